@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The bloblist cache stores materialized (complete) bloblists for
+snapshots that are defined as a long chain of deltas on top of a base
+snapshot. A snapshot whose bloblist is found in the cache can be
+loaded with a single read, and any descendant snapshot can use it as
+a starting point instead of replaying the whole chain.
+
+Each cache entry is a file named after the revision. It contains the
+md5 checksum of the payload, a newline, and the payload itself, which
+is a zlib compressed json document. The cache is derived data and may
+be deleted at any time.
+
+The number of entries is bounded by MAX_ENTRIES. When a new entry
+makes the cache too large, the least recently used entries are
+removed. The modification time of an entry is used as its time of
+last use, and is updated whenever the entry is loaded.
+"""
+
+import os
+import zlib
+import tempfile
+
+from common import *
+
+# A snapshot bloblist is materialized only if at least this many raw
+# bloblists had to be read to construct it.
+MIN_CHAIN_LENGTH = 3
+
+# The maximum number of materialized bloblists to keep.
+MAX_ENTRIES = 50
+
+class BloblistCache(object):
+    def __init__(self, cache_dir, writable = True):
+        assert os.path.isabs(cache_dir)
+        self.cache_dir = cache_dir
+        self.writable = writable
+
+    def __get_path(self, rev):
+        assert isinstance(rev, int) and rev > 0
+        return os.path.join(self.cache_dir, "%s.bloblist" % rev)
+
+    def has(self, rev):
+        return os.path.exists(self.__get_path(rev))
+
+    def load(self, rev, fingerprint):
+        """Returns a tuple (bloblist, load_stats) for the given revision,
+        or None if there is no valid cached bloblist for it. The
+        fingerprint must be the fingerprint of the snapshot, and is
+        used to make sure the cache entry still describes the
+        snapshot."""
+        path = self.__get_path(rev)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        checksum, _, payload = data.partition(b"\n")
+        try:
+            if md5sum(payload) != bytes2str(checksum):
+                raise ValueError("Checksum mismatch")
+            entry = get_json_module().loads(zlib.decompress(payload))
+        except (ValueError, zlib.error):
+            warn("Cached bloblist for snapshot %s is corrupt - ignoring it" % rev)
+            self.remove(rev)
+            return None
+        if entry['fingerprint'] != fingerprint:
+            # Probably an erased snapshot.
+            self.remove(rev)
+            return None
+        if self.writable:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return entry['bloblist'], entry['load_stats']
+
+    def save(self, rev, fingerprint, bloblist, load_stats):
+        """Stores the complete bloblist for the given revision. Does
+        nothing if the cache is not writable."""
+        if not self.writable:
+            return
+        entry = {'fingerprint': fingerprint,
+                 'load_stats': load_stats,
+                 'bloblist': bloblist}
+        payload = zlib.compress(get_json_module().dumps(entry).encode("utf-8"), 1)
+        data = str2bytes(md5sum(payload)) + b"\n" + payload
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.mkdir(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        fd, tmppath = tempfile.mkstemp(prefix = "tmp_", dir = self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmppath, self.__get_path(rev))
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        self.__trim()
+
+    def __trim(self):
+        """Removes the least recently used entries until there are no
+        more than MAX_ENTRIES left."""
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(".bloblist"):
+                continue
+            try:
+                entries.append((os.stat(os.path.join(self.cache_dir, fn)).st_mtime_ns, fn))
+            except OSError:
+                pass # Removed by someone else
+        entries.sort()
+        for mtime, fn in entries[:max(0, len(entries) - MAX_ENTRIES)]:
+            try:
+                os.remove(os.path.join(self.cache_dir, fn))
+            except OSError:
+                pass
+
+    def remove(self, rev):
+        if not self.writable:
+            return
+        try:
+            os.remove(self.__get_path(rev))
+        except OSError:
+            pass
@@ -2,7 +2,8 @@ from common import *
 from jsonrpc import DataSource
 import deduplication
 import boar_exceptions
-from copy import copy
+import bisect
+from collections import OrderedDict
 
 """ A recipe has the following format:
 
@@ -27,6 +28,10 @@ def create_blob_reader(recipe, repo):
     assert recipe
     return RecipeReader(recipe, repo)
 
+# The maximum number of blob files that a single recipe reader keeps
+# open at the same time.
+MAX_OPEN_BLOBS = 16
+
 class RecipeReader(DataSource):
     def __init__(self, recipe, repo, offset = 0, size = None, local_path = None):
         assert offset >= 0
@@ -38,28 +43,38 @@ class RecipeReader(DataSource):
         self.local_path = local_path
         self.progress_callback = lambda x: None
 
-        self.pieces = []
         self.blob_paths = {} # Blob id -> blob path
-        self.file_handles = {} # blob -> handle
-
-        # Expand repeated pieces
+        self.file_handles = OrderedDict() # blob path -> handle, least recently used first
+
+        # The pieces are stored as parallel lists, indexed by piece
+        # number. A piece with a repeat count is stored only once and
+        # covers piece_sizes[n] * piece_repeats[n] bytes of the
+        # recipe, starting at piece_starts[n].
+        self.piece_starts = []
+        self.piece_sources = []
+        self.piece_offsets = []
+        self.piece_sizes = []
+        self.piece_repeats = []
         piece_size_sum = 0
         for piece in recipe['pieces']:
             repeat = piece.get('repeat', 1)
-            for n in range(0, repeat):
-                piece_to_add = copy(piece)
-                piece_to_add['position_in_recipe'] = piece_size_sum
-                piece_size_sum += piece['size']
-                self.pieces.append(piece_to_add)
+            assert repeat >= 0 and piece['size'] >= 0 and piece['offset'] >= 0
             blob = piece['source']
-            blobpath = None
-            if self.local_path:
-                blobpath =  os.path.join(self.local_path, blob)
-            if not blobpath or not os.path.exists(blobpath):
-                blobpath = self.repo.get_blob_path(blob)
-            if not os.path.exists(blobpath):
-                raise boar_exceptions.CorruptionError("A recipe (%s) refers to a missing blob (%s)" % (recipe['md5sum'], blob))
-            self.blob_paths[piece['source']] = blobpath
+            if blob not in self.blob_paths:
+                blobpath = None
+                if self.local_path:
+                    blobpath =  os.path.join(self.local_path, blob)
+                if not blobpath or not os.path.exists(blobpath):
+                    blobpath = self.repo.get_blob_path(blob)
+                if not os.path.exists(blobpath):
+                    raise boar_exceptions.CorruptionError("A recipe (%s) refers to a missing blob (%s)" % (recipe['md5sum'], blob))
+                self.blob_paths[blob] = blobpath
+            self.piece_starts.append(piece_size_sum)
+            self.piece_sources.append(self.blob_paths[blob])
+            self.piece_offsets.append(piece['offset'])
+            self.piece_sizes.append(piece['size'])
+            self.piece_repeats.append(repeat)
+            piece_size_sum += piece['size'] * repeat
 
         if piece_size_sum != recipe['size']:
             raise boar_exceptions.CorruptionError("Recipe is internally inconsistent: %s" % recipe['md5sum'])
@@ -72,7 +87,6 @@ class RecipeReader(DataSource):
 
         self.bytes_left_in_segment = self.segment_size
         self.segment_start_in_recipe = offset
-        self.current_piece_index = 0
 
         assert self.segment_start_in_recipe + self.bytes_left_in_segment <= recipe['size']
 
@@ -80,42 +94,80 @@ class RecipeReader(DataSource):
     def bytes_left(self):
         return self.bytes_left_in_segment
 
-    def __del__(self):
+    def close(self):
         for f in list(self.file_handles.values()):
             f.close()
-        del self.file_handles
-
-    def __read_from_blob(self, blob, position, size):
-        blobpath = self.blob_paths[blob]
-        if blobpath not in self.file_handles:
-            for f in list(self.file_handles.values()):
-                f.close()
-            self.file_handles.clear()
-            self.file_handles[blobpath] = open(blobpath, "rb")
-        f = self.file_handles[blobpath]
-        f.seek(position)
-        data = f.read(size)
-        #print "read_from_blob(blob=%s, position=%s, size=%s) => '%s'" % (blob, position, size, data)
-        return data
-
-    def __search_forward(self, pos, start_index = 0):
-        index = start_index
-        while True:
-            piece = self.pieces[index]
-            piece_start = piece['position_in_recipe']
-            piece_end = piece_start + piece['size']
-            if piece_start <= pos < piece_end:
-                break
-            index += 1
-        #print "search_forward(%s, %s) => %s" % (pos, start_index, index)
+        self.file_handles.clear()
+
+    def __del__(self):
+        if hasattr(self, "file_handles"):
+            self.close()
+
+    def __get_file_handle(self, blobpath):
+        f = self.file_handles.get(blobpath, None)
+        if f:
+            self.file_handles.move_to_end(blobpath)
+            return f
+        if len(self.file_handles) >= MAX_OPEN_BLOBS:
+            _, oldest = self.file_handles.popitem(last = False)
+            oldest.close()
+        f = open(blobpath, "rb")
+        self.file_handles[blobpath] = f
+        return f
+
+    def __find_piece(self, pos):
+        """Returns the index of the piece that contains the given
+        recipe position. Zero-length pieces are never returned, as
+        they share their start position with the following piece."""
+        index = bisect.bisect_right(self.piece_starts, pos) - 1
+        assert index >= 0
         return index
 
-    def __read_piece_data(self, piece, recipe_pos, max_size):
-        piece_pos = recipe_pos - piece['position_in_recipe']
-        blob_pos = piece['offset'] + piece_pos
-        available_blob_data_size = piece['size'] - piece_pos
-        blob_read_size = min(available_blob_data_size, max_size)
-        return self.__read_from_blob(piece['source'], blob_pos, blob_read_size)
+    def __read_piece_data(self, index, recipe_pos, view):
+        """Reads as much data as will fit in the given memoryview, but
+        not past the end of the current repetition of the piece at the
+        given index. Returns the number of bytes read."""
+        size = self.piece_sizes[index]
+        piece_pos = (recipe_pos - self.piece_starts[index]) % size
+        blob_read_size = min(size - piece_pos, len(view))
+        f = self.__get_file_handle(self.piece_sources[index])
+        f.seek(self.piece_offsets[index] + piece_pos)
+        bytes_read = f.readinto(view[:blob_read_size])
+        if not bytes_read:
+            raise boar_exceptions.CorruptionError("Blob %s is shorter than expected" % self.piece_sources[index])
+        return bytes_read
+
+    def __readinto_at(self, position, view):
+        """Fills the given memoryview with recipe data starting at the
+        given recipe position."""
+        filled = 0
+        while filled < len(view):
+            index = self.__find_piece(position + filled)
+            filled += self.__read_piece_data(index, position + filled, view[filled:])
+
+    @overrides(DataSource)
+    def readinto(self, buffer):
+        """Reads data into the given writable buffer, but no more than
+        is left in the segment. Returns the number of bytes read."""
+        view = memoryview(buffer).cast("B")
+        readsize = min(self.bytes_left_in_segment, len(view))
+        current_recipe_read_position = self.segment_start_in_recipe + (self.segment_size - self.bytes_left_in_segment)
+        self.__readinto_at(current_recipe_read_position, view[:readsize])
+        self.bytes_left_in_segment -= readsize
+        self.progress_callback(calculate_progress(self.segment_size, self.segment_size - self.bytes_left_in_segment))
+        return readsize
+
+    def read_at(self, position, size):
+        """Returns up to size bytes of recipe data, starting at the
+        given position in the recipe. The position is independent of
+        the segment given at construction, and this method does not
+        affect the state of ordinary reads. Useful for random access,
+        such as serving file system reads."""
+        assert position >= 0 and size >= 0
+        size = max(0, min(size, self.recipe_size - position))
+        result = bytearray(size)
+        self.__readinto_at(position, memoryview(result))
+        return bytes(result)
 
     @overrides(DataSource)
     def read(self, readsize = None):
@@ -124,18 +176,9 @@ class RecipeReader(DataSource):
             readsize = self.bytes_left_in_segment
         readsize = min(self.bytes_left_in_segment, readsize)
         assert readsize >= 0
-
-        result = b""
-        while len(result) < readsize:
-            #print self.segment_start_in_recipe, self.segment_size, self.bytes_left_in_segment
-            current_recipe_read_position = self.segment_start_in_recipe + (self.segment_size - self.bytes_left_in_segment)
-            self.current_piece_index = self.__search_forward(current_recipe_read_position, start_index = self.current_piece_index)
-            remaining = readsize - len(result)
-            data = self.__read_piece_data(self.pieces[self.current_piece_index], current_recipe_read_position, remaining)
-            result += data
-            self.bytes_left_in_segment -= len(data)
-        self.progress_callback(calculate_progress(self.segment_size, self.segment_size - self.bytes_left_in_segment))
-        return result
+        result = bytearray(readsize)
+        self.readinto(result)
+        return bytes(result)
 
     def set_progress_callback(self, progress_callback):
         assert callable(progress_callback)
@@ -23,9 +23,13 @@ import os
 import re
 import shutil
 from . import sessions
+from . import sessionindex
+from . import bloblistcache
 import sys
 import tempfile
 import random, time
+import hmac
+import threading
 
 from common import *
 from boar_common import *
@@ -37,6 +41,11 @@ from .blobreader import create_blob_reader
 import deduplication
 
 LATEST_REPO_FORMAT = 5
+# Repositories in the "chunks" deduplication mode are marked with this
+# format version instead of LATEST_REPO_FORMAT, so that boar versions
+# that do not know about the mode refuse to open them. The format is
+# otherwise the same as LATEST_REPO_FORMAT.
+CHUNKS_REPO_FORMAT = 6
 REPOID_FILE = "repoid.txt"
 VERSION_FILE = "version.txt"
 RECOVERYTEXT_FILE = "recovery.txt"
@@ -49,8 +58,20 @@ DERIVED_DIR = "derived"
 DERIVED_SHA256_DIR = os.path.join(DERIVED_DIR, "sha256")
 DERIVED_BLOCKS_DIR = os.path.join(DERIVED_DIR, "blocks")
 DERIVED_BLOCKS_DB = os.path.join(DERIVED_BLOCKS_DIR, "blocks.db")
+DERIVED_SESSIONS_DB = os.path.join(DERIVED_DIR, "sessions.db")
+DERIVED_BLOBLISTS_DIR = os.path.join(DERIVED_DIR, "bloblists")
 DELETE_MARKER = "deleted.json"
+MANIFEST_FILE = "manifest.json"
+# The assumed worst case timestamp granularity of a file system, in
+# seconds (FAT has two seconds)
+SESSIONS_MTIME_GRANULARITY = 2
+BLOCK_LIST_FILE = "blocks.bin"
+CHUNK_LIST_FILE = "chunks.bin"
+# Written instead of the block list by older versions
+LEGACY_BLOCKS_FILE = "blocks.json"
+PARTIAL_UPLOADS_DIR = os.path.join(TMP_DIR, "partial_uploads")
 MAXBLOBSIZE_FILE = "maxblobsize.txt"
+DEDUPLICATION_FILE = "ENABLE_DEDUPLICATION"
 
 # The smallest maximum blob size that may be configured for a
 # repository. It must be at least one deduplication block so that the
@@ -71,6 +92,35 @@ REPO_DIRS_V5 = (QUEUE_DIR, BLOB_DIR, SESSIONS_DIR, TMP_DIR,\
 
 DEDUP_BLOCK_SIZE = 2**16
 
+# The deduplication modes. In the "blocks" mode, data is deduplicated
+# against fixed size blocks of previously stored blobs, which are
+# found with a rolling checksum. In the "chunks" mode, data is cut
+# into content-defined chunks, and chunks that are already stored are
+# referenced. The mode is stored in the DEDUPLICATION_FILE, which is
+# empty for the "blocks" mode. Repositories in the "chunks" mode also
+# have the format version CHUNKS_REPO_FORMAT.
+DEDUP_MODE_BLOCKS = "blocks"
+DEDUP_MODE_CHUNKS = "chunks"
+DEDUP_MODES = (DEDUP_MODE_BLOCKS, DEDUP_MODE_CHUNKS)
+
+# The (minimum, average, maximum) chunk size in the "chunks"
+# deduplication mode. The average must be a power of two.
+DEDUP_CHUNK_SIZES = (2**14, 2**16, 2**18)
+
+# Uploads of blobs at least this large are kept in the partial uploads
+# directory while they are received, so that an interrupted upload can
+# be resumed. This requires file locking with fcntl.flock(). On
+# platforms without fcntl, such as Windows, uploads are not resumable,
+# and an interrupted upload starts over from the beginning.
+RESUMABLE_UPLOAD_MIN_SIZE = 16 * 2**20
+
+# Partial uploads that have not been resumed for this many seconds are
+# removed when a new snapshot is started.
+PARTIAL_UPLOAD_MAX_AGE = 7 * 24 * 3600
+
+# The read size used when verifying the checksum of new blobs
+VERIFY_BLOCK_SIZE = 2**20
+
 def aligned_split_size(max_blob_size, block_size = DEDUP_BLOCK_SIZE):
     """Returns the actual size at which a repository with the given maximum
     blob size cuts blobs into sub-blobs: the maximum rounded down to a whole
@@ -201,23 +251,37 @@ def integrity_assert(test, errormsg = None):
         raise CorruptionError(errormsg)
 
 def create_repository(repopath, enable_deduplication = False, max_blob_size = None):
+    """Creates a new repository at the given path. The
+    enable_deduplication argument may be True (the same as
+    DEDUP_MODE_BLOCKS) or one of DEDUP_MODES to create a repository
+    that deduplicates data."""
+    if enable_deduplication == True:
+        enable_deduplication = DEDUP_MODE_BLOCKS
+    if enable_deduplication and enable_deduplication not in DEDUP_MODES:
+        raise UserError("Unknown deduplication mode: %s" % enable_deduplication)
     if enable_deduplication and not deduplication.dedup_available:
         # Ok, we COULD create a deduplicated repo without the module,
         # but the user is likely to be confused when he cannot use it.
-        raise UserError("Cannot create deduplicated repository: deduplication module is not installed")
+        raise UserError("Cannot create deduplicated repository: %s" % deduplication.dedup_unavailable_reason())
     if max_blob_size is not None:
         assert isinstance(max_blob_size, int)
         if max_blob_size < MIN_MAX_BLOB_SIZE:
             raise UserError("Maximum blob size must be at least %s bytes" % MIN_MAX_BLOB_SIZE)
     os.mkdir(repopath)
-    create_file(os.path.join(repopath, VERSION_FILE), str(LATEST_REPO_FORMAT))
+    if enable_deduplication == DEDUP_MODE_CHUNKS:
+        create_file(os.path.join(repopath, VERSION_FILE), str(CHUNKS_REPO_FORMAT))
+    else:
+        create_file(os.path.join(repopath, VERSION_FILE), str(LATEST_REPO_FORMAT))
     for d in QUEUE_DIR, BLOB_DIR, SESSIONS_DIR, TMP_DIR, DERIVED_DIR, DERIVED_BLOCKS_DIR, RECIPES_DIR:
         os.mkdir(os.path.join(repopath, d))
     create_file(os.path.join(repopath, "recovery.txt"), recoverytext)
     create_file(os.path.join(repopath, REPOID_FILE), generate_random_repoid())
-    if enable_deduplication:
-        with open(os.path.join(repopath, "ENABLE_DEDUPLICATION"), "wb"):
+    if enable_deduplication == DEDUP_MODE_BLOCKS:
+        # An empty file, as written by earlier versions
+        with open(os.path.join(repopath, DEDUPLICATION_FILE), "wb"):
             pass
+    elif enable_deduplication:
+        create_file(os.path.join(repopath, DEDUPLICATION_FILE), enable_deduplication)
     if max_blob_size is not None:
         create_file(os.path.join(repopath, MAXBLOBSIZE_FILE), str(max_blob_size))
 
@@ -256,7 +320,21 @@ class Repo(object):
         self.repopath = repopath
         if self.__get_repo_version() > LATEST_REPO_FORMAT:
             raise UserError("Repo is from a future boar version. Upgrade your boar.")
+        # The session reader cache and the session index may be used
+        # by several threads at once (see boarserve), so they are
+        # protected by these locks. Everything else that the read-only
+        # methods touch is only read from disk.
         self.session_readers = {}
+        self.session_readers_lock = threading.Lock()
+        self.session_index = None
+        self.session_index_lock = threading.RLock()
+        # The modification time of the sessions dir when the session
+        # index was last brought up to date, see get_session_index()
+        self.session_index_synced_mtime = None
+        # A secret that is used to sign the verification manifests of
+        # transactions written through this instance. Any transaction
+        # not created by this instance will be fully verified.
+        self.transaction_key = os.urandom(32)
         self.scanners = ()
         self.repo_mutex = FileMutex(os.path.join(repopath, TMP_DIR), "__REPOLOCK__")
         misuse_assert(os.path.exists(self.repopath), "No such directory: %s" % (self.repopath))
@@ -272,7 +350,11 @@ class Repo(object):
 
         if self.deduplication_enabled() and not deduplication.dedup_available:
             self.readonly = True
-            notice("This repository requires the native deduplication module for writing - only read operations can be performed.")
+            notice("This repository requires the native deduplication module for writing (%s) - only read operations can be performed." %
+                   deduplication.dedup_unavailable_reason())
+
+        self.bloblist_cache = bloblistcache.BloblistCache(self.get_path(DERIVED_BLOBLISTS_DIR),
+                                                          writable = not self.readonly)
 
         if not self.readonly:
             self.repo_mutex.lock_with_timeout(60)
@@ -293,7 +375,10 @@ class Repo(object):
         self.repo_mutex.release()
 
     def close(self):
-        pass
+        with self.session_index_lock:
+            if self.session_index:
+                self.session_index.close()
+                self.session_index = None
 
     def __quick_check(self):
         """This method must be called after any repository upgrade
@@ -315,7 +400,35 @@ class Repo(object):
         return os.path.exists(os.path.join(self.repopath, "ENABLE_PERMANENT_ERASE"))
 
     def deduplication_enabled(self):
-        return os.path.exists(os.path.join(self.repopath, "ENABLE_DEDUPLICATION"))
+        return os.path.exists(os.path.join(self.repopath, DEDUPLICATION_FILE))
+
+    def get_deduplication_mode(self):
+        """Returns the deduplication mode of this repository, one of
+        DEDUP_MODES, or None if deduplication is not enabled."""
+        if not hasattr(self, "_deduplication_mode_cache"):
+            path = os.path.join(self.repopath, DEDUPLICATION_FILE)
+            if os.path.exists(path):
+                mode = bytes2str(read_file(path)).strip() or DEDUP_MODE_BLOCKS
+                if mode not in DEDUP_MODES:
+                    raise UserError("Repository uses an unknown deduplication mode (%s). Upgrade your boar." % mode)
+                self._deduplication_mode_cache = mode
+            else:
+                self._deduplication_mode_cache = None
+        return self._deduplication_mode_cache
+
+    def paranoid_verification_enabled(self):
+        """If true, all blobs and recipes in a commit are re-read and
+        verified before they are accepted, even if they were verified
+        while they were received."""
+        return os.path.exists(os.path.join(self.repopath, "ENABLE_PARANOID_VERIFICATION"))
+
+    def sign_transaction_data(self, data):
+        """Returns a signature for the given data that can only be
+        created by this repository instance. It is used to
+        authenticate the verification manifest that a session writer
+        passes on to the commit processing."""
+        assert type(data) == bytes
+        return hmac.new(self.transaction_key, data, hashlib.sha256).hexdigest()
 
     def get_max_blob_size(self):
         """Returns the configured maximum raw blob size in bytes, or
@@ -366,6 +479,11 @@ class Repo(object):
         if version > LATEST_REPO_FORMAT:
             raise UserError("Repo version %s can not be handled by this version of boar" % version)
         if version == LATEST_REPO_FORMAT:
+            if self.get_deduplication_mode() == DEDUP_MODE_CHUNKS and \
+                    self.__read_version_file() != CHUNKS_REPO_FORMAT:
+                # Created before the chunks mode had its own format
+                # version.
+                replace_file(os.path.join(self.repopath, VERSION_FILE), str(CHUNKS_REPO_FORMAT))
             return
         notice("Old repo format detected. Upgrading...")
         if self.__get_repo_version() == 0:
@@ -537,6 +655,18 @@ class Repo(object):
     def get_tmpdir(self):
         return self.get_path(TMP_DIR)
 
+    def get_partial_upload_path(self, blob_md5):
+        """Returns the path where the received data of an unfinished
+        upload of the given blob is kept."""
+        assert is_md5sum(blob_md5)
+        partial_dir = self.get_path(PARTIAL_UPLOADS_DIR)
+        if not os.path.exists(partial_dir):
+            try:
+                os.mkdir(partial_dir)
+            except FileExistsError:
+                pass # Created concurrently
+        return os.path.join(partial_dir, blob_md5 + ".partial")
+
     def get_repo_identifier(self):
         """Returns the identifier for the repo, or None if the
         repository has no identifier. The latter scenarion will
@@ -551,11 +681,20 @@ class Repo(object):
         assert re.match("^[a-zA-Z0-9_-]+$", identifier), "illegal characters in repo identifier '%s'" % identifier
         return identifier
 
-    def __get_repo_version(self):
+    def __read_version_file(self):
         version_file = os.path.join(self.repopath, VERSION_FILE)
-        if os.path.exists(version_file):
-            with safe_open(version_file, "rb") as f:
-                return int(f.read())
+        if not os.path.exists(version_file):
+            return None
+        with safe_open(version_file, "rb") as f:
+            return int(f.read())
+
+    def __get_repo_version(self):
+        version = self.__read_version_file()
+        if version == CHUNKS_REPO_FORMAT:
+            # Same as the latest format, see CHUNKS_REPO_FORMAT
+            return LATEST_REPO_FORMAT
+        if version != None:
+            return version
         # Repo is from before repo format numbering started.
         # Make sure it is a valid one and return v0
         for directory in REPO_DIRS_V0:
@@ -662,11 +801,75 @@ class Repo(object):
         return self.get_session(rev).is_deleted()
 
     def get_deleted_snapshots(self):
-        result = []
-        for sid in self.get_all_sessions():
-            if self.get_session(sid).is_deleted():
-                result.append(sid)
-        return result
+        return self.get_session_index().get_deleted_revisions()
+
+    def get_session_index(self):
+        """Returns the session index for this repository, brought up to
+        date with the snapshots that currently exist. The index is
+        stored under "derived" if the repository is writable, and kept
+        in memory otherwise. The sessions dir is only listed again if
+        its modification time has changed since the last call. Entries
+        whose stamp no longer matches the snapshot are rebuilt. This
+        catches snapshots that were rewritten (for instance erased) by
+        an index-unaware boar version, since the first call for every
+        Repo instance always checks all the stamps."""
+        with self.session_index_lock:
+            self.__open_session_index()
+            sessions_mtime = os.stat(self.get_path(SESSIONS_DIR)).st_mtime_ns
+            if sessions_mtime == self.session_index_synced_mtime:
+                return self.session_index
+            all_sids = self.get_all_sessions()
+            indexed_stamps = self.session_index.get_stamps()
+            entries = []
+            for sid in all_sids:
+                stamp = sessionindex.get_session_stamp(self.get_session_path(sid))
+                if sid in indexed_stamps and indexed_stamps[sid] == stamp:
+                    continue
+                # Snapshots committed or rewritten by an index-unaware
+                # boar version, or an index that was deleted. Bypass the
+                # session reader cache to avoid keeping every snapshot in
+                # memory.
+                self.forget_session_reader(sid)
+                reader = sessions.SessionReader(self, self.get_session_path(sid))
+                entries.append(sessionindex.session_index_entry(sid, reader, stamp))
+            removed_sids = set(indexed_stamps) - set(all_sids)
+            if entries or removed_sids:
+                self.session_index.update(entries, removed_sids)
+            if time.time() - sessions_mtime / 1e9 > SESSIONS_MTIME_GRANULARITY:
+                # A snapshot created within the timestamp granularity of
+                # the file system might not change the mtime. Don't trust
+                # a recent mtime.
+                self.session_index_synced_mtime = sessions_mtime
+            return self.session_index
+
+    def __open_session_index(self):
+        with self.session_index_lock:
+            if self.session_index == None:
+                dbpath = ":memory:"
+                if not self.readonly:
+                    dbpath = self.get_path(DERIVED_SESSIONS_DB)
+                self.session_index = sessionindex.SessionIndex(dbpath)
+            return self.session_index
+
+    def __update_session_index(self, rev):
+        """Updates the session index entry for the given snapshot. Must
+        be called whenever a snapshot is created or modified."""
+        self.forget_session_reader(rev)
+        stamp = sessionindex.get_session_stamp(self.get_session_path(rev))
+        reader = self.get_session(rev)
+        self.__open_session_index().update([sessionindex.session_index_entry(rev, reader, stamp)])
+
+    def get_session_names(self):
+        """Returns a list of the names of all sessions in the
+        repository, including meta sessions and the "__deleted"
+        pseudo-session. """
+        return self.get_session_index().get_session_names()
+
+    def get_session_ids(self, session_name):
+        """Returns a sorted list of all the revisions that belong to the
+        given session."""
+        assert isinstance(session_name, str)
+        return self.get_session_index().get_revisions(session_name)
 
     def get_highest_used_revision(self):
         """ Returns the highest used revision id in the
@@ -695,9 +898,26 @@ class Repo(object):
         assert id, "Id was: "+ str(id)
         assert isinstance(id, int)
         misuse_assert(self.has_snapshot(id), "There is no snapshot with id %s" % id)
-        if id not in self.session_readers:
-            self.session_readers[id] = sessions.SessionReader(self, self.get_session_path(id))
-        return self.session_readers[id]
+        with self.session_readers_lock:
+            reader = self.session_readers.get(id)
+        if reader == None:
+            # Opened without holding the lock, since it means reading
+            # from disk. Another thread may do the same, in which case
+            # the first reader to be stored wins.
+            reader = sessions.SessionReader(self, self.get_session_path(id))
+            with self.session_readers_lock:
+                reader = self.session_readers.setdefault(id, reader)
+        return reader
+
+    def forget_session_reader(self, id = None):
+        """Removes the given snapshot, or all snapshots if id is None,
+        from the session reader cache. Must be called when a snapshot
+        may have been modified."""
+        with self.session_readers_lock:
+            if id == None:
+                self.session_readers.clear()
+            else:
+                self.session_readers.pop(id, None)
 
     def create_snapshot(self, session_name, base_session = None, session_id = None, force_base_snapshot = False):
         misuse_assert(not self.readonly, "Repository is read-only")
@@ -714,15 +934,15 @@ class Repo(object):
         """ Returns the id of the latest snapshot in the specified
         session. Returns None if there is no such session. """
         assert isinstance(session_name, str)
-        all_sids = self.get_all_sessions()
-        all_sids.sort()
-        all_sids.reverse()
-        for sid in all_sids:
-            session = self.get_session(sid)
-            name = session.get_client_value("name")
-            if name == session_name:
-                return sid
-        return None
+        if self.readonly and self.session_index == None:
+            # Building the in-memory index means opening every
+            # snapshot. Usually, the latest snapshot of a session is
+            # found by opening only a few of them.
+            for sid in sorted(self.get_all_sessions(), reverse = True):
+                if self.get_session(sid).get_client_value("name") == session_name:
+                    return sid
+            return None
+        return self.get_session_index().find_last_revision(session_name)
 
     def find_next_session_id(self):
         return self.get_highest_used_revision() + 1
@@ -890,12 +1110,7 @@ class Repo(object):
         """ Returns a (possibly empty) list of all the snapshots that
         has the given rev as base snapshot. """
         assert isinstance(rev, int)
-        result = []
-        for sid in self.get_all_sessions():
-            snapshot = self.get_session(sid)
-            if snapshot.get_base_id() == rev:
-                result.append(rev)
-        return result
+        return self.get_session_index().get_referring_revisions(rev)
 
     def get_introduced_blobs(self):
         seen_blobs = set()
@@ -935,8 +1150,8 @@ class Repo(object):
         misuse_assert(not self.readonly, "Cannot erase snapshots from a write protected repo")
         if self.get_referring_snapshots(rev):
             raise MisuseError("Erasing rev %s would create orphan snapshots" % rev)
-        if rev in self.session_readers:
-            del self.session_readers[rev]
+        self.forget_session_reader(rev)
+        self.bloblist_cache.remove(rev)
 
         session_path = self.get_session_path(rev)
         delete_copy = os.path.join(session_path, "deleted")
@@ -959,6 +1174,7 @@ class Repo(object):
         writer.set_fingerprint("d41d8cd98f00b204e9800998ecf8427e")
         writer.commit()
         os.rename(delete_copy, os.path.join(trashdir, str(rev) + ".deleted"))
+        self.__update_session_index(rev)
 
     def erase_orphan_blobs(self):
         assert self.repo_mutex.is_locked()
@@ -994,7 +1210,7 @@ class Repo(object):
         progress_callback(.01)
         sw.mark("Lock mutex and init")
 
-        transaction = Transaction(self, queued_item)
+        transaction = Transaction(self, queued_item, paranoid = self.paranoid_verification_enabled())
         transaction.verify_meta()
         progress_callback(.02)
         sw.mark("Meta check 1")
@@ -1020,6 +1236,8 @@ class Repo(object):
         transaction.verify_meta()
         sw.mark("Meta check 2")
 
+        transaction.discard_manifest()
+
         # Everything seems OK, move the blobs and consolidate the session
         transaction.integrate_files()
         sw.mark("Files integrated")
@@ -1038,6 +1256,8 @@ class Repo(object):
         self._before_transaction_completion()
         shutil.move(queued_item, session_path)
         assert not self.get_queued_session_id(), "Commit completed, but queue should be empty after processing"
+        self.__update_session_index(session_id)
+        sw.mark("Session index updated")
         progress_callback(1.0)
         sw.mark("done")
 
@@ -1050,10 +1270,34 @@ class Repo(object):
 
 class Transaction(object):
 
-    def __init__(self, repo, transaction_dir):
+    def __init__(self, repo, transaction_dir, paranoid = False):
         self.repo = repo
         self.path = transaction_dir
         self.session_reader = sessions.SessionReader(repo, self.path)
+        self.verified_blobs = {}
+        if not paranoid:
+            self.__load_manifest()
+
+    def __load_manifest(self):
+        """Loads the list of raw blobs that were verified by
+        the session writer while they were received. The manifest is
+        only trusted if it is signed by this repository instance."""
+        manifest_path = self.get_path(MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return
+        manifest_data = read_json(manifest_path)
+        manifest = manifest_data['manifest']
+        payload = str2bytes(get_json_module().dumps(manifest, sort_keys = True))
+        if not hmac.compare_digest(self.repo.sign_transaction_data(payload), manifest_data['signature']):
+            # Not written by us, possibly a transaction that is
+            # resumed after a crash. Verify everything.
+            return
+        self.verified_blobs = manifest['blobs']
+
+    def discard_manifest(self):
+        manifest_path = self.get_path(MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            safe_delete_file(manifest_path)
 
     def integrate_deletions(self):
         snapshots_to_delete = []
@@ -1088,27 +1332,52 @@ class Transaction(object):
 
 
     def integrate_blocks(self):
+        self.integrate_chunks()
         blocksdb = self.repo.blocksdb
-        blocks_fname = os.path.join(self.path, "blocks.json")
-        if not os.path.exists(blocks_fname):
+        blocks_fname = self.get_path(BLOCK_LIST_FILE)
+        legacy_blocks_fname = self.get_path(LEGACY_BLOCKS_FILE)
+        if os.path.exists(blocks_fname):
+            blocks = deduplication.read_block_list(blocks_fname)
+        elif os.path.exists(legacy_blocks_fname):
+            blocks_fname = legacy_blocks_fname
+            blocks = [(str2bytes(blob_md5), offset, rolling, str2bytes(md5))
+                      for blob_md5, offset, rolling, md5 in read_json(blocks_fname)]
+        else:
             return
-        blocks = read_json(blocks_fname)
+        raw_blob_exists = {}
+        def existing_blocks():
+            for block in blocks:
+                blob_md5 = block[0]
+                if blob_md5 not in raw_blob_exists:
+                    # Possibly another commit sneaked in a recipe while we
+                    # were looking the other way. Let's be lenient for now.
+
+                    # assert self.has_raw_blob(blob_md5), "Tried to register a
+                    # block for non-existing blob %s" % blob_md5
+                    raw_blob_exists[blob_md5] = self.repo.has_raw_blob(bytes2str(blob_md5))
+                if raw_blob_exists[blob_md5]:
+                    yield block
         blocksdb.begin()
-        for block_spec in blocks:
-            blob_md5, offset, rolling, sha256 = block_spec
-            blob_md5 = str2bytes(blob_md5)
-            sha256 = str2bytes(sha256)
-            # Possibly another commit sneaked in a recipe while we
-            # were looking the other way. Let's be lenient for now.
-
-            # assert self.has_raw_blob(blob_md5), "Tried to register a
-            # block for non-existing blob %s" % blob_md5
-            if self.repo.has_raw_blob(blob_md5):
-                blocksdb.add_block(blob_md5, offset, sha256)
-                blocksdb.add_rolling(rolling)
+        blocksdb.add_blocks(existing_blocks())
         blocksdb.commit()
         safe_delete_file(blocks_fname)
 
+    def integrate_chunks(self):
+        """Registers the content-defined chunks that were found in
+        the new blobs of this transaction."""
+        blocksdb = self.repo.blocksdb
+        chunks_fname = self.get_path(CHUNK_LIST_FILE)
+        if not os.path.exists(chunks_fname):
+            return
+        chunks = deduplication.read_block_list(chunks_fname, magic = deduplication.CHUNK_LIST_MAGIC)
+        blocksdb.begin()
+        for blob_md5, offset, size, md5 in chunks:
+            # Be lenient, just like for blocks
+            if self.repo.has_raw_blob(blob_md5):
+                blocksdb.add_chunk(blob_md5, offset, size, md5)
+        blocksdb.commit()
+        safe_delete_file(chunks_fname)
+
 
     def get_raw_blobs(self):
         """Returns a list of all raw blobs that are present in the transaction directory"""
@@ -1131,31 +1400,54 @@ class Transaction(object):
 
     def verify_blobs(self, progress_callback = lambda x: None):
         """Read and checksum all raw blobs in the transaction. An
-        assertion error is raised if any errors are found."""
-        raw_blobs = self.get_raw_blobs()
-        for n, blob in enumerate(raw_blobs):
+        assertion error is raised if any errors are found. The blobs
+        are verified in parallel, largest first. Blobs listed in a
+        trusted manifest are not read again."""
+        sizes = {}
+        for blob in self.get_raw_blobs():
+            size = os.path.getsize(self.get_path(blob))
+            if self.verified_blobs.get(blob, None) == size:
+                continue
+            sizes[blob] = size
+        def verifier(blob):
             full_path = self.get_path(blob)
-            pp = PartialProgress(float(n) / float(len(raw_blobs)), float(n+1) / float(len(raw_blobs)), progress_callback)
-            size = os.path.getsize(full_path)
-            assert blob == md5sum_file(full_path,
-                                       end=size,
-                                       progress_callback=pp), "Invalid blob found in queue dir:" + full_path
-            assert os.path.getsize(full_path) == size
-            #progress_callback((1.0*n+1)/len(raw_blobs))
+            def verify(report_work):
+                md5summer = hashlib.md5()
+                with safe_open(full_path, "rb") as f:
+                    for block in file_reader(f, end = sizes[blob], blocksize = VERIFY_BLOCK_SIZE):
+                        md5summer.update(block)
+                        report_work(len(block))
+                assert blob == md5summer.hexdigest(), "Invalid blob found in queue dir:" + full_path
+                assert os.path.getsize(full_path) == sizes[blob]
+            return verify
+        blobs = sorted(sizes.keys(), key = lambda blob: sizes[blob], reverse = True)
+        run_parallel_tasks([verifier(blob) for blob in blobs], sum(sizes.values()), progress_callback)
 
     def verify_recipes(self, progress_callback = lambda x: None):
         """Read and checksum all recipes in the transaction. An
-        assertion error is raised if any errors are found."""
+        assertion error is raised if any errors are found. The recipes
+        are verified in parallel, largest first. Recipes are always
+        read, even if listed in a trusted manifest, as they refer to
+        data in the repository that the session writer never read."""
+        recipes = {}
         for recipe_blob in self.get_recipes():
+            recipes[recipe_blob] = read_json(self.get_recipe_path(recipe_blob))
+        def verifier(recipe_blob):
             full_path = self.get_recipe_path(recipe_blob)
-            md5summer = hashlib.md5()
-            recipe = read_json(full_path)
-            reader = blobreader.RecipeReader(recipe, self.repo, local_path=self.path)
-            while reader.bytes_left():
-                # DEDUP_BLOCK_SIZE should fit the data nicely, as
-                # a recipe will be chunked suchwise.
-                md5summer.update(reader.read(DEDUP_BLOCK_SIZE))
-            assert recipe_blob == md5summer.hexdigest(), "Invalid recipe found in queue dir:" + full_path
+            def verify(report_work):
+                md5summer = hashlib.md5()
+                reader = blobreader.RecipeReader(recipes[recipe_blob], self.repo, local_path=self.path)
+                while reader.bytes_left():
+                    # DEDUP_BLOCK_SIZE should fit the data nicely, as
+                    # a recipe will be chunked suchwise.
+                    data = reader.read(DEDUP_BLOCK_SIZE)
+                    md5summer.update(data)
+                    report_work(len(data))
+                assert recipe_blob == md5summer.hexdigest(), "Invalid recipe found in queue dir:" + full_path
+            return verify
+        recipe_blobs = sorted(recipes.keys(), key = lambda blob: recipes[blob].get('size', 0), reverse = True)
+        run_parallel_tasks([verifier(blob) for blob in recipe_blobs],
+                           sum([recipe.get('size', 0) for recipe in recipes.values()]), progress_callback)
 
 
     def verify_meta(self):
@@ -1191,8 +1483,17 @@ class Transaction(object):
                 read_json(self.get_path("delete.json"))
                 has_delete = True
                 continue
-            if filename == "blocks.json":
-                read_json(self.get_path("blocks.json"))
+            if filename == LEGACY_BLOCKS_FILE:
+                read_json(self.get_path(filename))
+                continue
+            if filename == BLOCK_LIST_FILE:
+                deduplication.verify_block_list(self.get_path(filename))
+                continue
+            if filename == CHUNK_LIST_FILE:
+                deduplication.verify_block_list(self.get_path(filename), deduplication.CHUNK_LIST_MAGIC)
+                continue
+            if filename == MANIFEST_FILE:
+                read_json(self.get_path(MANIFEST_FILE))
                 continue
             assert False, "Unexpected file in new session:" + filename
         if has_delete:
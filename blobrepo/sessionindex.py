@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The session index is a derived, rebuildable summary of the snapshot
+definitions in a repository. For every revision it records the session
+name, the base snapshot, the deleted status and the fingerprint, so
+that questions such as "what is the latest revision of session X?" can
+be answered without opening every snapshot in the repository.
+
+The index is never authoritative. It is brought up to date with the
+contents of the "sessions" directory whenever it is used, and it may
+be deleted at any time. Every entry carries a stamp (the modification
+time of the session.json file it was read from), so that snapshots
+rewritten by an index-unaware boar version can be detected.
+"""
+
+import errno
+import os
+import sqlite3
+import threading
+
+from common import *
+
+SESSION_INDEX_VERSION = "2"
+
+class SessionIndex(object):
+    def __init__(self, dbpath):
+        """Opens (or creates) the session index at the given path. The
+        special path ":memory:" gives a non-persistent index, useful
+        for write protected repositories."""
+        assert dbpath == ":memory:" or os.path.isabs(dbpath)
+        self.dbpath = dbpath
+        self.lock = threading.RLock()
+        try:
+            self.conn = self.__open_db()
+        except sqlite3.DatabaseError:
+            # The index is derived data. If it is unreadable, just
+            # start over from scratch.
+            assert dbpath != ":memory:"
+            warn("Session index is corrupt, rebuilding: %s" % dbpath)
+            os.remove(dbpath)
+            self.conn = self.__open_db()
+
+    def __open_db(self):
+        conn = sqlite3.connect(self.dbpath, check_same_thread = False, timeout = 600)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS props (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (rev INTEGER PRIMARY KEY, name TEXT, base INTEGER, deleted INTEGER NOT NULL, fingerprint TEXT NOT NULL, stamp INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_name ON sessions (name, rev)")
+            conn.execute("INSERT OR IGNORE INTO props VALUES ('version', ?)", (SESSION_INDEX_VERSION,))
+            conn.commit()
+            version, = conn.execute("SELECT value FROM props WHERE name = 'version'").fetchone()
+            if version != SESSION_INDEX_VERSION:
+                raise sqlite3.DatabaseError("Unexpected session index version: %s" % version)
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def get_indexed_revs(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT rev FROM sessions ORDER BY rev")]
+
+    def get_stamps(self):
+        """Returns a dict mapping every indexed revision to the stamp
+        of its entry."""
+        with self.lock:
+            return dict(self.conn.execute("SELECT rev, stamp FROM sessions"))
+
+    def update(self, entries, removed_revs = ()):
+        """Inserts or replaces the given entries, and removes any
+        entries for the given removed revisions, in a single
+        transaction. Each entry is a tuple (rev, name, base, deleted,
+        fingerprint, stamp)."""
+        with self.lock:
+            with self.conn:
+                for rev in removed_revs:
+                    self.conn.execute("DELETE FROM sessions WHERE rev = ?", (rev,))
+                for rev, name, base, deleted, fingerprint, stamp in entries:
+                    assert isinstance(rev, int) and rev > 0
+                    assert base == None or isinstance(base, int)
+                    assert is_md5sum(fingerprint)
+                    self.conn.execute("REPLACE INTO sessions (rev, name, base, deleted, fingerprint, stamp) VALUES (?, ?, ?, ?, ?, ?)",
+                                      (rev, name, base, int(bool(deleted)), fingerprint, stamp))
+
+    def find_last_revision(self, session_name):
+        with self.lock:
+            row = self.conn.execute("SELECT MAX(rev) FROM sessions WHERE name = ?", (session_name,)).fetchone()
+        return row[0]
+
+    def get_revisions(self, session_name):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT rev FROM sessions WHERE name = ? ORDER BY rev", (session_name,))]
+
+    def get_session_names(self):
+        """Returns a list of all distinct session names, including
+        meta sessions and the name of deleted snapshots, in the order
+        of their first appearance. A session without a name is
+        represented by None."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT name FROM sessions GROUP BY name ORDER BY MIN(rev)")]
+
+    def get_referring_revisions(self, base):
+        """Returns all revisions that has the given revision as base
+        snapshot."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT rev FROM sessions WHERE base = ? ORDER BY rev", (base,))]
+
+    def get_deleted_revisions(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT rev FROM sessions WHERE deleted = 1 ORDER BY rev")]
+
+    def get_entry(self, rev):
+        """Returns the tuple (rev, name, base, deleted, fingerprint) for
+        the given revision, or None if the revision is not indexed."""
+        with self.lock:
+            row = self.conn.execute("SELECT rev, name, base, deleted, fingerprint FROM sessions WHERE rev = ?", (rev,)).fetchone()
+        if row == None:
+            return None
+        rev, name, base, deleted, fingerprint = row
+        return rev, name, base, bool(deleted), fingerprint
+
+def get_session_stamp(session_path):
+    """Returns the stamp of the snapshot at the given path, or None if
+    it has no session.json (for instance while it is being
+    erased). The stamp must be taken before the snapshot is read, so
+    that a concurrent rewrite always gives a newer stamp."""
+    try:
+        return os.stat(os.path.join(session_path, "session.json")).st_mtime_ns
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def session_index_entry(rev, session_reader, stamp):
+    """Returns the index entry for the given snapshot."""
+    return (rev, session_reader.get_client_value("name"), session_reader.get_base_id(),
+            session_reader.is_deleted(), session_reader.get_fingerprint(), stamp)
@@ -22,12 +22,19 @@ import sys
 import copy
 
 from . import repository
+from . import bloblistcache
 from boar_exceptions import *
 
 import shutil
 import hashlib
+import time
 import types
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from common import *
 from boar_common import *
 
@@ -400,6 +407,133 @@ class PieceHandler(deduplication.OriginalPieceHandler):
             remaining -= segment_size
         return segments
 
+class PartialUpload(object):
+    """The data received so far for a large blob that is stored
+    verbatim (see Repo.stores_blob_verbatim()). The data is kept in
+    the partial uploads directory of the repository until the blob is
+    finished, so that an upload that is interrupted, for instance by a
+    dropped connection, can be resumed by a later session. The file is
+    locked while in use, so that concurrent uploads of the same blob
+    do not interfere.
+
+    The data already present is only used if the client claims it by
+    asking for the offset to continue from (see claim()). Otherwise it
+    is thrown away when the first new data arrives.
+
+    Without fcntl, the constructor always raises Busy, and the blob is
+    received like any other verbatim blob."""
+
+    class Busy(Exception):
+        pass
+
+    def __init__(self, path, blob_md5, blob_size):
+        assert is_md5sum(blob_md5)
+        assert blob_size >= 0
+        if not fcntl:
+            raise PartialUpload.Busy("File locking is not available")
+        self.path = path
+        self.expected_md5 = blob_md5
+        self.expected_size = blob_size
+        self.f = open(path, "a+b")
+        try:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.f.close()
+            raise PartialUpload.Busy("Blob %s is being uploaded by someone else" % blob_md5)
+        if not os.path.exists(path) or not os.path.samestat(os.stat(path), os.fstat(self.f.fileno())):
+            # Expired while we were waiting for the lock
+            self.f.close()
+            raise PartialUpload.Busy("Partial upload of blob %s was removed" % blob_md5)
+        self.f.seek(0, os.SEEK_END)
+        self.prefix_size = self.f.tell()
+        if self.prefix_size > blob_size:
+            self.__truncate()
+        self.claimed = False
+        self.md5summer = hashlib.md5()
+        self.written_bytes = 0
+
+    def __truncate(self):
+        self.f.truncate(0)
+        self.prefix_size = 0
+
+    def claim(self):
+        """Returns the number of bytes already received. The client
+        must continue the upload from this offset."""
+        assert not self.claimed
+        self.claimed = True
+        for data in self.iter_prefix():
+            self.md5summer.update(data)
+        self.written_bytes = self.prefix_size
+        return self.prefix_size
+
+    def iter_prefix(self):
+        """Yields the data that was received before this upload was
+        started."""
+        self.f.seek(0)
+        remaining = self.prefix_size
+        while remaining > 0:
+            data = self.f.read(min(remaining, repository.VERIFY_BLOCK_SIZE))
+            if not data:
+                raise CorruptionError("Partial upload %s was truncated" % self.path)
+            remaining -= len(data)
+            yield data
+
+    def write(self, data):
+        if not self.claimed:
+            self.__truncate()
+            self.claimed = True
+        if self.written_bytes + len(data) > self.expected_size:
+            self.discard()
+            raise SizeViolation("Violation of file contract (too big) detected: %s" % self.expected_md5)
+        self.f.write(data)
+        self.md5summer.update(data)
+        self.written_bytes += len(data)
+
+    def close(self):
+        """Verifies that the complete blob has been received. The data
+        stays in place, and locked, until release() or discard() is
+        called."""
+        if self.written_bytes != self.expected_size:
+            self.discard()
+            raise SizeViolation("Violation of file contract (too small) detected: %s" % self.expected_md5)
+        if self.md5summer.hexdigest() != self.expected_md5:
+            self.discard()
+            raise ContentViolation("Violation of file contract (checksum) detected: %s" % self.expected_md5)
+        self.f.flush()
+
+    def release(self):
+        """Unlocks the data, leaving it for a later upload to resume."""
+        if self.f.closed:
+            return
+        self.f.flush()
+        if os.fstat(self.f.fileno()).st_size == 0:
+            # Nothing worth resuming
+            safe_delete_file(self.path)
+        self.f.close()
+
+    def discard(self):
+        if not self.f.closed:
+            safe_delete_file(self.path)
+            self.f.close()
+
+def expire_partial_uploads(partial_dir, max_age):
+    """Removes the partial uploads in the given directory that have
+    not been written to for max_age seconds. Uploads that are in use
+    are left alone."""
+    if not fcntl or not os.path.exists(partial_dir):
+        return
+    now = time.time()
+    for fn in os.listdir(partial_dir):
+        path = os.path.join(partial_dir, fn)
+        try:
+            if now - os.path.getmtime(path) < max_age:
+                continue
+            with open(path, "rb") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                safe_delete_file(path)
+        except OSError:
+            pass # In use, or already removed
+
 class SessionWriter(object):
     def __init__(self, repo, session_name, base_session = None, session_id = None, force_base_snapshot = False):
         assert session_name and isinstance(session_name, str)
@@ -415,16 +549,26 @@ class SessionWriter(object):
         self.base_session = base_session
         self.force_base_snapshot = force_base_snapshot
         self.metadatas = {}
-        self.found_uncommitted_blocks = []
+        # The blocks found in the new blobs are streamed to a block
+        # list in the session dir, which is opened on demand.
+        self.block_list = None
+        self.chunk_list = None
+        self.dedup_mode = repo.get_deduplication_mode()
         self.blob_deduplicator = {}
         # Blobs that are stored verbatim as a single raw file (no
         # deduplication or splitting) take a fast path that streams straight
         # to disk, bypassing the deduplication state machine. See
         # init_new_blob() and Repo.stores_blob_verbatim().
         self.raw_blob_writers = {}
+        # Large blobs being received, see PartialUpload.
+        self.partial_uploads = {}
+        # Raw blobs (md5 -> size) whose checksums were verified while
+        # the data was received. They are listed in the
+        # transaction manifest so that they need not be read again
+        # when the commit is processed.
+        self.verified_blobs = {}
 
-        all_rolling = self.repo.blocksdb.get_all_rolling()
-        self.rolling_set = deduplication.CreateIntegerSet(all_rolling)
+        self.rolling_set = self.repo.blocksdb.get_rolling_set()
 
         self.session_mutex = FileMutex(os.path.join(self.repo.repopath, repository.TMP_DIR), self.session_name)
         self.session_mutex.lock()
@@ -435,6 +579,8 @@ class SessionWriter(object):
             prefix = "tmp_",
             dir = os.path.join(self.repo.repopath, repository.TMP_DIR))
         os.chmod(self.session_path, currentmask ^ 0o777)
+        expire_partial_uploads(self.repo.get_path(repository.PARTIAL_UPLOADS_DIR),
+                               repository.PARTIAL_UPLOAD_MAX_AGE)
         if self.force_base_snapshot:
             self.writer = _NaiveSessionWriter(session_name, None, self.session_path)
         else:
@@ -457,8 +603,21 @@ class SessionWriter(object):
 
     def cancel(self):
         self.dead = True
+        self.__release_partial_uploads()
+        self.__close_block_list()
         self.session_mutex.release()
 
+    def __close_block_list(self):
+        if self.block_list:
+            self.block_list.close()
+        if self.chunk_list:
+            self.chunk_list.close()
+
+    def __release_partial_uploads(self):
+        for partial in self.partial_uploads.values():
+            partial.release()
+        self.partial_uploads.clear()
+
     def deleted_snapshot(self, deleted_name, deleted_fingerprint):
         self.writer.delete(deleted_name, deleted_fingerprint)
 
@@ -473,11 +632,24 @@ class SessionWriter(object):
         # here. Possibly some other session is uploading, or has
         # uploaded this blob, before we get here. But that is ok.
         assert not self.dead
+        assert blob_md5 not in self.partial_uploads
         if self.repo.stores_blob_verbatim(blob_size):
             # Fast path: store the blob verbatim, bypassing the deduplication
             # machinery. Write to a temp file first; blob_finished() puts it in
             # place (or drops it if an identical blob arrived earlier). The
-            # StrictFileWriter enforces the promised size and checksum.
+            # StrictFileWriter enforces the promised size and checksum. A
+            # large blob is written to a partial upload file instead,
+            # which works the same way. Blobs that are deduplicated or
+            # split are not resumable, as their data is not kept in a
+            # single file.
+            if blob_size >= repository.RESUMABLE_UPLOAD_MIN_SIZE:
+                try:
+                    partial = PartialUpload(self.repo.get_partial_upload_path(blob_md5), blob_md5, blob_size)
+                    self.partial_uploads[blob_md5] = partial
+                    self.raw_blob_writers[blob_md5] = (partial, partial.path)
+                    return
+                except PartialUpload.Busy:
+                    pass # Not resumable, but otherwise fine
             tmppath = tempfile.mktemp(prefix = "rawblob_", dir = self.session_path)
             self.raw_blob_writers[blob_md5] = \
                 (StrictFileWriter(tmppath, blob_md5, blob_size), tmppath)
@@ -490,6 +662,16 @@ class SessionWriter(object):
             rollingchecksumclass = deduplication.FakeRollingChecksum
             blockifierclass = deduplication.FakeBlockChecksum
 
+        if self.dedup_mode == repository.DEDUP_MODE_CHUNKS:
+            self.blob_deduplicator[blob_md5] = \
+                deduplication.ChunkRecipeFinder(self.tmpblocksdb,
+                                                repository.DEDUP_CHUNK_SIZES,
+                                                PieceHandler(self.session_path, repository.DEDUP_BLOCK_SIZE,
+                                                             tmpdir = self.repo.get_tmpdir(),
+                                                             BlockifierClass = deduplication.FakeBlockChecksum,
+                                                             max_blob_size = self.max_blob_size))
+            return
+
         fname = os.path.join(self.session_path, blob_md5)
         blobsource = deduplication.UniformBlobGetter(self.repo, self.session_path)
         self.blob_deduplicator[blob_md5] = \
@@ -505,6 +687,33 @@ class SessionWriter(object):
                                        RollingChecksumClass = rollingchecksumclass)
 
 
+    def get_partial_offset(self, blob_md5):
+        """Returns the number of bytes of the given new blob that were
+        received by an earlier, interrupted, upload. The caller must
+        continue by adding the data that follows that offset. Must be
+        called after init_new_blob() and before any data is added."""
+        assert not self.dead
+        partial = self.partial_uploads.get(blob_md5)
+        if not partial:
+            return 0
+        return partial.claim()
+
+    def get_received_md5summer(self, blob_md5):
+        """Returns a md5 object that has been fed with the data that
+        get_partial_offset() reported as already received."""
+        partial = self.partial_uploads.get(blob_md5)
+        if partial and partial.claimed:
+            return partial.md5summer.copy()
+        return hashlib.md5()
+
+    def discard_partial_upload(self, blob_md5):
+        """Throws away the data received so far for the given blob, so
+        that it will not be resumed by a later upload. Used when the
+        data is known to be bad."""
+        partial = self.partial_uploads.pop(blob_md5, None)
+        if partial:
+            partial.discard()
+
     def add_blob_data(self, blob_md5, fragment):
         """ Adds the given fragment to the end of the new blob with the given checksum."""
         assert is_md5sum(blob_md5)
@@ -518,6 +727,7 @@ class SessionWriter(object):
     def __blob_finished_raw(self, blob_md5):
         writer, tmppath = self.raw_blob_writers[blob_md5]
         writer.close() # Verifies the promised size and checksum.
+        self.verified_blobs[blob_md5] = writer.expected_size
         real_name = os.path.join(self.session_path, blob_md5)
         # An identical blob may already have been written during this
         # commit. If so, just drop our copy.
@@ -526,6 +736,9 @@ class SessionWriter(object):
         else:
             os.rename(tmppath, real_name)
         del self.raw_blob_writers[blob_md5]
+        if blob_md5 in self.partial_uploads:
+            # The data has been moved, just unlock it
+            self.partial_uploads.pop(blob_md5).release()
 
     def blob_finished(self, blob_md5):
         if blob_md5 in self.raw_blob_writers:
@@ -533,11 +746,26 @@ class SessionWriter(object):
             return
         sw = StopWatch(enabled=False, name="session.blob_finished")
         self.blob_deduplicator[blob_md5].close()
+        for sub_blob_md5, sub_blob_size in self.blob_deduplicator[blob_md5].original_piece_handler.sub_blobs:
+            # Written and checksummed by the piece handler
+            self.verified_blobs[sub_blob_md5] = sub_blob_size
         for block in self.blob_deduplicator[blob_md5].original_piece_handler.blocks:
             # Let the recipe finder know about these blocks
             self.rolling_set.add(block[2])
             self.tmpblocksdb.add_tmp_block(md5 = block[3], blob = block[0], offset = block[1])
-            self.found_uncommitted_blocks.append(block)
+            if not self.block_list:
+                self.block_list = deduplication.BlockListWriter(
+                    os.path.join(self.session_path, repository.BLOCK_LIST_FILE))
+            self.block_list.add_block(*block)
+        if self.dedup_mode == repository.DEDUP_MODE_CHUNKS:
+            for chunk in self.blob_deduplicator[blob_md5].get_new_chunks():
+                blob, offset, size, md5 = chunk
+                self.tmpblocksdb.add_tmp_chunk(md5 = md5, blob = blob, offset = offset, size = size)
+                if not self.chunk_list:
+                    self.chunk_list = deduplication.BlockListWriter(
+                        os.path.join(self.session_path, repository.CHUNK_LIST_FILE),
+                        magic = deduplication.CHUNK_LIST_MAGIC)
+                self.chunk_list.add_block(*chunk)
 
         sw.mark(1)
         recipe = self.blob_deduplicator[blob_md5].get_recipe()
@@ -588,6 +816,8 @@ class SessionWriter(object):
         dest = os.path.join(self.session_path, blob_md5)
         assert os.path.exists(dest), "reflink_replace_blob: blob is not present as a raw blob"
         tmp = tempfile.mktemp(prefix="reflink_", dir=self.session_path)
+        # The data is no longer the data we verified on arrival
+        self.verified_blobs.pop(blob_md5, None)
         reflink_file(source_path, tmp)
         try:
             os.replace(tmp, dest)
@@ -645,6 +875,7 @@ class SessionWriter(object):
         try:
             return self.__commit(sessioninfo, progress_callback=progress_callback)
         finally:
+            self.__release_partial_uploads()
             self.session_mutex.release()
 
     def __commit(self, sessioninfo, progress_callback = lambda x: None):
@@ -682,8 +913,12 @@ class SessionWriter(object):
                 self.writer.add_blobinfo(blobitem)
         self.writer.commit()
 
-        blocks_fname = os.path.join(self.session_path, "blocks.json")
-        write_json(blocks_fname, self.found_uncommitted_blocks)
+        self.__close_block_list()
+
+        manifest = {"blobs": self.verified_blobs}
+        payload = str2bytes(get_json_module().dumps(manifest, sort_keys = True))
+        write_json(os.path.join(self.session_path, repository.MANIFEST_FILE),
+                   {"manifest": manifest, "signature": self.repo.sign_transaction_data(payload)})
 
         # This is a fail-safe to reduce the risk of lockfile problems going undetected.
         # It is not meant to be 100% safe. That responsibility lies with the lockfile.
@@ -693,6 +928,8 @@ class SessionWriter(object):
         return session_id
 
     def __del__(self):
+        if hasattr(self, "partial_uploads"):
+            self.__release_partial_uploads()
         if self.session_mutex.is_locked():
             self.session_mutex.release()
 
@@ -708,6 +945,12 @@ class SessionReader(object):
         self.path = session_path
         self.dirname = os.path.basename(self.path)
         self.repo = repo
+        # The revision is only known for snapshots that are part of
+        # the repository (not queued or deleted ones)
+        self.rev = None
+        if repo and re.match("^[0-9]+$", self.dirname) and \
+                repo.get_session_path(int(self.dirname)) == self.path:
+            self.rev = int(self.dirname)
         assert os.path.exists(self.path), "No such session path:" + self.path
         self.raw_bloblist = None
         path = os.path.join(self.path, "session.json")
@@ -789,15 +1032,23 @@ class SessionReader(object):
                 raise CorruptionError("Bloblist for snapshot %s is mangled" % self.dirname)
 
     def get_all_blob_infos(self):
-        # Diffucult to optimize this one. Caching the full blob list
-        # is not necessarily faster. Caching the raw bloblists and
-        # reconstructing the full bloblist as needed, seems to be the
-        # way to go until we can cache the bloblist in binary form
-        # somewhere.
+        # The full bloblist is reconstructed by applying the raw
+        # bloblists of the snapshot chain, starting from the base
+        # snapshot or from the nearest snapshot that has a
+        # materialized bloblist in the cache, whichever comes first.
         self.quick_quick_verify()
+        cache = None
+        if self.repo and self.rev:
+            cache = self.repo.bloblist_cache
         session_obj = self
-        all_session_objs = [self]
+        all_session_objs = []
+        cached = None
         while True:
+            if cache and session_obj.rev:
+                cached = cache.load(session_obj.rev, session_obj.get_fingerprint())
+                if cached:
+                    break
+            all_session_objs.insert(0, session_obj)
             base_session_id = session_obj.properties.get("base_session", None)
             if base_session_id == None:
                 break
@@ -806,18 +1057,27 @@ class SessionReader(object):
             except MisuseError:
                 # Missing session here means repo corruption
                 raise CorruptionError("Required base snapshot %s is missing" % base_session_id)
-            all_session_objs.insert(0, session_obj)
-        self.load_stats = { "add_count": 0, "remove_count": 0, "total_count": 0 }
-        bloblist = {}
+        # The stats are collected in a local variable, since the same
+        # reader may be used by several threads at once.
+        if cached:
+            cached_bloblist, load_stats = cached
+            bloblist = bloblist_to_dict(cached_bloblist)
+        else:
+            load_stats = { "add_count": 0, "remove_count": 0, "total_count": 0 }
+            bloblist = {}
         for session_obj in all_session_objs:
             rawbloblist = session_obj.get_raw_bloblist()
             for blobinfo in rawbloblist:
                 if blobinfo.get("action", None) == "remove":
-                    self.load_stats['remove_count'] += 1
+                    load_stats['remove_count'] += 1
                 else:
-                    self.load_stats['add_count'] += 1
+                    load_stats['add_count'] += 1
             apply_delta(bloblist, rawbloblist)
-        self.load_stats['total_count'] = len(bloblist)
-        return list(bloblist.values())
+        load_stats['total_count'] = len(bloblist)
+        self.load_stats = load_stats
+        result = list(bloblist.values())
+        if cache and len(all_session_objs) >= bloblistcache.MIN_CHAIN_LENGTH:
+            cache.save(self.rev, self.get_fingerprint(), result, load_stats)
+        return result
 
 
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, tempfile, shutil, random
+
+TMPDIR=tempfile.gettempdir()
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from blobrepo import blobreader
+from boar_exceptions import CorruptionError
+
+class FakeRepo(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_blob_path(self, blob):
+        return os.path.join(self.path, blob)
+
+class TestRecipeReader(unittest.TestCase):
+    def setUp(self):
+        self.blobdir = tempfile.mkdtemp(prefix="boar_test_blobreader_", dir=TMPDIR)
+        self.repo = FakeRepo(self.blobdir)
+        self.blobs = {}
+        rnd = random.Random(0)
+        for n in range(blobreader.MAX_OPEN_BLOBS * 2):
+            data = bytes([rnd.randrange(256) for i in range(rnd.randint(1, 500))])
+            self.add_blob("%032x" % n, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.blobdir, ignore_errors = True)
+
+    def add_blob(self, name, data):
+        with open(os.path.join(self.blobdir, name), "wb") as f:
+            f.write(data)
+        self.blobs[name] = data
+
+    def make_recipe(self, pieces):
+        size = 0
+        for piece in pieces:
+            size += piece['size'] * piece.get('repeat', 1)
+        return {"md5sum": "00000000000000000000000000000000",
+                "method": "concat",
+                "size": size,
+                "pieces": pieces}
+
+    def expected_data(self, pieces):
+        result = b""
+        for piece in pieces:
+            data = self.blobs[piece['source']][piece['offset']:piece['offset'] + piece['size']]
+            result += data * piece.get('repeat', 1)
+        return result
+
+    def test_repeat(self):
+        blob = "%032x" % 0
+        pieces = [{"source": blob, "offset": 0, "size": 1},
+                  {"source": blob, "offset": 0, "size": 0, "repeat": 3},
+                  {"source": blob, "offset": 0, "size": 1, "repeat": 1000000}]
+        reader = blobreader.RecipeReader(self.make_recipe(pieces), self.repo, offset = 999990, size = 10)
+        self.assertEqual(reader.read(), self.blobs[blob][0:1] * 10)
+        self.assertEqual(reader.bytes_left(), 0)
+        self.assertEqual(reader.read(), b"")
+
+    def test_random_recipes(self):
+        rnd = random.Random(1)
+        for trial in range(100):
+            pieces = []
+            for n in range(rnd.randint(1, 40)):
+                blob = rnd.choice(sorted(self.blobs.keys()))
+                offset = rnd.randint(0, len(self.blobs[blob]))
+                piece = {"source": blob, "offset": offset,
+                         "size": rnd.randint(0, len(self.blobs[blob]) - offset)}
+                repeat = rnd.choice([1, 1, 0, 2, 7])
+                if repeat != 1:
+                    piece['repeat'] = repeat
+                pieces.append(piece)
+            expected = self.expected_data(pieces)
+            offset = rnd.randint(0, len(expected))
+            size = rnd.randint(0, len(expected) - offset)
+            reader = blobreader.RecipeReader(self.make_recipe(pieces), self.repo, offset = offset, size = size)
+            result = b""
+            while reader.bytes_left():
+                result += reader.read(rnd.randint(1, 1000))
+            self.assertEqual(result, expected[offset:offset+size])
+            self.assertTrue(len(reader.file_handles) <= blobreader.MAX_OPEN_BLOBS)
+            reader.close()
+
+    def test_readinto(self):
+        blob = "%032x" % 0
+        pieces = [{"source": blob, "offset": 0, "size": len(self.blobs[blob]), "repeat": 3}]
+        reader = blobreader.RecipeReader(self.make_recipe(pieces), self.repo)
+        buf = bytearray(len(self.blobs[blob]) * 4)
+        self.assertEqual(reader.readinto(buf), len(self.blobs[blob]) * 3)
+        self.assertEqual(bytes(buf[:len(self.blobs[blob]) * 3]), self.blobs[blob] * 3)
+
+    def test_read_at(self):
+        blob = "%032x" % 0
+        pieces = [{"source": blob, "offset": 0, "size": len(self.blobs[blob]), "repeat": 3}]
+        expected = self.expected_data(pieces)
+        reader = blobreader.RecipeReader(self.make_recipe(pieces), self.repo)
+        self.assertEqual(reader.read_at(5, 10), expected[5:15])
+        self.assertEqual(reader.read_at(len(expected) - 3, 10), expected[-3:])
+        self.assertEqual(reader.read_at(len(expected) + 1, 10), b"")
+        self.assertEqual(reader.read(), expected)
+
+    def test_inconsistent_recipe(self):
+        blob = "%032x" % 0
+        recipe = self.make_recipe([{"source": blob, "offset": 0, "size": 1, "repeat": 2}])
+        recipe['size'] = 3
+        self.assertRaises(CorruptionError, blobreader.RecipeReader, recipe, self.repo)
+
+    def test_truncated_blob(self):
+        blob = "%032x" % 0
+        recipe = self.make_recipe([{"source": blob, "offset": 0, "size": len(self.blobs[blob])}])
+        self.add_blob(blob, b"")
+        reader = blobreader.RecipeReader(recipe, self.repo)
+        self.assertRaises(CorruptionError, reader.read)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,7 +33,9 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 from blobrepo import repository
-from common import tounicode
+from blobrepo import sessions
+from blobrepo import bloblistcache
+from common import tounicode, write_json, get_json_module
 
 class TestBlobRepo(unittest.TestCase):
     def setUp(self):
@@ -198,5 +200,220 @@ class TestBlobRepo(unittest.TestCase):
             pass
         self.assertEqual(self.repo.get_orphan_blobs(), set(["551d8cd98f00b204e9800998ecf8427e"]))
 
+    def test_find_last_revision(self):
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        id2 = self.repo.create_snapshot(u"OtherSession").commit({"name": u"OtherSession"})
+        id3 = self.repo.create_snapshot(SESSION_NAME, base_session = id1).commit({"name": SESSION_NAME})
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id3)
+        self.assertEqual(self.repo.find_last_revision(u"OtherSession"), id2)
+        self.assertEqual(self.repo.find_last_revision(u"NoSuchSession"), None)
+        self.assertEqual(self.repo.get_session_ids(SESSION_NAME), [id1, id3])
+        self.assertEqual(self.repo.get_session_names(), [SESSION_NAME, u"OtherSession"])
+        self.assertEqual(self.repo.get_referring_snapshots(id1), [id3])
+
+    def test_session_index_is_rebuilt(self):
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit()
+        self.repo.close()
+        os.remove(os.path.join(self.repopath, repository.DERIVED_SESSIONS_DB))
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.find_last_revision(SESSION_NAME), id1)
+        # Snapshots unknown to the index (for instance created by an
+        # older boar version) must be picked up as well
+        id2 = self.repo.create_snapshot(SESSION_NAME).commit()
+        self.assertEqual(repo.find_last_revision(SESSION_NAME), id2)
+
+    def test_session_index_after_erase(self):
+        with open(os.path.join(self.repopath, "ENABLE_PERMANENT_ERASE"), "w"):
+            pass
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        id2 = self.repo.create_snapshot(u"OtherSession").commit({"name": u"OtherSession"})
+        self.assertEqual(self.repo.get_deleted_snapshots(), [])
+        with self.repo:
+            self.repo._erase_snapshots([id1])
+        self.assertEqual(self.repo.get_deleted_snapshots(), [id1])
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), None)
+        self.assertEqual(self.repo.find_last_revision(u"OtherSession"), id2)
+
+    def test_session_index_after_unindexed_erase(self):
+        with open(os.path.join(self.repopath, "ENABLE_PERMANENT_ERASE"), "w"):
+            pass
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id1)
+        index_path = os.path.join(self.repopath, repository.DERIVED_SESSIONS_DB)
+        shutil.copy(index_path, index_path + ".old")
+        with self.repo:
+            self.repo._erase_snapshots([id1])
+        self.repo.close()
+        # Simulate an erase by a boar version that does not know about
+        # the index, which leaves the entry of the erased snapshot as
+        # it was.
+        os.replace(index_path + ".old", index_path)
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.find_last_revision(SESSION_NAME), None)
+        self.assertEqual(repo.get_deleted_snapshots(), [id1])
+
+    def test_chunks_repo_format(self):
+        # A repository in the chunks deduplication mode is marked with a
+        # format version that older boar versions refuse.
+        self.repo.close()
+        with open(os.path.join(self.repopath, repository.VERSION_FILE), "w") as f:
+            f.write(str(repository.CHUNKS_REPO_FORMAT))
+        with open(os.path.join(self.repopath, repository.DEDUPLICATION_FILE), "w") as f:
+            f.write(repository.DEDUP_MODE_CHUNKS)
+        self.assertTrue(repository.CHUNKS_REPO_FORMAT > repository.LATEST_REPO_FORMAT)
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.get_deduplication_mode(), repository.DEDUP_MODE_CHUNKS)
+        with open(os.path.join(self.repopath, repository.VERSION_FILE), "w") as f:
+            f.write(str(repository.CHUNKS_REPO_FORMAT + 1))
+        self.assertRaises(repository.UserError, repository.Repo, self.repopath)
+
+    def test_bloblist_cache(self):
+        rev = None
+        for n in range(4):
+            writer = self.repo.create_snapshot(SESSION_NAME, base_session = rev)
+            if n == 0:
+                writer.init_new_blob(DATA1_MD5, len(DATA1))
+                writer.add_blob_data(DATA1_MD5, DATA1)
+                writer.blob_finished(DATA1_MD5)
+            else:
+                writer.remove("file%s.txt" % (n - 1))
+            writer.add({"filename": "file%s.txt" % n, "md5sum": DATA1_MD5})
+            rev = writer.commit({"name": SESSION_NAME})
+        expected = [{"filename": "file3.txt", "md5sum": DATA1_MD5}]
+        # The writer of the last snapshot loaded the full bloblist of
+        # its base snapshot, which was then deep enough to be cached.
+        self.assertTrue(self.repo.bloblist_cache.has(rev - 1))
+        self.assertFalse(self.repo.bloblist_cache.has(rev - 2))
+        self.assertFalse(self.repo.bloblist_cache.has(rev))
+        reader = self.repo.get_session(rev)
+        self.assertEqual(reader.get_all_blob_infos(), expected)
+        expected_stats = reader.load_stats
+        self.assertEqual(expected_stats, {"add_count": 4, "remove_count": 3, "total_count": 1})
+
+        # The materialized bloblist must give the same result
+        repo = repository.Repo(self.repopath)
+        reader = repo.get_session(rev)
+        self.assertEqual(reader.get_all_blob_infos(), expected)
+        self.assertEqual(reader.load_stats, expected_stats)
+
+        # A corrupt cache entry must be ignored
+        cache_file = os.path.join(self.repopath, repository.DERIVED_BLOBLISTS_DIR, "%s.bloblist" % (rev - 1))
+        with open(cache_file, "ab") as f:
+            f.write(b"garbage")
+        repo = repository.Repo(self.repopath)
+        reader = repo.get_session(rev)
+        self.assertEqual(reader.get_all_blob_infos(), expected)
+        self.assertEqual(reader.load_stats, expected_stats)
+
+    def test_bloblist_cache_alternating(self):
+        rev = None
+        revs = []
+        for n in range(10):
+            writer = self.repo.create_snapshot(SESSION_NAME, base_session = rev)
+            if n == 0:
+                writer.init_new_blob(DATA1_MD5, len(DATA1))
+                writer.add_blob_data(DATA1_MD5, DATA1)
+                writer.blob_finished(DATA1_MD5)
+            writer.add({"filename": "file%s.txt" % n, "md5sum": DATA1_MD5})
+            rev = writer.commit({"name": SESSION_NAME})
+            revs.append(rev)
+        cache_dir = os.path.join(self.repopath, repository.DERIVED_BLOBLISTS_DIR)
+        shutil.rmtree(cache_dir, ignore_errors = True)
+        # Building an entry from the entry of an earlier revision must
+        # not evict the earlier one, or switching between the two
+        # revisions would rebuild them over and over.
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(len(repo.get_session(revs[5]).get_all_blob_infos()), 6)
+        self.assertTrue(repo.bloblist_cache.has(revs[5]))
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(len(repo.get_session(revs[9]).get_all_blob_infos()), 10)
+        self.assertTrue(repo.bloblist_cache.has(revs[9]))
+        self.assertTrue(repo.bloblist_cache.has(revs[5]))
+        # The least recently used entries are removed when the cache is full
+        saved = bloblistcache.MAX_ENTRIES
+        bloblistcache.MAX_ENTRIES = 2
+        try:
+            os.utime(os.path.join(cache_dir, "%s.bloblist" % revs[5]), ns = (0, 0))
+            repo = repository.Repo(self.repopath)
+            repo.get_session(revs[9]).get_all_blob_infos()
+            repo.get_session(revs[2]).get_all_blob_infos()
+            self.assertTrue(repo.bloblist_cache.has(revs[2]))
+            self.assertTrue(repo.bloblist_cache.has(revs[9]))
+            self.assertFalse(repo.bloblist_cache.has(revs[5]))
+        finally:
+            bloblistcache.MAX_ENTRIES = saved
+
+    def _create_transaction_dir(self, signing_repo):
+        """Creates a transaction dir containing a corrupted blob that
+        is listed as verified in a manifest signed by the given repo."""
+        path = tempfile.mkdtemp(dir = self.repo.get_tmpdir())
+        writer = sessions._NaiveSessionWriter(session_name = SESSION_NAME, base_session = None, path = path)
+        writer.set_fingerprint("d41d8cd98f00b204e9800998ecf8427e")
+        writer.commit()
+        with open(os.path.join(path, DATA1_MD5), "wb") as f:
+            f.write(b"x" * len(DATA1))
+        manifest = {"blobs": {DATA1_MD5: len(DATA1)}}
+        payload = get_json_module().dumps(manifest, sort_keys = True).encode("utf-8")
+        write_json(os.path.join(path, repository.MANIFEST_FILE),
+                   {"manifest": manifest, "signature": signing_repo.sign_transaction_data(payload)})
+        return path
+
+    def test_transaction_manifest(self):
+        path = self._create_transaction_dir(self.repo)
+        # The blob is trusted, and will not be read
+        repository.Transaction(self.repo, path).verify_blobs()
+        # Unless we are paranoid
+        self.assertRaises(AssertionError, repository.Transaction(self.repo, path, paranoid = True).verify_blobs)
+
+    def test_transaction_manifest_recipes_are_verified(self):
+        path = self._create_transaction_dir(self.repo)
+        with open(os.path.join(path, DATA1_MD5), "wb") as f:
+            f.write(DATA1)
+        # A recipe that claims to be DATA2, but refers to DATA1. Even
+        # if listed in a (legacy) signed manifest, it must be read.
+        write_json(os.path.join(path, DATA2_MD5 + ".recipe"),
+                   {"method": "concat", "md5sum": DATA2_MD5, "size": len(DATA1),
+                    "pieces": [{"source": DATA1_MD5, "offset": 0, "size": len(DATA1)}]})
+        manifest = {"blobs": {DATA1_MD5: len(DATA1)}, "recipes": {DATA2_MD5: len(DATA1)}}
+        payload = get_json_module().dumps(manifest, sort_keys = True).encode("utf-8")
+        os.remove(os.path.join(path, repository.MANIFEST_FILE))
+        write_json(os.path.join(path, repository.MANIFEST_FILE),
+                   {"manifest": manifest, "signature": self.repo.sign_transaction_data(payload)})
+        self.assertRaises(AssertionError, repository.Transaction(self.repo, path).verify_recipes)
+
+    def test_transaction_manifest_wrong_signature(self):
+        other_repo = repository.Repo(self.repopath)
+        path = self._create_transaction_dir(other_repo)
+        self.assertRaises(AssertionError, repository.Transaction(self.repo, path).verify_blobs)
+
+    def test_session_index_sync_is_skipped(self):
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        sessions_dir = os.path.join(self.repopath, repository.SESSIONS_DIR)
+        os.utime(sessions_dir, (1000000000, 1000000000))
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id1)
+        listings = []
+        def get_all_sessions():
+            listings.append(1)
+            return repository.get_all_ids_in_directory(sessions_dir)
+        self.repo.get_all_sessions = get_all_sessions
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id1)
+        self.assertEqual(listings, [])
+        os.utime(sessions_dir, (1000000010, 1000000010))
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id1)
+        self.assertEqual(listings, [1])
+
+    def test_readonly_find_last_revision_is_lazy(self):
+        id1 = self.repo.create_snapshot(SESSION_NAME).commit({"name": SESSION_NAME})
+        id2 = self.repo.create_snapshot(u"OtherSession").commit({"name": u"OtherSession"})
+        self.repo.close()
+        with open(os.path.join(self.repopath, "READONLY"), "w"):
+            pass
+        repo = repository.Repo(self.repopath)
+        self.assertEqual(repo.find_last_revision(u"OtherSession"), id2)
+        self.assertEqual(repo.find_last_revision(SESSION_NAME), id1)
+        self.assertEqual(repo.find_last_revision(u"NoSuchSession"), None)
+        self.assertEqual(repo.session_index, None)
+        self.assertEqual(list(repo.session_readers.keys()), [id2, id1])
+
 if __name__ == '__main__':
     unittest.main()
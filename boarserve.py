@@ -20,6 +20,7 @@ import socketserver
 import front
 import sys
 import socket
+import functools
 
 from boar_exceptions import *
 from common import warn
@@ -35,12 +36,22 @@ class PipedBoarServer(object):
         self.handler = jsonrpc.RpcHandler()
         self.handler.register_function(ping, "ping")
         self.handler.register_function(self.initialize, "initialize")
+        self.handler.register_function(self.negotiate_compression, "negotiate_compression")
         self.server = jsonrpc.BoarMessageServer(from_client, to_client, self.handler)
 
     def initialize(self):
         self.repo = repository.Repo(self.repopath)
         fr = front.Front(self.repo)
         self.handler.register_instance(fr, "front")
+        return get_capabilities()
+
+    def negotiate_compression(self, spec):
+        """Compresses all messages after the reply to this call, using
+        the given compression spec. Returns the spec that will be
+        used."""
+        compression = jsonrpc.WireCompression(spec)
+        self.server.set_compression(compression)
+        return compression.get_spec()
 
     def serve(self):
         try:
@@ -52,6 +63,89 @@ class PipedBoarServer(object):
         if self.repo.repo_mutex.is_locked():
             self.repo.repo_mutex.release()
 
+# The front methods that never modify the repository. A client of a
+# threaded server is served by the shared repository instance for as
+# long as it only calls these. Methods that use the blocks database
+# are not included, since its connection can only be used by the
+# thread that opened it.
+READ_ONLY_METHODS = set([
+    "allows_permanent_erase", "get_session_ids", "get_session_names",
+    "get_deleted_snapshots", "get_dedup_block_size", "get_deleted_snapshot_info",
+    "get_session_ignore_list", "get_session_include_list", "get_session_info",
+    "get_base_id", "get_predecessor", "get_session_fingerprint",
+    "get_session_bloblist", "get_session_load_stats", "get_session_bloblist_stream",
+    "get_session_raw_bloblist", "get_bloblist_delta", "get_stats", "has_snapshot",
+    "get_highest_used_revision", "is_deleted", "get_blob_size", "get_blob",
+    "get_blobs", "has_blob", "has_blobs", "find_last_revision",
+    "repo_get_highest_used_revision", "get_repo_identifier",
+    "deduplication_enabled", "get_max_blob_size", "get_blob_split_size"])
+
+class SharedRepoBoarServer(PipedBoarServer):
+    """A server for a single client of a threaded server. Read-only
+    calls are served by a long-lived repository instance that is
+    shared by all clients, so that they do not have to pay for opening
+    the repository, and so that cached snapshot data is reused between
+    clients. As soon as the client calls a method that may modify the
+    repository, it is given a private repository instance that is used
+    for the rest of the connection, just like a client of the forking
+    server. The read-only methods of the repository may be called by
+    several threads at once, so the calls to the shared instance are
+    not serialized."""
+
+    def __init__(self, shared_repo, from_client, to_client):
+        self.shared_repo = shared_repo
+        self.repo = None
+        self.shared_front = None
+        self.private_front = None
+        PipedBoarServer.__init__(self, shared_repo.repopath, from_client, to_client)
+
+    def initialize(self):
+        self.shared_front = front.Front(self.shared_repo)
+        for name in dir(self.shared_front):
+            if name.startswith("_") or not callable(getattr(self.shared_front, name)):
+                continue
+            self.handler.register_function(self.__make_dispatcher(name), "front." + name)
+        return get_capabilities()
+
+    def __make_dispatcher(self, name):
+        # The wrapper keeps the signature of the front method, since
+        # the rpc handler inspects it for a progress_callback argument.
+        @functools.wraps(getattr(self.shared_front, name))
+        def dispatcher(*args, **kwargs):
+            return getattr(self.__get_front(name), name)(*args, **kwargs)
+        return dispatcher
+
+    def __get_front(self, method_name):
+        if self.private_front:
+            return self.private_front
+        if method_name in READ_ONLY_METHODS:
+            return self.shared_front
+        self.repo = repository.Repo(self.repopath)
+        self.private_front = front.Front(self.repo)
+        return self.private_front
+
+    def _cleanup(self):
+        if not self.repo:
+            return
+        if self.repo.repo_mutex.is_locked():
+            self.repo.repo_mutex.release()
+        self.repo.close()
+        # The client may have modified existing snapshots (for
+        # instance by erasing them), so the shared instance must not
+        # trust its cached session readers any more.
+        self.shared_repo.forget_session_reader()
+
+def get_capabilities():
+    """Returns the optional protocol features that this server
+    supports. Older servers return None from initialize(), so clients
+    must not use any of these features unless they are listed. The
+    "front" entry lists the front methods that a client may only call
+    if they are listed, see front.front_supports()."""
+    return {"compression": list(jsonrpc.COMPRESSION_METHODS),
+            "front": ["has_blobs", "get_session_bloblist_stream", "get_bloblist_delta",
+                      "get_partial_offset", "get_blobs", "add_blobs_streamed",
+                      "add_bloblist_entries"]}
+
 def init_stdio_server(repopath):
     """This creates a boar server that uses sys.stdin/sys.stdout to
     communicate with the client. The function also hides the real
@@ -67,15 +161,27 @@ if "fork" in dir(os):
     class ForkingTCPServer(socketserver.ForkingMixIn, socketserver.TCPServer):
         pass
 
-def run_socketserver(repopath, address, port):
-    repository.Repo(repopath) # Just check if the repo path is valid
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+def run_socketserver(repopath, address, port, threaded = False):
+    """Serves the repository to network clients. By default, every
+    client is served by a separate process. If threaded is True, the
+    clients are instead served by threads in this process, sharing a
+    single repository instance for read-only operations."""
+    repo = repository.Repo(repopath) # Also checks if the repo path is valid
     class BoarTCPHandler(socketserver.BaseRequestHandler):
         def handle(self):
             to_client = self.request.makefile(mode="wb")
             from_client = self.request.makefile(mode="rb")
-            PipedBoarServer(repopath, from_client, to_client).serve()
+            if threaded:
+                SharedRepoBoarServer(repo, from_client, to_client).serve()
+            else:
+                PipedBoarServer(repopath, from_client, to_client).serve()
 
-    if "fork" not in dir(os):
+    if threaded:
+        server = ThreadingTCPServer((address, port), BoarTCPHandler)
+    elif "fork" not in dir(os):
         warn("Your operating system does not support the 'fork()' system call. This server will only be able to handle one client at a time. Please see the manual on how to set up a server on your operating system to handle multiple clients.")
         server = socketserver.TCPServer((address, port), BoarTCPHandler)
     else:
@@ -21,6 +21,7 @@ import re
 import sys
 import tempfile
 import socket
+import stat
 
 import subprocess
 from front import Front
@@ -30,6 +31,12 @@ from boar_exceptions import *
 
 BOAR_URL_PATTERN = r"boar(\+(local|ssh|tcp))?://.+"
 
+# The number of seconds a shared ssh master connection is kept open
+# after the last boar command using it has finished. Can be overridden
+# with the BOAR_SSH_CONTROL_PERSIST environment variable, where 0
+# disables connection sharing.
+SSH_CONTROL_PERSIST = 300
+
 def is_boar_url(string):
     return re.match(BOAR_URL_PATTERN, string) != None
 
@@ -78,7 +85,20 @@ def user_friendly_open_local_repository(path):
         repo = repository.Repo(path)
     return repo
 
-def create_boar_proxy(to_server, from_server):
+def get_wire_compression(transporter):
+    """Returns the WireCompression to ask the server for, or None. The
+    BOAR_COMPRESSION environment variable may contain a compression
+    spec (see jsonrpc.parse_compression_spec()). By default, only
+    connections over ssh are compressed, as they are the ones likely
+    to pass over slow links."""
+    spec = os.getenv("BOAR_COMPRESSION")
+    if spec == None:
+        spec = "fast" if transporter == "ssh" else "none"
+    if jsonrpc.parse_compression_spec(spec) == None:
+        return None
+    return jsonrpc.WireCompression(spec)
+
+def create_boar_proxy(to_server, from_server, compression = None):
     allowed_exceptions = []
     import builtins as builtin_exceptions
     all_exceptions = sorted(n for n, e in vars(builtin_exceptions).items() 
@@ -105,18 +125,30 @@ def create_boar_proxy(to_server, from_server):
         raise UserError("Could not connect to remote repository: %s" % e)
     except:
         raise
-    server.initialize()
+    capabilities = server.initialize() or {}
+    if compression and compression.method in capabilities.get("compression", ()):
+        accepted = server.negotiate_compression(compression.get_spec())
+        transport.set_compression(jsonrpc.WireCompression(accepted))
+    server.capabilities = capabilities
     return server
 
+def get_remote_front(server):
+    """Returns the front of the given server proxy. The capabilities
+    reported by the server are stored on it for
+    front.front_supports()."""
+    front = server.front
+    front.capabilities = server.capabilities
+    return front
+
 def _connect_tcp(host, port):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((host, port))
     to_server = s.makefile(mode="wb")
     from_server = s.makefile(mode="rb")
-    server = create_boar_proxy(to_server, from_server)
-    return server.front
+    server = create_boar_proxy(to_server, from_server, get_wire_compression("tcp"))
+    return get_remote_front(server)
 
-def _connect_cmd(cmd):
+def _connect_cmd(cmd, compression = None):
     p = subprocess.Popen(cmd,
                          shell = True,
                          stdout = subprocess.PIPE,
@@ -125,8 +157,8 @@ def _connect_cmd(cmd):
     if p.poll():
         raise UserError("Transport command failed with error code %s" % (p.returncode))
     # Child process acts as server: write TO server via p.stdin (wb), read FROM server via p.stdout (rb)
-    server = create_boar_proxy(p.stdin, p.stdout)
-    return server.front
+    server = create_boar_proxy(p.stdin, p.stdout, compression)
+    return get_remote_front(server)
 
 def connect_ssh(url):
     url_with_user_match = re.match(r"boar\+ssh://(.*)@([^/]+)(/.*)", url)
@@ -159,11 +191,15 @@ def connect_ssh(url):
     if os.getenv("BOAR_DISABLE_DEDUP") == "1":
         env += " " + "BOAR_DISABLE_DEDUP=1"
 
+    ssh_options = get_ssh_multiplexing_options(ssh_cmd)
+    if ssh_options:
+        ssh_cmd = "%s %s" % (ssh_cmd, ssh_options)
+
     cmd = '%s "%s" %s "%s" serve -S "%s"' % (ssh_cmd, host, env, boar_cmd, path)
     if user:
         cmd = '%s -l "%s" "%s" %s "%s" serve -S "%s"' % (ssh_cmd, user, host, env, boar_cmd, path)
 
-    return _connect_cmd(cmd)
+    return _connect_cmd(cmd, get_wire_compression("ssh"))
 
 def connect_tcp(url):
     url_match = re.match(r"boar(\+tcp)?://(.*):(\d+)/?", url)
@@ -181,10 +217,45 @@ def connect_local(url):
     repopath, = url_match.groups()
     boarhome = os.path.dirname(os.path.abspath(__file__))
     cmd = "'%s/boar' serve -S '%s'" % (boarhome, repopath)
-    return _connect_cmd(cmd)
+    return _connect_cmd(cmd, get_wire_compression("local"))
+
+
+def get_ssh_multiplexing_options(ssh_cmd):
+    """Returns the options that make OpenSSH share a single master
+    connection between all boar commands talking to the same host, so
+    that only the first one has to wait for the ssh handshake. The
+    master connection closes itself after being idle for a while (see
+    SSH_CONTROL_PERSIST). Returns an empty string if sharing is
+    disabled or not supported by the ssh command."""
+    if ssh_cmd != "ssh" or os.name != "posix":
+        return ""
+    persist = os.getenv("BOAR_SSH_CONTROL_PERSIST", str(SSH_CONTROL_PERSIST))
+    try:
+        persist = int(persist)
+    except ValueError:
+        raise UserError("BOAR_SSH_CONTROL_PERSIST must be a number of seconds, was: %s" % persist)
+    if persist <= 0:
+        return ""
+    # The control sockets give access to the connections, so they must
+    # live in a directory that only the current user can access.
+    control_dir = os.path.join(tempfile.gettempdir(), "boar-ssh-%s" % os.getuid())
+    try:
+        os.mkdir(control_dir, 0o700)
+    except OSError:
+        pass
+    st = os.lstat(control_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        warn("Not sharing ssh connections, %s is not a private directory" % control_dir)
+        return ""
+    return '-o ControlMaster=auto -o ControlPath="%s" -o ControlPersist=%s' % \
+        (os.path.join(control_dir, "%C"), persist)
 
+_ssh_command = None
 
 def __get_ssh_command():
+    global _ssh_command
+    if _ssh_command:
+        return _ssh_command
     ssh_cmd = None
     devnull = open(os.devnull, "w")
     def cmd_exists(cmd):
@@ -201,4 +272,5 @@ def __get_ssh_command():
             break
     if not ssh_cmd:
         raise UserError("No ssh command found (tried: %s)" % (", ".join(ssh_candidates)))
+    _ssh_command = ssh_cmd
     return ssh_cmd
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 import hashlib
+import base64
 import re
 import os
 import sys
@@ -30,6 +31,9 @@ import stat as statmod
 import tempfile
 from tempfile import TemporaryFile
 from threading import current_thread
+import threading
+import concurrent.futures
+import queue
 
 def bytes2str(b):
     if type(b) == str:
@@ -117,6 +121,24 @@ def is_sha256(str):
 
 assert is_md5sum("7df642b2ff939fa4ba27a3eb4009ca67")
 
+def encode_bitmap(bools):
+    """Packs the given sequence of booleans into a compact, json
+    friendly string. Use decode_bitmap() to unpack it."""
+    bits = bytearray((len(bools) + 7) // 8)
+    for n, b in enumerate(bools):
+        if b:
+            bits[n // 8] |= 1 << (n % 8)
+    return bytes2str(base64.b64encode(bytes(bits)))
+
+def decode_bitmap(bitmap, count):
+    """Unpacks a string created by encode_bitmap() into a list of
+    count booleans."""
+    bits = base64.b64decode(bitmap)
+    assert len(bits) == (count + 7) // 8, "Bitmap has unexpected length"
+    return [bool(bits[n // 8] & (1 << (n % 8))) for n in range(count)]
+
+assert decode_bitmap(encode_bitmap([True, False] * 5), 10) == [True, False] * 5
+
 def prefixwrap(prefix, text, rowlen = 80):
     rows = textwrap.wrap(text, width = rowlen - len(prefix))
     result = [prefix + rows.pop(0)]
@@ -582,7 +604,7 @@ def uabspath(path):
 #     return fn
 
 def get_tree(root, sep = os.sep, skip = [], absolute_paths = False, progress_printer = None):
-    """ Returns a list of all the files under the given root
+    """ Returns a sorted list of all the files under the given root
     directory. Any files or directories given in the skip argument
     will not be returned or scanned.
 
@@ -596,6 +618,21 @@ def get_tree(root, sep = os.sep, skip = [], absolute_paths = False, progress_pri
     files found so far. When processing has completed, finished() will
     be called.
     """
+    tree = [path for path, st in walk_tree(root, sep = sep, skip = skip, absolute_paths = absolute_paths,
+                                           progress_printer = progress_printer)]
+    # The order of the returned files must be deterministic for tests to pass.
+    return sorted(tree)
+
+def walk_tree(root, sep = os.sep, skip = [], absolute_paths = False, progress_printer = None, max_workers = None):
+    """ Yields a tuple (path, stat) for every file under the given
+    root directory, where stat is the os.stat() result of the
+    file. The arguments are the same as for get_tree(), but the files
+    are yielded as they are found, in no particular order.
+
+    Directories are scanned concurrently by a pool of max_workers
+    threads, which hides most of the latency of network file
+    systems. The current directory of the process is never changed.
+    """
     assert isinstance(root, str) # Avoid any encoding problems later
     assert type(skip) == type([]), "skip list must be a list"
     assert sep in ("/", "\\")
@@ -613,6 +650,8 @@ def get_tree(root, sep = os.sep, skip = [], absolute_paths = False, progress_pri
             assert False
 
     absolute_root = uabspath(root)
+    if max_workers == None:
+        max_workers = default_worker_count()
 
     if not progress_printer:
         class DummyProgressPrinter(object):
@@ -620,54 +659,68 @@ def get_tree(root, sep = os.sep, skip = [], absolute_paths = False, progress_pri
             def finished(self): pass
         progress_printer = DummyProgressPrinter()
 
-    all_files = []
-
-    def rec_tree(root, path):
-        old_cwd = os.getcwd()
+    fs_encoding = sys.getfilesystemencoding()
+    def scan_dir(dir_abspath, path):
+        """Returns a list of (path, stat) tuples for the files in the
+        given directory, and a list of (abspath, path) tuples for the
+        subdirectories."""
+        files = []
+        subdirs = []
         try:
-            os.chdir(root)
-            names = os.listdir(b".")
-            
-            for name in names:
-                try:
-                    name = name.decode(sys.getfilesystemencoding())
-                except UnicodeDecodeError:
-                    raise UndecodableFilenameException(root.encode(sys.getfilesystemencoding()), name)
-                if name in skip:
-                    continue
-                try:
-                    st = os.stat(name)
-                except OSError as e:
-                    if e.errno == 2 and os.path.islink(name):
-                        print("Warning: ignoring broken symbolic link: ", path + name)
+            with os.scandir(dir_abspath) as entries:
+                for entry in entries:
+                    name = entry.name
+                    try:
+                        # Undecodable names are smuggled through as surrogates
+                        name.encode(fs_encoding)
+                    except UnicodeEncodeError:
+                        raise UndecodableFilenameException(os.fsencode(dir_abspath), os.fsencode(name))
+                    if name in skip:
                         continue
-                    raise
-                if statmod.S_ISDIR(st.st_mode):
-                    rec_tree(name, path + name + sep)
-                else:
-                    all_files.append(path + name)
-            progress_printer.update(new_value=len(all_files))
+                    try:
+                        st = entry.stat()
+                    except OSError as e:
+                        if e.errno == errno.ENOENT and entry.is_symlink():
+                            print("Warning: ignoring broken symbolic link: ", path + name)
+                            continue
+                        raise
+                    if statmod.S_ISDIR(st.st_mode):
+                        subdirs.append((entry.path, path + name + sep))
+                    else:
+                        files.append((path + name, st))
         except OSError as e:
             # Windows may automatically create hidden system directories in a drive's topmost
             # directory, e.g. "e:\System Volume Information". Thus, if a Boar repository is
-            # rooted at "e:\", rec_tree() tries to recurse into the system directories as well,
+            # rooted at "e:\", the walk tries to recurse into the system directories as well,
             # triggering a WindowsError because the access has been denied.
             # For consistency, skip access errors under other platforms as well.
             if e.errno != errno.EACCES:
                 raise
-        finally:
-            os.chdir(old_cwd)
+        return files, subdirs
 
-    if absolute_paths:
-        rec_tree(absolute_root, absolute_root + sep)
-    else:
-        rec_tree(absolute_root, "")
+    files_found = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        if absolute_paths:
+            pending = set([executor.submit(scan_dir, absolute_root, absolute_root + sep)])
+        else:
+            pending = set([executor.submit(scan_dir, absolute_root, "")])
+        try:
+            while pending:
+                finished, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    files, subdirs = future.result()
+                    for subdir_abspath, subdir_path in subdirs:
+                        pending.add(executor.submit(scan_dir, subdir_abspath, subdir_path))
+                    files_found += len(files)
+                    progress_printer.update(new_value=files_found)
+                    for item in files:
+                        yield item
+        finally:
+            for future in pending:
+                future.cancel()
 
     progress_printer.finished()
 
-    # The order of the returned files must be deterministic for tests to pass.
-    return sorted(all_files)
-
 class FileMutex(object):
     """ The purpose of this class is to protect a shared resource from
     other processes. It accomplishes this by using the atomicity of
@@ -1145,3 +1198,93 @@ class ProgressHelper(object):
         assert 0.0 <= self.current_progress <= 1.0
         return pp
 
+def default_worker_count():
+    """Returns a reasonable number of worker threads for I/O and
+    checksum heavy tasks on this machine."""
+    return max(2, min(8, os.cpu_count() or 1))
+
+def run_parallel_tasks(tasks, total_work, progress_callback = lambda f: None, max_workers = None):
+    """Executes the given tasks in a pool of worker threads. Each task
+    is a callable that accepts a single argument, a function that the
+    task should call with the amount of work (typically a byte count)
+    it has performed since the last call. The progress callback will
+    be called with the fraction of total_work that is completed, but
+    only from the calling thread, so it does not need to be thread
+    safe. The first exception raised by any task is re-raised here,
+    and any tasks that have not yet started are cancelled."""
+    if max_workers == None:
+        max_workers = default_worker_count()
+    lock = threading.Lock()
+    aborted = threading.Event()
+    work_done = [0]
+    def report_work(amount):
+        if aborted.is_set():
+            # Some other task has failed. Stop as soon as possible.
+            raise concurrent.futures.CancelledError()
+        with lock:
+            work_done[0] += amount
+    def report_progress():
+        with lock:
+            done = work_done[0]
+        progress_callback(calculate_progress(total_work, min(done, total_work)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+        pending = set(executor.submit(task, report_work) for task in tasks)
+        try:
+            while pending:
+                finished, pending = concurrent.futures.wait(pending, timeout = 0.5,
+                                                            return_when = concurrent.futures.FIRST_EXCEPTION)
+                for future in finished:
+                    future.result()
+                report_progress()
+        except:
+            aborted.set()
+            for future in pending:
+                future.cancel()
+            raise
+
+def read_ahead(datasource, block_size, max_blocks = 4):
+    """Reads all the remaining data from the given data source, and
+    yields it in blocks of block_size bytes (the last one may be
+    shorter). The data is read by a separate thread, at most
+    max_blocks blocks ahead of the caller. That way, the caller can
+    process one block while the next one is being read, as long as
+    the processing releases the GIL. An exception raised by the data
+    source is re-raised here. If there is no more than a single
+    block of data, it is simply read by the calling thread."""
+    if datasource.bytes_left() <= block_size:
+        if datasource.bytes_left() > 0:
+            yield datasource.read(block_size)
+        return
+    blocks = queue.Queue(maxsize = max_blocks)
+    stopped = threading.Event()
+    def put(item):
+        # Gives up if the caller stops consuming the blocks
+        while not stopped.is_set():
+            try:
+                blocks.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def reader():
+        try:
+            while datasource.bytes_left() > 0:
+                if not put(datasource.read(block_size)):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+    thread = threading.Thread(target = reader, name = "read_ahead")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stopped.set()
+        thread.join()
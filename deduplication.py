@@ -15,25 +15,46 @@
 # limitations under the License.
 
 from common import *
+from boar_exceptions import *
 from ordered_dict import OrderedDict
 from jsonrpc import FileDataSource
 
 import sys
 import tempfile
 import array
+import struct
+import binascii
+
+# The version of the cdedup module that this code is written for. An
+# installed module of any other version (such as 1.0, which lacks
+# BlocksDB.add_blocks()) is treated as if it was not installed at all,
+# but the mismatch is reported by dedup_unavailable_reason().
+REQUIRED_CDEDUP_VERSION = "1.1"
+
+cdedup_version = None
 try:
     if os.getenv("BOAR_DISABLE_DEDUP") == "1": raise ImportError()
     import cdedup
     if not hasattr(cdedup, "__version__"):
         raise ImportError()
-    assert cdedup.__version__ == "1.0", "Unexpected deduplication module version (was: %s)" % cdedup.__version__
     cdedup_version = cdedup.__version__
-    from cdedup import RollingChecksum, calc_rolling, IntegerSet, BlocksDB
-    dedup_available = True
+    dedup_available = (cdedup_version == REQUIRED_CDEDUP_VERSION)
 except ImportError:
-    cdedup_version = None
     dedup_available = False
 
+if dedup_available:
+    from cdedup import RollingChecksum, calc_rolling, IntegerSet, BlocksDB, ChunkFinder
+
+def dedup_unavailable_reason():
+    """Returns a short explanation of why the deduplication module
+    cannot be used, or None if it can."""
+    if dedup_available:
+        return None
+    if cdedup_version:
+        return "deduplication module v%s is installed, but v%s is required" % \
+            (cdedup_version, REQUIRED_CDEDUP_VERSION)
+    return "deduplication module is not installed"
+
 def CreateIntegerSet(ints):
     """This method will return an IntegerSet containing the given
     ints. The IntegerSet is suitable for use with the RecipeFinder
@@ -58,6 +79,9 @@ class FakeRollingChecksum(object):
     def feed_string(self, s):
         pass
 
+    def scan_string(self, s):
+        return []
+
     def __iter__(self):
         return self
 
@@ -93,9 +117,14 @@ class TmpBlocksDB(object):
     def __init__(self, blocksdb):
         self.blocksdb = blocksdb
         self.blocks = {} # md5 -> [(blob, offset), ...]
+        # Locations in the underlying blocksdb of the blocks found by
+        # get_many_block_locations(), so that the recipe finder does
+        # not need to look them up again when building the recipe.
+        self.db_locations = {} # md5 -> [(blob, offset), ...]
+        self.chunks = {} # md5 -> (blob, offset, size)
 
     def add_tmp_block(self, md5, blob, offset):
-        md5 = str2bytes(md5)
+        md5 = str2bytes(md5).lower()
         blob = str2bytes(blob)
         assert is_md5sum(md5)
         assert is_md5sum(blob)
@@ -107,12 +136,60 @@ class TmpBlocksDB(object):
         return self.blocksdb.get_block_size()
 
     def get_block_locations(self, md5, limit = -1):
-        md5 = str2bytes(md5)
-        return self.blocks.get(md5, []) + self.blocksdb.get_block_locations(md5, limit)
+        md5 = str2bytes(md5).lower()
+        if md5 in self.db_locations:
+            db_locations = self.db_locations[md5]
+            if limit >= 0:
+                db_locations = db_locations[:limit]
+        else:
+            db_locations = self.blocksdb.get_block_locations(md5, limit)
+        return self.blocks.get(md5, []) + db_locations
+
+    def get_many_block_locations(self, md5s):
+        """Returns a dict mapping each of the given md5 sums to a list
+        of its (blob, offset) locations. The blocks that are not
+        already known are looked up in the blocksdb all at once. The
+        md5 sums are lower case in the result, like in the blocksdb."""
+        md5s = [str2bytes(md5).lower() for md5 in md5s]
+        unknown = [md5 for md5 in md5s if md5 not in self.db_locations]
+        found = self.blocksdb.get_many_block_locations(unknown) if unknown else {}
+        result = {}
+        for md5 in md5s:
+            if md5 in found:
+                db_locations = list(found[md5])
+                if db_locations:
+                    self.db_locations[md5] = db_locations
+            else:
+                db_locations = self.db_locations.get(md5, [])
+            result[md5] = self.blocks.get(md5, []) + db_locations
+        return result
 
     def has_block(self, md5):
-        md5 = str2bytes(md5)
-        return md5 in self.blocks or self.blocksdb.has_block(md5)
+        md5 = str2bytes(md5).lower()
+        return md5 in self.blocks or md5 in self.db_locations or self.blocksdb.has_block(md5)
+
+    def add_tmp_chunk(self, md5, blob, offset, size):
+        md5 = str2bytes(md5).lower()
+        blob = str2bytes(blob)
+        assert is_md5sum(md5)
+        assert is_md5sum(blob)
+        self.chunks.setdefault(md5, (blob, offset, size))
+
+    def get_many_chunk_locations(self, md5s):
+        """Returns a dict mapping the given md5 sums that are known
+        chunks to their (blob, offset, size) location. The md5 sums are
+        lower case in the result, like in the blocksdb."""
+        md5s = [str2bytes(md5).lower() for md5 in md5s]
+        result = {}
+        unknown = []
+        for md5 in md5s:
+            if md5 in self.chunks:
+                result[md5] = self.chunks[md5]
+            else:
+                unknown.append(md5)
+        if unknown:
+            result.update(self.blocksdb.get_many_chunk_locations(unknown))
+        return result
 
 class FakeBlocksDB(object):
     def __init__(self, dbfile, block_size):
@@ -121,12 +198,24 @@ class FakeBlocksDB(object):
     def get_all_rolling(self):
         return []
 
+    def get_rolling_set(self):
+        return FakeIntegerSet(0)
+
     def has_block(self, md5):
         return False
 
     def get_block_locations(self, md5, limit = -1):
         return []
 
+    def get_many_block_locations(self, md5s):
+        return dict((str2bytes(md5).lower(), []) for md5 in md5s)
+
+    def get_many_chunk_locations(self, md5s):
+        return {}
+
+    def add_chunk(self, blob, offset, size, md5):
+        pass
+
     def add_rolling(self, rolling):
         pass
 
@@ -136,6 +225,9 @@ class FakeBlocksDB(object):
     def add_block(self, blob, offset, md5):
         pass
 
+    def add_blocks(self, blocks):
+        pass
+
     def begin(self):
         pass
 
@@ -145,7 +237,66 @@ class FakeBlocksDB(object):
     def get_block_size(self):
         return self.block_size
 
+# A block list is a binary file that lists the deduplication blocks
+# found in a new snapshot, to be added to the blocks db when the
+# snapshot is committed. It starts with BLOCK_LIST_MAGIC, followed by a
+# fixed size record per block: the blob and block md5 sums as 16 raw
+# bytes each, and the offset and rolling checksum as little-endian
+# unsigned 64-bit integers.
+#
+# The content-defined chunks of the "chunks" deduplication mode are
+# listed the same way, in a file starting with CHUNK_LIST_MAGIC. The
+# size of the chunk takes the place of the rolling checksum.
+
+BLOCK_LIST_MAGIC = b"BOARBLOCKS1\n"
+CHUNK_LIST_MAGIC = b"BOARCHUNKS1\n"
+BLOCK_LIST_RECORD = struct.Struct("<16sQQ16s")
+
+class BlockListWriter(object):
+    def __init__(self, path, magic = BLOCK_LIST_MAGIC):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(magic)
+
+    def add_block(self, blob, offset, rolling, md5):
+        """The blob and md5 are given as hex strings. For a chunk
+        list, the size of the chunk is given as the rolling
+        checksum."""
+        assert not self.f.closed
+        self.f.write(BLOCK_LIST_RECORD.pack(binascii.unhexlify(blob), offset, rolling,
+                                            binascii.unhexlify(md5)))
 
+    def close(self):
+        self.f.close()
+
+def verify_block_list(path, magic = BLOCK_LIST_MAGIC):
+    """Raises a CorruptionError if the given file is obviously not a
+    complete block list (or chunk list, if magic is
+    CHUNK_LIST_MAGIC). The records themselves are not checked."""
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise CorruptionError("Not a block list: %s" % path)
+    if (os.path.getsize(path) - len(magic)) % BLOCK_LIST_RECORD.size != 0:
+        raise CorruptionError("Truncated block list: %s" % path)
+
+def read_block_list(path, records_per_read = 10000, magic = BLOCK_LIST_MAGIC):
+    """Yields all the blocks in the given block list file as (blob,
+    offset, rolling, md5) tuples, with the blob and md5 as lowercase
+    hex bytes, ready for BlocksDB.add_blocks(). For a chunk list,
+    the tuples are (blob, offset, size, md5). Raises a
+    CorruptionError if the file is malformed."""
+    verify_block_list(path, magic)
+    record_size = BLOCK_LIST_RECORD.size
+    with open(path, "rb") as f:
+        f.seek(len(magic))
+        while True:
+            data = f.read(record_size * records_per_read)
+            if not data:
+                break
+            if len(data) % record_size != 0:
+                raise CorruptionError("Truncated block list: %s" % path)
+            for blob, offset, rolling, md5 in BLOCK_LIST_RECORD.iter_unpack(data):
+                yield binascii.hexlify(blob), offset, rolling, binascii.hexlify(md5)
 
 
 class BlockChecksum(object):
@@ -226,6 +377,35 @@ class OriginalPieceHandler(object):
         blob, offset = self.get_piece_address(index)
         return [(blob, offset, size)]
 
+def recipe_piece(source, offset, size, original):
+    assert offset >= 0
+    assert size >= 0
+    assert type(original) == bool
+    return OrderedDict([("source", bytes2str(source)),
+                        ("offset", offset),
+                        ("size", size),
+                        ("original", original),
+                        ("repeat", 1)])
+
+def merge_repeated_pieces(pieces):
+    """Returns the given recipe pieces, with consecutive identical
+    deduplicated pieces merged into one piece with a repeat count."""
+    if len(pieces) == 0:
+        return pieces
+    new_pieces = [pieces[0]]
+    assert new_pieces[-1]['repeat'] == 1
+    for piece in pieces[1:]:
+        assert piece['repeat'] == 1
+        if new_pieces[-1]['source'] == piece['source'] and \
+                new_pieces[-1]['size'] == piece['size'] and \
+                new_pieces[-1]['offset'] == piece['offset'] and \
+                new_pieces[-1]['original'] == piece['original'] and \
+                new_pieces[-1]['original'] == False:
+            new_pieces[-1]['repeat'] += 1
+        else:
+            new_pieces.append(piece)
+    return new_pieces
+
 from statemachine import GenericStateMachine
 
 START_STATE = "START"
@@ -368,17 +548,23 @@ class RecipeFinder(GenericStateMachine):
         assert type(s) == bytes
         assert not self.closed
         self.feed_byte_count += len(s)
-        self.rs.feed_string(s)
+        # The scan runs without the GIL
+        hits = array.array("Q", self.rs.scan_string(s))
         self.md5summer.update(s)
         self.tail_buffer.append(s)
-        for offset, rolling in self.rs:
+        block_md5s, block_locations = self.__prefetch_blocks(hits)
+        for offset in hits:
             if offset < self.end_of_last_hit:
                 # Ignore overlapping blocks
                 continue
             block_data = self.tail_buffer[offset : offset + self.block_size]
-            md5 = md5sum(block_data)
-            self.end_of_last_hit >= 0
-            if self.blocksdb.has_block(str2bytes(md5)):
+            if offset in block_md5s:
+                md5 = block_md5s[offset]
+                found = bool(block_locations[str2bytes(md5)])
+            else:
+                md5 = md5sum(block_data)
+                found = self.blocksdb.has_block(str2bytes(md5))
+            if found:
                 assert self.end_of_last_hit >= 0
                 if offset - self.end_of_last_hit > 0:
                     # If this hit is NOT a continuation of the last
@@ -403,6 +589,25 @@ class RecipeFinder(GenericStateMachine):
             self.dispatch(ORIGINAL_DATA_FOUND_EVENT, offset = self.feed_byte_count - self.block_size)
         #print "Half-time flush complete"
 
+    def __prefetch_blocks(self, hits):
+        """Looks up the blocks at the given rolling checksum hits with
+        a single query. Hits are only considered if they do not
+        overlap the previous one, as the blocks are likely to be found
+        back to back. Returns a dict of offset -> md5 for the
+        prefetched blocks, and a dict of md5 -> locations. A hit
+        that was not prefetched must be checked individually."""
+        block_md5s = {}
+        next_offset = self.end_of_last_hit
+        for offset in hits:
+            if offset < next_offset:
+                continue
+            block_md5s[offset] = md5sum(self.tail_buffer[offset : offset + self.block_size])
+            next_offset = offset + self.block_size
+        if not block_md5s:
+            return block_md5s, {}
+        md5s = set(str2bytes(md5) for md5 in block_md5s.values())
+        return block_md5s, self.blocksdb.get_many_block_locations(list(md5s))
+
     def close(self):
         #print "Closing"
 
@@ -428,18 +633,7 @@ class RecipeFinder(GenericStateMachine):
 
     def __seq2rec(self):
         restored_size = 0
-
-        def get_dict(source, offset, size, original):
-            #assert is_md5sum(source)
-            assert offset >= 0
-            assert size >= 0
-            assert type(original) == bool
-
-            return OrderedDict([("source", bytes2str(source)),
-                                ("offset", offset),
-                                ("size", size),
-                                ("original", original),
-                                ("repeat", 1)])
+        get_dict = recipe_piece
 
         for s in self.sequences:
             if isinstance(s, Struct):
@@ -499,22 +693,7 @@ class RecipeFinder(GenericStateMachine):
 
     def __polish_recipe_repeats(self):
         assert self.recipe
-        pieces = self.recipe['pieces']
-        if len(pieces) == 0:
-            return
-        new_pieces = [pieces.pop(0)]
-        assert new_pieces[-1]['repeat'] == 1
-        for piece in pieces:
-            assert piece['repeat'] == 1
-            if new_pieces[-1]['source'] == piece['source'] and \
-                    new_pieces[-1]['size'] == piece['size'] and \
-                    new_pieces[-1]['offset'] == piece['offset'] and \
-                    new_pieces[-1]['original'] == piece['original'] and \
-                    new_pieces[-1]['original'] == False:
-                new_pieces[-1]['repeat'] += 1
-            else:
-                new_pieces.append(piece)
-        self.recipe['pieces'] = new_pieces
+        self.recipe['pieces'] = merge_repeated_pieces(self.recipe['pieces'])
 
     def get_recipe(self):
         assert self.closed
@@ -528,6 +707,159 @@ class RecipeFinder(GenericStateMachine):
             self.__polish_recipe_repeats()
         return self.recipe
 
+class ChunkRecipeFinder(object):
+    """Finds a recipe for a blob in a repository that uses
+    content-defined chunks (the "chunks" deduplication mode). The data
+    is cut into chunks by a ChunkFinder. Chunks that are already
+    stored, in the repository or earlier in the same blob, are
+    referenced by the recipe. The rest is original data that is passed
+    on to the original piece handler. This class has the same
+    interface as RecipeFinder."""
+    def __init__(self, blocksdb, chunk_sizes, original_piece_handler, ChunkFinderClass = None):
+        if not ChunkFinderClass:
+            ChunkFinderClass = ChunkFinder
+        self.blocksdb = blocksdb
+        self.chunk_finder = ChunkFinderClass(*chunk_sizes)
+        self.original_piece_handler = original_piece_handler
+
+        self.tail_buffer = TailBuffer()
+        self.md5summer = hashlib.md5()
+        self.feed_byte_count = 0
+        self.chunk_start = 0
+        self.closed = False
+
+        # The blob, in order. Each item is either ("original", piece
+        # index, size), ("dedup", blob, offset, size) or ("self",
+        # piece index, offset in piece, size) for data that repeats
+        # original data of this blob.
+        self.sequences = []
+        self.seq_number = -1
+        self.piece_size = None # The size of the current original piece, if any
+        self.new_chunks = OrderedDict() # md5 -> (piece index, offset in piece, size)
+        self.recipe = None
+
+    def feed(self, s):
+        assert type(s) == bytes
+        assert not self.closed
+        self.feed_byte_count += len(s)
+        self.md5summer.update(s)
+        self.tail_buffer.append(s)
+        self.__add_chunks(self.chunk_finder.feed_string(s))
+
+    def __add_chunks(self, chunk_ends):
+        chunks = []
+        for end in chunk_ends:
+            data = self.tail_buffer[self.chunk_start : end]
+            chunks.append((str2bytes(md5sum(data)), data))
+            self.chunk_start = end
+        self.tail_buffer.release(self.chunk_start)
+        if not chunks:
+            return
+        locations = self.blocksdb.get_many_chunk_locations([md5 for md5, data in chunks])
+        for md5, data in chunks:
+            if md5 in locations:
+                blob, offset, size = locations[md5]
+                assert size == len(data)
+                self.__add_reference("dedup", blob, offset, size)
+            elif md5 in self.new_chunks:
+                index, offset, size = self.new_chunks[md5]
+                self.__add_reference("self", index, offset, size)
+            else:
+                self.__add_original(md5, data)
+
+    def __add_reference(self, kind, source, offset, size):
+        self.__end_original_piece()
+        if self.sequences and self.sequences[-1][0] == kind:
+            last_kind, last_source, last_offset, last_size = self.sequences[-1]
+            if (last_source, last_offset + last_size) == (source, offset):
+                # A continuation of the previous reference
+                self.sequences[-1] = (kind, source, last_offset, last_size + size)
+                return
+        self.sequences.append((kind, source, offset, size))
+
+    def __add_original(self, md5, data):
+        if self.piece_size == None:
+            self.seq_number += 1
+            self.piece_size = 0
+            self.original_piece_handler.init_piece(self.seq_number)
+        self.new_chunks[md5] = (self.seq_number, self.piece_size, len(data))
+        self.original_piece_handler.add_piece_data(self.seq_number, data)
+        self.piece_size += len(data)
+
+    def __end_original_piece(self):
+        if self.piece_size == None:
+            return
+        self.original_piece_handler.end_piece(self.seq_number)
+        self.sequences.append(("original", self.seq_number, self.piece_size))
+        self.piece_size = None
+
+    def __get_piece_range(self, index, offset, size):
+        """Returns the (blob, offset, size) segments that store the
+        given range of an original piece."""
+        segments = []
+        pos = 0
+        for blob, blob_offset, segment_size in \
+                self.original_piece_handler.get_piece_segments(index, offset + size):
+            skip = max(offset - pos, 0)
+            if skip < segment_size:
+                segments.append((blob, blob_offset + skip, segment_size - skip))
+            pos += segment_size
+        return segments
+
+    def close(self):
+        assert not self.closed
+        self.closed = True
+        if self.chunk_start < self.feed_byte_count:
+            self.__add_chunks([self.feed_byte_count])
+        if self.feed_byte_count == 0:
+            # An empty blob still needs a (zero-length) original piece
+            self.seq_number += 1
+            self.piece_size = 0
+            self.original_piece_handler.init_piece(self.seq_number)
+        self.__end_original_piece()
+        self.original_piece_handler.close()
+        restored_size = 0
+        for piece in self.get_recipe()['pieces']:
+            restored_size += piece['size'] * piece['repeat']
+        assert restored_size == self.feed_byte_count, "Restored is %s, feeded is %s" % (restored_size, self.feed_byte_count)
+
+    def get_new_chunks(self):
+        """After the finder has been closed, returns a list of (blob,
+        offset, size, md5) for the chunks of original data that were
+        found. Chunks that were split over several blobs are left
+        out, as they cannot be referenced as a whole."""
+        assert self.closed
+        result = []
+        for md5, (index, offset, size) in self.new_chunks.items():
+            segments = self.__get_piece_range(index, offset, size)
+            if len(segments) == 1:
+                blob, blob_offset, segment_size = segments[0]
+                assert segment_size == size
+                result.append((bytes2str(blob), blob_offset, size, bytes2str(md5)))
+        return result
+
+    def get_recipe(self):
+        assert self.closed
+        if self.recipe == None:
+            pieces = []
+            for seq in self.sequences:
+                if seq[0] == "original":
+                    kind, index, size = seq
+                    for blob, offset, segment_size in self.original_piece_handler.get_piece_segments(index, size):
+                        pieces.append(recipe_piece(blob, offset, segment_size, True))
+                elif seq[0] == "dedup":
+                    kind, blob, offset, size = seq
+                    pieces.append(recipe_piece(blob, offset, size, False))
+                else:
+                    kind, index, offset, size = seq
+                    for blob, blob_offset, segment_size in self.__get_piece_range(index, offset, size):
+                        pieces.append(recipe_piece(blob, blob_offset, segment_size, False))
+            self.recipe = OrderedDict([("md5sum", self.md5summer.hexdigest()),
+                                       ("size", self.feed_byte_count),
+                                       ("method", "concat"),
+                                       ("pieces", merge_repeated_pieces(pieces))])
+        return self.recipe
+
 class BlockSequenceFinder(object):
     def __init__(self, blocksdb):
         self.blocksdb = blocksdb
@@ -23,10 +23,16 @@ implement an RPC mechanism for this interface.
 from blobrepo import repository
 from boar_exceptions import *
 import sys
+import struct
+import tempfile
+import zlib
 from time import ctime, time
-from common import md5sum, is_md5sum, warn, get_json_module, StopWatch, calculate_progress, str2bytes
-from boar_common import SimpleProgressPrinter
+from common import md5sum, is_md5sum, warn, get_json_module, StopWatch, calculate_progress, str2bytes, \
+    encode_bitmap, decode_bitmap
+from boar_common import SimpleProgressPrinter, bloblist_delta
 from blobrepo.sessions import bloblist_fingerprint
+from jsonrpc import ConcatDataSource, StreamDataSource, FileDataSource
+from collections import OrderedDict
 import copy
 
 json = get_json_module()
@@ -75,8 +81,92 @@ def set_file_contents(front, session_name, filename, contents):
     add_file_simple(front, filename, contents)
     front.commit(session_name)
 
+def write_bloblist_stream(bloblist, f):
+    """Writes the given bloblist to the file object f, as a zlib
+    compressed stream of records. Each record is a blobinfo dict in
+    json format, preceded by its length as a 32 bit unsigned
+    integer."""
+    compressor = zlib.compressobj(BLOBLIST_STREAM_COMPRESSION_LEVEL)
+    for blobinfo in bloblist:
+        record = str2bytes(json.dumps(blobinfo))
+        f.write(compressor.compress(struct.pack("!I", len(record)) + record))
+    f.write(compressor.flush())
+
+def read_bloblist_stream(datasource):
+    """A generator that yields the blobinfo dicts from a data source
+    containing a stream written by write_bloblist_stream(). The data
+    source is always exhausted when the generator finishes or is
+    closed, as required for data sources coming from a remote
+    front."""
+    decompressor = zlib.decompressobj()
+    buf = b""
+    def parse_records(buf):
+        records = []
+        pos = 0
+        while len(buf) - pos >= 4:
+            size, = struct.unpack_from("!I", buf, pos)
+            if len(buf) - pos - 4 < size:
+                break
+            records.append(json.loads(buf[pos + 4:pos + 4 + size]))
+            pos += 4 + size
+        return records, buf[pos:]
+    try:
+        while datasource.bytes_left() > 0:
+            buf += decompressor.decompress(datasource.read(BLOBLIST_STREAM_CHUNK_SIZE))
+            records, buf = parse_records(buf)
+            for blobinfo in records:
+                yield blobinfo
+        buf += decompressor.flush()
+        records, buf = parse_records(buf)
+        for blobinfo in records:
+            yield blobinfo
+        if buf or not decompressor.eof:
+            raise CorruptionError("Bloblist stream ended prematurely")
+    finally:
+        while datasource.bytes_left() > 0:
+            datasource.read(BLOBLIST_STREAM_CHUNK_SIZE)
+
+def front_supports(front, method_name):
+    """Returns True if the given front implements the given optional
+    method (see boarserve.get_capabilities()). A local front
+    implements all of them, a remote front only the ones that the
+    server listed when the connection was made."""
+    if isinstance(front, Front):
+        return True
+    if isinstance(front, DryRunFront):
+        return front_supports(front.realfront, method_name)
+    # Attribute lookups on a remote front are turned into rpc calls,
+    # so only look at what the client has stored on it.
+    capabilities = vars(front).get("capabilities") or {}
+    return method_name in capabilities.get("front", ())
+
+def iter_session_bloblist(front, id):
+    """Returns an iterator over the bloblist of the given snapshot. For
+    a remote front, the bloblist is transferred as a compressed stream
+    that is decoded while it is received, instead of as a single huge
+    json message, if the server supports it. Note that no other calls
+    can be made to a remote front until the iterator is exhausted."""
+    if isinstance(front, Front) or not front_supports(front, "get_session_bloblist_stream"):
+        return iter(front.get_session_bloblist(id))
+    return read_bloblist_stream(front.get_session_bloblist_stream(id))
+
 valid_session_props = set(["ignore", "include"])
 
+# Bloblist streams are read in chunks of this size, and compressed at
+# this zlib level.
+BLOBLIST_STREAM_CHUNK_SIZE = 2**16
+BLOBLIST_STREAM_COMPRESSION_LEVEL = 6
+
+# When cloning, blobs are transferred in batches, to avoid several
+# round trips per blob on remote connections. A batch is sent when it
+# contains this many bytes (a single larger blob is sent alone) or
+# this many blobs.
+CLONE_BATCH_SIZE = 32 * 2**20
+CLONE_BATCH_COUNT = 1000
+
+# The number of bloblist entries that are added per call when cloning.
+CLONE_ENTRY_BATCH_COUNT = 1000
+
 def clone(from_front, to_front, reflink = False):
     """Clone all new snapshots from from_front into to_front. Returns a
     statistics dict with the number of blobs 'reflinked' and 'copied'."""
@@ -189,64 +279,128 @@ def __clone_single_snapshot(from_front, to_front, session_id, reflink = False, s
     """ This function requires that a new snapshot is underway in
     to_front. It does not commit that snapshot. """
     assert from_front != to_front
-    other_bloblist = from_front.get_session_bloblist(session_id)
     other_raw_bloblist = from_front.get_session_raw_bloblist(session_id)
-    for n, blobinfo in enumerate(other_raw_bloblist):
+    new_blobs = OrderedDict()
+    for blobinfo in other_raw_bloblist:
         action = blobinfo.get("action", None)
         if not action:
-            md5sum = blobinfo['md5sum']
-            if not (to_front.has_blob(md5sum) or to_front.new_snapshot_has_blob(md5sum)):
+            new_blobs.setdefault(blobinfo['md5sum'], blobinfo['size'])
+        elif action != "remove":
+            assert False, "Unexpected blobinfo action: " + str(action)
+    if front_supports(to_front, "has_blobs"):
+        blobs_present = decode_bitmap(to_front.has_blobs(list(new_blobs.keys())), len(new_blobs))
+    else:
+        blobs_present = [to_front.has_blob(md5sum) or to_front.new_snapshot_has_blob(md5sum)
+                         for md5sum in new_blobs]
+    missing_blobs = [(md5sum, size) for (md5sum, size), present
+                     in zip(new_blobs.items(), blobs_present) if not present]
+    batch = []
+    batch_size = 0
+    for n, (md5sum, size) in enumerate(missing_blobs):
+        if reflink and _local_source_has_raw_blob(from_front, to_front, md5sum):
+            # Offer the destination the source's raw blob file to share
+            # via a copy-on-write reflink instead of streaming and
+            # re-storing its data. The destination takes it only if it
+            # would store the blob verbatim anyway; repos that
+            # deduplicate or split decline and the blob is streamed
+            # normally below (so those features still apply).
+            try:
+                reflinked = to_front.reflink_new_blob(
+                    md5sum, size, from_front.repo.get_blob_path(md5sum))
+            except (OSError, IOError):
+                # A reflink can still fail for a particular blob even
+                # after the up-front check (e.g. the disk filled up).
+                # Fall back to copying that blob normally.
                 reflinked = False
-                if reflink and _local_source_has_raw_blob(from_front, to_front, md5sum):
-                    # Offer the destination the source's raw blob file to share
-                    # via a copy-on-write reflink instead of streaming and
-                    # re-storing its data. The destination takes it only if it
-                    # would store the blob verbatim anyway; repos that
-                    # deduplicate or split decline and the blob is streamed
-                    # normally below (so those features still apply).
-                    try:
-                        reflinked = to_front.reflink_new_blob(
-                            md5sum, blobinfo['size'],
-                            from_front.repo.get_blob_path(md5sum))
-                    except (OSError, IOError):
-                        # A reflink can still fail for a particular blob even
-                        # after the up-front check (e.g. the disk filled up).
-                        # Fall back to copying that blob normally.
-                        reflinked = False
-                if not reflinked:
-                    pp = SimpleProgressPrinter(sys.stdout,
-                                               label="Sending blob %s of %s (%s MB)" %
-                                               (n+1, len(other_raw_bloblist),
-                                                round((blobinfo['size'] / float(2**20)), 3)))
-                    sw = StopWatch(enabled=False, name="front.clone")
-                    to_front.init_new_blob(md5sum, blobinfo['size'])
-                    sw.mark("front.init_new_blob()")
-                    datasource = from_front.get_blob(md5sum)
-                    pp.update(0.0)
-                    datasource.set_progress_callback(pp.update)
-                    to_front.add_blob_data_streamed(blob_md5 = md5sum,
-                                                    datasource = datasource)
-                    pp.finished()
-                    sw.mark("front.add_blob_data_streamed()")
-                    to_front.blob_finished(md5sum)
-                    sw.mark("front.finished()")
-                    if reflink and _blob_can_reflink_replace(from_front, to_front, md5sum):
-                        # Deduplication/splitting ran, but this blob ended up
-                        # stored verbatim as a single raw blob identical to
-                        # the source's - share it with a reflink instead of
-                        # keeping the freshly copied data.
-                        try:
-                            to_front.reflink_replace_blob(md5sum, from_front.repo.get_blob_path(md5sum))
-                            reflinked = True
-                        except (OSError, IOError):
-                            reflinked = False
+            if reflinked:
                 if stats is not None:
-                    stats["reflinked" if reflinked else "copied"] += 1
-            to_front.add(blobinfo)
-        elif action == "remove":
-            to_front.remove(blobinfo['filename'])
-        else:
-            assert False, "Unexpected blobinfo action: " + str(action)
+                    stats["reflinked"] += 1
+                continue
+        batch.append((md5sum, size))
+        batch_size += size
+        if batch_size >= CLONE_BATCH_SIZE or len(batch) >= CLONE_BATCH_COUNT:
+            __clone_blob_batch(from_front, to_front, batch, n + 1, len(missing_blobs),
+                               reflink = reflink, stats = stats)
+            batch = []
+            batch_size = 0
+    if batch:
+        __clone_blob_batch(from_front, to_front, batch, len(missing_blobs), len(missing_blobs),
+                           reflink = reflink, stats = stats)
+    if front_supports(to_front, "add_bloblist_entries"):
+        for n in range(0, len(other_raw_bloblist), CLONE_ENTRY_BATCH_COUNT):
+            to_front.add_bloblist_entries(other_raw_bloblist[n:n+CLONE_ENTRY_BATCH_COUNT])
+    else:
+        for blobinfo in other_raw_bloblist:
+            if blobinfo.get("action", None) == "remove":
+                to_front.remove(blobinfo['filename'])
+            else:
+                to_front.add(blobinfo)
+
+def __clone_blob_batch(from_front, to_front, batch, last_n, total_count, reflink = False, stats = None):
+    """Transfers the given blobs, a list of (md5sum, size) pairs, from
+    from_front to the snapshot underway in to_front, using a single
+    call to each front. If either front is an older server that does
+    not support that, the blobs are transferred one at a time
+    instead. The last_n and total_count arguments are only used for
+    progress reporting."""
+    if not (front_supports(from_front, "get_blobs") and front_supports(to_front, "add_blobs_streamed")):
+        first_n = last_n - len(batch) + 1
+        for n, (md5sum, size) in enumerate(batch):
+            __clone_blob(from_front, to_front, md5sum, size, first_n + n, total_count,
+                         reflink = reflink, stats = stats)
+        return
+    first_n = last_n - len(batch) + 1
+    batch_size = sum([size for md5sum, size in batch])
+    if len(batch) == 1:
+        label = "Sending blob %s of %s" % (last_n, total_count)
+    else:
+        label = "Sending blobs %s-%s of %s" % (first_n, last_n, total_count)
+    pp = SimpleProgressPrinter(sys.stdout,
+                               label="%s (%s MB)" % (label, round((batch_size / float(2**20)), 3)))
+    sw = StopWatch(enabled=False, name="front.clone")
+    datasource = from_front.get_blobs([md5sum for md5sum, size in batch])
+    sw.mark("front.get_blobs()")
+    pp.update(0.0)
+    datasource.set_progress_callback(pp.update)
+    to_front.add_blobs_streamed(blobs = batch, datasource = datasource)
+    pp.finished()
+    sw.mark("front.add_blobs_streamed()")
+    for md5sum, size in batch:
+        __clone_blob_finished(from_front, to_front, md5sum, reflink = reflink, stats = stats)
+
+def __clone_blob(from_front, to_front, md5sum, size, n, total_count, reflink = False, stats = None):
+    """Transfers a single blob from from_front to the snapshot underway
+    in to_front, using only the calls that every server supports."""
+    pp = SimpleProgressPrinter(sys.stdout,
+                               label="Sending blob %s of %s (%s MB)" %
+                               (n, total_count, round((size / float(2**20)), 3)))
+    sw = StopWatch(enabled=False, name="front.clone")
+    to_front.init_new_blob(md5sum, size)
+    sw.mark("front.init_new_blob()")
+    datasource = from_front.get_blob(md5sum)
+    pp.update(0.0)
+    datasource.set_progress_callback(pp.update)
+    to_front.add_blob_data_streamed(blob_md5 = md5sum, datasource = datasource)
+    pp.finished()
+    sw.mark("front.add_blob_data_streamed()")
+    to_front.blob_finished(md5sum)
+    sw.mark("front.finished()")
+    __clone_blob_finished(from_front, to_front, md5sum, reflink = reflink, stats = stats)
+
+def __clone_blob_finished(from_front, to_front, md5sum, reflink = False, stats = None):
+    reflinked = False
+    if reflink and _blob_can_reflink_replace(from_front, to_front, md5sum):
+        # Deduplication/splitting ran, but this blob ended up
+        # stored verbatim as a single raw blob identical to
+        # the source's - share it with a reflink instead of
+        # keeping the freshly copied data.
+        try:
+            to_front.reflink_replace_blob(md5sum, from_front.repo.get_blob_path(md5sum))
+            reflinked = True
+        except (OSError, IOError):
+            reflinked = False
+    if stats is not None:
+        stats["reflinked" if reflinked else "copied"] += 1
 
 def is_identical(front1, front2):
     """ Returns True iff the other repo contains the same sessions
@@ -321,26 +475,19 @@ class Front(object):
         return self.repo.allows_permanent_erase()
 
     def get_session_ids(self, session_name = None):
-        sids = self.repo.get_all_sessions()
         if not session_name:
-            return sids
-        result = []
-        for sid in sids:
-            session_info = self.get_session_info(sid)
-            name = session_info.get("name")
-            if name == session_name:
-                result.append(sid)
-        return result
+            return self.repo.get_all_sessions()
+        return self.repo.get_session_ids(session_name)
 
     def get_session_names(self, include_meta = False):
-        sessions_count = {}
-        for sid in self.get_session_ids():
-            session_info = self.get_session_info(sid)
-            name = session_info.get("name", "<no name>")
+        result = []
+        for name in self.repo.get_session_names():
+            if name == None:
+                name = "<no name>"
             if not include_meta and name.startswith("__"):
                 continue
-            sessions_count[name] = sessions_count.get(name, 0) + 1
-        return list(sessions_count.keys())
+            result.append(name)
+        return result
 
     def get_deleted_snapshots(self):
         return self.repo.get_deleted_snapshots()
@@ -450,10 +597,49 @@ class Front(object):
         yet loaded its bloblist."""
         return copy.copy(self.loadstats.get(id, None))
 
+    def get_session_bloblist_stream(self, id):
+        """ Returns the same bloblist as get_session_bloblist(), but as a
+        data source delivering a compressed stream of records. Use
+        iter_session_bloblist() or read_bloblist_stream() to decode
+        it. """
+        f = tempfile.TemporaryFile()
+        try:
+            write_bloblist_stream(self.get_session_bloblist(id), f)
+            size = f.tell()
+            f.seek(0)
+        except:
+            f.close()
+            raise
+        return FileDataSource(f, size)
+
     def get_session_raw_bloblist(self, id):
         session_reader = self.repo.get_session(id)
         return copy.copy(session_reader.get_raw_bloblist())
 
+    def get_bloblist_delta(self, from_id, to_id):
+        """ Returns a delta bloblist that, when applied to the bloblist
+        of snapshot from_id, gives the bloblist of snapshot to_id. If
+        from_id is a base (direct or indirect) of to_id, the delta is
+        composed from the raw bloblists of the snapshots between them,
+        and may contain redundant entries, such as the removal of a
+        file that was both added and removed along the way. """
+        assert isinstance(from_id, int) and isinstance(to_id, int)
+        chain = []
+        session_id = to_id
+        while session_id != None and session_id > from_id:
+            chain.insert(0, session_id)
+            session_id = self.repo.get_session(session_id).get_base_id()
+        if session_id != from_id:
+            # Not on the same chain of snapshots. We'll have to
+            # compare the complete bloblists.
+            return bloblist_delta(self.get_session_bloblist(from_id),
+                                  self.get_session_bloblist(to_id))
+        delta = {}
+        for session_id in chain:
+            for blobinfo in self.repo.get_session(session_id).get_raw_bloblist():
+                delta[blobinfo['filename']] = dict(blobinfo)
+        return list(delta.values())
+
     def get_stats(self):
         return self.repo.get_stats()
 
@@ -526,6 +712,13 @@ class Front(object):
     def init_new_blob(self, blob_md5, size):
         self.new_session.init_new_blob(blob_md5, size)
 
+    def get_partial_offset(self, blob_md5):
+        """ Returns the number of bytes of the new blob that the
+        repository already has received in an earlier, interrupted,
+        upload. Must be called right after init_new_blob(). The caller
+        must then only send the data that follows this offset. """
+        return self.new_session.get_partial_offset(blob_md5)
+
     def get_all_rolling(self):
         return self.repo.blocksdb.get_all_rolling()
 
@@ -539,7 +732,8 @@ class Front(object):
     def add_blob_data_streamed(self, blob_md5, datasource):
         import hashlib, common
         assert is_md5sum(blob_md5)
-        summer = hashlib.md5()
+        # Includes any data received before a resumed upload
+        summer = self.new_session.get_received_md5summer(blob_md5)
         total = datasource.bytes_left()
         while datasource.bytes_left() > 0:
             # repository.DEDUP_BLOCK_SIZE is a reasonable size - no other reason
@@ -547,10 +741,28 @@ class Front(object):
             summer.update(block)
             self.new_session.add_blob_data(blob_md5, block)
         if summer.hexdigest() != blob_md5:
+            self.new_session.discard_partial_upload(blob_md5)
             raise common.ContentViolation("Received blob data differs from promised.")
     def blob_finished(self, blob_md5):
         self.new_session.blob_finished(blob_md5)
 
+    def add_blobs_streamed(self, blobs, datasource):
+        """ Adds several new blobs to the snapshot underway. The blobs
+        argument is a list of (md5sum, size) pairs, and the datasource
+        must deliver the data of all the blobs, concatenated in the
+        same order. """
+        assert datasource.bytes_left() == sum([size for blob_md5, size in blobs])
+        try:
+            for blob_md5, size in blobs:
+                self.init_new_blob(blob_md5, size)
+                self.add_blob_data_streamed(blob_md5, StreamDataSource(datasource, size))
+                self.blob_finished(blob_md5)
+        except:
+            # Let the data source be exhausted, even if we fail.
+            while datasource.bytes_left() > 0:
+                datasource.read(repository.DEDUP_BLOCK_SIZE)
+            raise
+
     def reflink_new_blob(self, blob_md5, blob_size, source_path):
         """ Try to add a blob to the active snapshot by reflinking an existing
         raw blob file (on the same filesystem) instead of copying its data.
@@ -582,6 +794,19 @@ class Front(object):
         assert self.new_session
         self.new_session.remove(filename)
 
+    def add_bloblist_entries(self, entries):
+        """ Applies the given raw bloblist entries to the snapshot
+        underway. An entry with the action "remove" is handled as a
+        call to remove(), any other entry as a call to add(). """
+        for blobinfo in entries:
+            action = blobinfo.get("action", None)
+            if not action:
+                self.add(blobinfo)
+            elif action == "remove":
+                self.remove(blobinfo['filename'])
+            else:
+                assert False, "Unexpected blobinfo action: " + str(action)
+
     def __mksession(self, session_name):
         """Create a new session. For internal use. Allows names that
         starts with "__", but throws UserError for invalid names or if
@@ -647,9 +872,29 @@ class Front(object):
         datasource = self.repo.get_blob_reader(sum, offset, size)
         return datasource
 
+    def get_blobs(self, sums):
+        """ Returns a single data source that delivers the contents of
+        all the given blobs, concatenated in the given order. """
+        sources = []
+        for sum in sums:
+            sources.append((self.repo.get_blob_size(sum),
+                            lambda sum = sum: self.repo.get_blob_reader(sum)))
+        return ConcatDataSource(sources)
+
     def has_blob(self, sum):
         return self.repo.has_blob(sum)
 
+    def has_blobs(self, sums):
+        """ Checks the existence of many blobs in a single call. For
+        each of the given blobs, tells if it exists in the repository,
+        or in the new snapshot if one is underway. The result is
+        returned as a bitmap, see common.decode_bitmap(). """
+        result = []
+        for sum in sums:
+            result.append(self.repo.has_blob(sum) or
+                          (self.new_session != None and self.new_snapshot_has_blob(sum)))
+        return encode_bitmap(result)
+
     def get_all_blobs(self):
         """ Returns a list of all blobs (raw or recipes) in the
         repository. This method is deprecated. Use get_all_raw_blobs()
@@ -731,12 +976,21 @@ class DryRunFront(object):
     def get_session_bloblist(self, id):
         return self.realfront.get_session_bloblist(id)
 
+    def get_session_bloblist_stream(self, id):
+        return self.realfront.get_session_bloblist_stream(id)
+
+    def get_bloblist_delta(self, from_id, to_id):
+        return self.realfront.get_bloblist_delta(from_id, to_id)
+
     def create_session(self, session_name, base_session = None, force_base_snapshot = False):
         pass
 
     def init_new_blob(self, blob_md5, size):
         pass
 
+    def get_partial_offset(self, blob_md5):
+        return 0
+
     def add_blob_data(self, blob_md5, b64data):
         pass
 
@@ -750,9 +1004,16 @@ class DryRunFront(object):
     def blob_finished(self, blob_md5):
         pass
 
+    def add_blobs_streamed(self, blobs=None, datasource=None):
+        while datasource.bytes_left():
+            datasource.read(2**12)
+
     def add(self, metadata):
         pass
 
+    def add_bloblist_entries(self, entries):
+        pass
+
     def remove(self, filename):
         pass
 
@@ -771,6 +1032,9 @@ class DryRunFront(object):
     def new_snapshot_has_blob(self, sum):
         return False
 
+    def has_blobs(self, sums):
+        return self.realfront.has_blobs(sums)
+
     def find_last_revision(self, session_name):
         return self.realfront.find_last_revision(session_name)
 
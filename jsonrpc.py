@@ -31,6 +31,10 @@ import sys, os
 import struct
 import inspect
 import select
+import errno
+import io
+import zlib
+import lzma
 
 from boar_exceptions import *
 from common import *
@@ -164,6 +168,13 @@ def dictkeyclean(d):
 #----------------------
 # JSON-RPC 1.0
 
+# Binary payloads are copied in chunks that start at MIN_CHUNK_SIZE
+# and double for every chunk up to MAX_CHUNK_SIZE. Small payloads are
+# not kept waiting, while the per-chunk overhead for large payloads is
+# negligible.
+MIN_CHUNK_SIZE = 2**20
+MAX_CHUNK_SIZE = 8 * 2**20
+
 class DataSource(object):
     def __init__(self):
         # Don't use this
@@ -179,6 +190,16 @@ class DataSource(object):
         than specified if there are no more bytes to read."""
         raise NotImplementedError()
 
+    def readinto(self, buf):
+        """Reads data into the given writable buffer and returns the
+        number of bytes read. Fewer bytes than the buffer size are
+        read only if there are no more bytes to read. Subclasses may
+        override this method to avoid allocating a new bytes object
+        for every call."""
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
     def set_progress_callback(self, progress_callback):
         raise NotImplementedError()
 
@@ -214,6 +235,14 @@ class StreamDataSource(DataSource):
         self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
         return data
 
+    @overrides(DataSource)
+    def readinto(self, buf):
+        bytes_read = readinto_fully(self.stream, memoryview(buf)[:self.remaining])
+        self.remaining -= bytes_read
+        assert self.remaining >= 0
+        self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
+        return bytes_read
+
 class FileDataSource(DataSource):
     def __init__(self, fo, data_size, progress_callback = lambda x: None):
         assert 0 <= data_size
@@ -250,6 +279,327 @@ class FileDataSource(DataSource):
         self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
         return data
 
+    @overrides(DataSource)
+    def readinto(self, buf):
+        if self.remaining == 0:
+            return 0
+        bytes_read = readinto_fully(self.fo, memoryview(buf)[:self.remaining])
+        self.remaining -= bytes_read
+        assert self.remaining >= 0
+        if self.remaining == 0:
+            self.fo.close()
+        self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
+        return bytes_read
+
+    def sendfile(self, out_fd):
+        """Sends all remaining data to the given file descriptor using
+        os.sendfile(), so that the data never has to be copied to user
+        space. Returns False, without sending anything, if this is not
+        possible for the files involved."""
+        if not hasattr(os, "sendfile") or self.remaining == 0:
+            return False
+        try:
+            in_fd = self.fo.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return False
+        offset = self.fo.tell()
+        first_call = True
+        while self.remaining > 0:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, min(self.remaining, MAX_CHUNK_SIZE))
+            except OSError as e:
+                if first_call and e.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    return False
+                raise
+            first_call = False
+            if sent == 0:
+                raise IOError("File ended prematurely: %s" % getattr(self.fo, "name", self.fo))
+            offset += sent
+            self.remaining -= sent
+            self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
+        self.fo.close()
+        return True
+
+class ConcatDataSource(DataSource):
+    """A data source that delivers the data of several other data
+    sources, one after the other. The sources are given as a list of
+    (size, opener) tuples, where opener is a function that returns a
+    data source of the given size. Every source is opened when it is
+    first needed, so that only one of them is open at a time."""
+    def __init__(self, sources, progress_callback = lambda x: None):
+        self.sources = list(sources)
+        self.sources.reverse() # We'll pop() from the end
+        self.current = None
+        self.total = sum([size for size, opener in self.sources])
+        assert 0 <= self.total
+        self.remaining = self.total
+        self.set_progress_callback(progress_callback)
+
+    @overrides(DataSource)
+    def set_progress_callback(self, progress_callback):
+        assert callable(progress_callback)
+        self.progress_callback = progress_callback
+
+    @overrides(DataSource)
+    def bytes_left(self):
+        return self.remaining
+
+    @overrides(DataSource)
+    def read(self, n = None):
+        if n == None:
+            n = self.remaining
+        result = []
+        while n > 0 and self.remaining > 0:
+            if self.current == None or self.current.bytes_left() == 0:
+                size, opener = self.sources.pop()
+                self.current = opener()
+                assert self.current.bytes_left() == size, "Data source has unexpected size"
+                continue
+            data = self.current.read(min(n, self.current.bytes_left()))
+            assert data, "Data source ended prematurely"
+            result.append(data)
+            n -= len(data)
+            self.remaining -= len(data)
+        self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
+        return b"".join(result)
+
+def readinto_fully(stream, buf):
+    """Fills the given buffer from the stream, using as many reads as
+    necessary. Raises an exception if the stream ends first."""
+    filled = 0
+    while filled < len(buf):
+        n = stream.readinto(buf[filled:])
+        if not n:
+            raise ConnectionLost("Stream ended prematurely")
+        filled += n
+    return filled
+
+def iter_chunks(datasource):
+    """Yields the remaining data in the data source as bytes objects of
+    increasing size, see MIN_CHUNK_SIZE and MAX_CHUNK_SIZE."""
+    chunk_size = MIN_CHUNK_SIZE
+    while datasource.bytes_left() > 0:
+        yield datasource.read(chunk_size)
+        chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+def copy_datasource(datasource, s_out, before_chunk = lambda: None, compression = None):
+    """Writes all remaining data from the data source to the binary
+    stream s_out. A file data source is sent with os.sendfile() if
+    possible. Otherwise the data is copied in chunks of increasing
+    size through a reusable buffer. The before_chunk function is
+    called before every chunk is written. If a WireCompression
+    instance is given, the chunks are written as compression frames
+    instead (see WireCompression.write_frame())."""
+    if not compression and isinstance(datasource, FileDataSource) and datasource.bytes_left() > 0:
+        try:
+            out_fd = s_out.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            out_fd = None
+        if out_fd != None:
+            before_chunk()
+            s_out.flush()
+            if datasource.sendfile(out_fd):
+                return
+    if datasource.bytes_left() == 0:
+        return
+    buf = memoryview(bytearray(min(datasource.bytes_left(), MAX_CHUNK_SIZE)))
+    chunk_size = MIN_CHUNK_SIZE
+    while datasource.bytes_left() > 0:
+        before_chunk()
+        n = datasource.readinto(buf[:chunk_size])
+        assert n > 0, "Data source ended prematurely"
+        if compression:
+            compression.write_frame(s_out, buf[:n])
+        else:
+            s_out.write(buf[:n])
+        chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+#----------------------
+# Wire compression
+
+# The compression methods this implementation understands, in order of
+# preference.
+COMPRESSION_METHODS = ("zlib", "lzma")
+
+# The compression levels used when a method is given without a level.
+# "fast" is an alias for the fastest zlib level.
+DEFAULT_COMPRESSION_LEVELS = {"zlib": 6, "lzma": 6}
+
+# A chunk is only compressed if a zlib compressed sample of its
+# beginning is smaller than this fraction of the sample. This keeps us
+# from wasting time on data that is already compressed.
+COMPRESSION_SAMPLE_SIZE = 2**12
+COMPRESSIBLE_RATIO = 0.9
+
+# JSON messages smaller than this are never compressed.
+MIN_COMPRESSED_JSON_SIZE = 2**12
+
+# A compressed JSON message is marked with a leading NUL byte, which
+# can never start a valid JSON text.
+COMPRESSED_JSON_MARKER = b"\0"
+
+# A compressed JSON message may not expand to more than what would fit
+# in the size field of an uncompressed message header.
+MAX_JSON_MESSAGE_SIZE = 2**32 - 1
+
+FRAME_HEADER_FORMAT = "!BI"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+FRAME_RAW = 0
+FRAME_COMPRESSED = 1
+
+def looks_compressible(data):
+    sample = data[:COMPRESSION_SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < COMPRESSIBLE_RATIO * len(sample)
+
+class WireCompression(object):
+    """Compresses the messages and binary payloads passed over a
+    connection, once both ends have agreed to do so. A compression
+    spec is a string on the form "<method>" or "<method>:<level>",
+    for instance "zlib:1". The level only affects the sending side.
+
+    When compression is active, a binary payload is sent as a number
+    of frames. Every frame starts with a frame header, giving the
+    frame type (raw or compressed) and the size of the frame data on
+    the wire. The size field in the message header still gives the
+    uncompressed payload size."""
+    def __init__(self, spec):
+        self.method, self.level = parse_compression_spec(spec)
+        assert self.method in COMPRESSION_METHODS
+
+    def get_spec(self):
+        return "%s:%s" % (self.method, self.level)
+
+    def compress(self, data):
+        if self.method == "zlib":
+            return zlib.compress(data, self.level)
+        return lzma.compress(data, preset = self.level)
+
+    def decompress(self, data, max_size):
+        """Decompresses the given data, which must be a single
+        complete stream of no more than max_size bytes when
+        uncompressed. The output is never allowed to grow beyond
+        max_size, so that a small message from a misbehaving peer can
+        not make us run out of memory."""
+        try:
+            if self.method == "zlib":
+                decompressor = zlib.decompressobj()
+            else:
+                decompressor = lzma.LZMADecompressor()
+            result = decompressor.decompress(data, max_size)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ConnectionLost("Garbled compressed data: %s" % e)
+        if not decompressor.eof or decompressor.unused_data:
+            raise ConnectionLost("Garbled compressed data: truncated, or larger than %s bytes" % max_size)
+        return result
+
+    def pack_json(self, data):
+        if len(data) < MIN_COMPRESSED_JSON_SIZE or not looks_compressible(data):
+            return data
+        compressed = COMPRESSED_JSON_MARKER + self.compress(data)
+        if len(compressed) >= len(data):
+            return data
+        return compressed
+
+    def unpack_json(self, data):
+        if data[:1] != COMPRESSED_JSON_MARKER:
+            return data
+        return self.decompress(data[1:], MAX_JSON_MESSAGE_SIZE)
+
+    def write_frame(self, s_out, data):
+        frame_type, frame_data = FRAME_RAW, data
+        if looks_compressible(data):
+            compressed = self.compress(data)
+            if len(compressed) < len(data):
+                frame_type, frame_data = FRAME_COMPRESSED, compressed
+        s_out.write(struct.pack(FRAME_HEADER_FORMAT, frame_type, len(frame_data)))
+        s_out.write(frame_data)
+
+    def read_frame(self, stream, max_size):
+        """Reads a single frame and returns its uncompressed data,
+        which may not be larger than max_size bytes."""
+        header = stream.read(FRAME_HEADER_SIZE)
+        if len(header) != FRAME_HEADER_SIZE:
+            raise ConnectionLost("Transport stream closed in the middle of a frame")
+        frame_type, frame_size = struct.unpack(FRAME_HEADER_FORMAT, header)
+        # A frame is only compressed if that makes it smaller
+        if frame_size > max_size:
+            raise ConnectionLost("Garbled message stream: frame is larger than expected")
+        data = stream.read(frame_size)
+        if len(data) != frame_size:
+            raise ConnectionLost("Transport stream closed in the middle of a frame")
+        if frame_type == FRAME_COMPRESSED:
+            return self.decompress(data, max_size)
+        if frame_type != FRAME_RAW:
+            raise ConnectionLost("Garbled message stream: unknown frame type %s" % frame_type)
+        return data
+
+def parse_compression_spec(spec):
+    """Returns a (method, level) tuple for the given compression spec,
+    or None if the spec is "none". Raises UserError for invalid
+    specs."""
+    assert isinstance(spec, str)
+    if spec == "none":
+        return None
+    if spec == "fast":
+        return "zlib", 1
+    method, _, level = spec.partition(":")
+    if method not in COMPRESSION_METHODS:
+        raise UserError("Unknown compression method: %s" % spec)
+    if not level:
+        return method, DEFAULT_COMPRESSION_LEVELS[method]
+    try:
+        level = int(level)
+    except ValueError:
+        raise UserError("Invalid compression level: %s" % spec)
+    if not 0 <= level <= 9:
+        raise UserError("Compression level must be between 0 and 9: %s" % spec)
+    return method, level
+
+class CompressedStreamDataSource(DataSource):
+    """The receiving end of a binary payload sent with compression
+    frames. The data_size is the uncompressed size of the payload."""
+    def __init__(self, stream, data_size, compression):
+        assert 0 <= data_size
+        self.stream = stream
+        self.compression = compression
+        self.remaining = data_size
+        self.total = data_size
+        self.buffer = b""
+        self.buffer_pos = 0
+        self.set_progress_callback(lambda x: None)
+
+    @overrides(DataSource)
+    def set_progress_callback(self, progress_callback):
+        assert callable(progress_callback)
+        self.progress_callback = progress_callback
+
+    @overrides(DataSource)
+    def bytes_left(self):
+        return self.remaining
+
+    @overrides(DataSource)
+    def read(self, n = None):
+        if n == None:
+            n = self.remaining
+        n = min(n, self.remaining)
+        result = []
+        while n > 0:
+            if self.buffer_pos == len(self.buffer):
+                # The sender never puts more than MAX_CHUNK_SIZE
+                # bytes in a frame, see copy_datasource().
+                self.buffer = self.compression.read_frame(self.stream, min(self.remaining, MAX_CHUNK_SIZE))
+                self.buffer_pos = 0
+                continue
+            piece = self.buffer[self.buffer_pos:self.buffer_pos + n]
+            self.buffer_pos += len(piece)
+            self.remaining -= len(piece)
+            n -= len(piece)
+            result.append(piece)
+        self.progress_callback(calculate_progress(self.total, self.total - self.remaining))
+        return b"".join(result)
+
 #----------------------
 # JSON-RPC 2.0
 
@@ -515,10 +865,17 @@ class BoarMessageClient(object):
         self.s_out = s_out
         self.call_count = 0
         self.progress_callback = lambda x: None
+        self.compression = None
 
     def set_progress_callback(self, cb):
         self.progress_callback = cb
 
+    def set_compression(self, compression):
+        """Compresses all following messages using the given
+        WireCompression instance. Must only be called after the server
+        has agreed to use the same compression."""
+        self.compression = compression
+
     def log(self, s):
         print(s)
 
@@ -533,20 +890,23 @@ class BoarMessageClient(object):
         bin_length = 0
         if datasource:
             bin_length = datasource.bytes_left()
+        if self.compression:
+            string = self.compression.pack_json(string)
         header = pack_header(len(string), datasource != None, bin_length)
         self.s_out.write(header)
         self.s_out.write(string)
         if datasource:
-            while datasource.bytes_left() > 0:
-                if os.name == "posix":
-                    # Select() only works for sockets on windows, but
-                    # this assert will let us discover protocol errors
-                    # on linux at least, which is quite useful.
-                    incoming_data, _, _ = select.select([self.s_in], [], [], 0)
-                    assert not incoming_data, "No incoming data allowed during send"
-                self.s_out.write(datasource.read(2**14))
+            copy_datasource(datasource, self.s_out, self.__check_no_incoming_data, self.compression)
         self.s_out.flush()
 
+    def __check_no_incoming_data(self):
+        if os.name == "posix":
+            # Select() only works for sockets on windows, but
+            # this assert will let us discover protocol errors
+            # on linux at least, which is quite useful.
+            incoming_data, _, _ = select.select([self.s_in], [], [], 0)
+            assert not incoming_data, "No incoming data allowed during send"
+
     def __recv( self ):
         while True:
             datasize, binary_data_size, is_progress_packet = read_header(self.s_in)
@@ -558,10 +918,14 @@ class BoarMessageClient(object):
             self.progress_callback(progress_obj)
 
         data = self.s_in.read(datasize)
-        if binary_data_size != None:
-            return data, StreamDataSource(self.s_in, binary_data_size)
-        else:
+        if self.compression:
+            data = self.compression.unpack_json(data)
+        if binary_data_size == None:
             return data, None
+        elif self.compression:
+            return data, CompressedStreamDataSource(self.s_in, binary_data_size, self.compression)
+        else:
+            return data, StreamDataSource(self.s_in, binary_data_size)
 
     def sendrecv( self, string, data_source = None ):
         """send data + receive data + close"""
@@ -589,10 +953,17 @@ class BoarMessageServer(object):
         self.s_out = s_out
         self.call_count = 0
         self.handler = handler
+        self.compression = None
+        self.next_compression = None
 
     def log(self, s):
         pass
 
+    def set_compression(self, compression):
+        """Compresses all messages following the reply to the current
+        request, using the given WireCompression instance."""
+        self.next_compression = compression
+
     def close( self ):
         self.s_in.close()
         self.s_out.close()
@@ -610,10 +981,10 @@ class BoarMessageServer(object):
             header = pack_header(len(dummy_result), True, result.bytes_left())
             self.s_out.write( header )
             self.s_out.write( dummy_result )
-            while result.bytes_left() > 0:
-                piece = result.read(2**14)
-                self.s_out.write(piece)
+            copy_datasource(result, self.s_out, compression = self.compression)
         else:
+            if self.compression:
+                result = self.compression.pack_json(result)
             header = pack_header(len(result))
             self.s_out.write( header )
             self.s_out.write( result )
@@ -650,10 +1021,14 @@ class BoarMessageServer(object):
                     self.log("Disconnected: %s" % e)
                     break
                 data = self.s_in.read(datasize)
-                if binary_data_size != None:
-                    incoming_data_source = StreamDataSource(self.s_in, binary_data_size)
-                else:
+                if self.compression:
+                    data = self.compression.unpack_json(data)
+                if binary_data_size == None:
                     incoming_data_source = None
+                elif self.compression:
+                    incoming_data_source = CompressedStreamDataSource(self.s_in, binary_data_size, self.compression)
+                else:
+                    incoming_data_source = StreamDataSource(self.s_in, binary_data_size)
                 result = self.handler.handle(data, incoming_data_source, self.__send_progress)
                 if incoming_data_source:
                     assert incoming_data_source.bytes_left() == 0,\
@@ -661,6 +1036,8 @@ class BoarMessageServer(object):
                 if type(result) == str:
                     result = str2bytes(result)
                 self.__send_result(result)
+                if self.next_compression:
+                    self.compression, self.next_compression = self.next_compression, None
                 self.call_count += 1
                 if self.handler.dead:
                     break
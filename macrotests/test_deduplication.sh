@@ -12,7 +12,7 @@ md5sum -c <<EOF || exit 1
 d978f6138c52b8be4f07bbbf571cd450  $BIGFILE
 EOF
 
-($BOAR --version | grep "Deduplication module v1.0") || { 
+($BOAR --version | grep "Deduplication module v1.1") || { 
     echo "Deduplication module has wrong version / is not installed"; exit 1; }
 
 (BOAR_DISABLE_DEDUP=1 $BOAR --version | grep "Deduplication module not installed") || { 
@@ -202,6 +202,27 @@ cp $BIGFILE Session/b.bin || exit 1
 $BOAR --repo="$REPO" verify || { echo "Verify failed"; exit 1; }
 rm -r "Session" "$REPO"
 
+#
+# Test that repair rebuilds a lost blocks database, so that new
+# commits are deduplicated against the old data again
+#
+
+for MODE in blocks chunks; do
+$BOAR mkrepo --dedup-mode=$MODE "$REPO" || exit 1
+fill_repo
+rm -f "$REPO"/derived/blocks/blocks.db* || exit 1
+$BOAR --repo="$REPO" repair -f || { echo "Repair failed"; exit 1; }
+$BOAR --repo="$REPO" verify || { echo "Verify after repair failed"; exit 1; }
+(cd Session &&
+    (echo "Prefix"; cat $BIGFILE) >c.bin &&
+    $BOAR ci -q ) || exit 1
+C_MD5=`md5sum Session/c.bin | cut -d' ' -f1`
+test -e "$REPO/recipes/${C_MD5:0:2}/$C_MD5.recipe" || {
+    echo "New data was not deduplicated after repair ($MODE)"; exit 1; }
+$BOAR --repo="$REPO" verify || { echo "Verify failed"; exit 1; }
+rm -r "Session" "$REPO" || exit 1
+done
+
 #
 # Test missing recipe
 #
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An in-memory directory tree of a snapshot, used by boarmount. The
+tree is built once from the bloblist, after which path lookups and
+directory listings cost time proportional to the path depth and the
+directory size, respectively, instead of the size of the snapshot.
+
+A RepositoryTree presents all sessions in a repository, on the form
+/<session>/<revision>/... The snapshot trees are loaded on first
+access and kept in a SnapshotTreeCache.
+"""
+
+import threading
+
+from common import *
+from boar_exceptions import CorruptionError
+from ordered_dict import OrderedDict
+
+# A rough estimate of the memory used by a single tree node,
+# including the name and the dict entry in the parent.
+APPROX_NODE_SIZE = 400
+
+# Every snapshot tree gets its own range of inode numbers, starting
+# at (revision << SNAPSHOT_INODE_BITS). This way the inodes of a
+# snapshot stay the same even if the tree is evicted and reloaded.
+SNAPSHOT_INODE_BITS = 32
+
+class FileNode(object):
+    __slots__ = ('inode', 'size', 'mtime', 'ctime', 'md5sum')
+
+    is_dir = False
+    is_link = False
+    nlink = 1
+
+    def __init__(self, inode, blobinfo):
+        self.inode = inode
+        self.size = blobinfo['size']
+        self.mtime = blobinfo['mtime']
+        self.ctime = blobinfo['ctime']
+        self.md5sum = blobinfo['md5sum']
+
+class DirNode(object):
+    __slots__ = ('inode', 'children', 'subdir_count', 'mtime', 'ctime')
+
+    is_dir = True
+    is_link = False
+    size = 0
+
+    def __init__(self, inode):
+        self.inode = inode
+        self.children = {}
+        self.subdir_count = 0
+        self.mtime = 0
+        self.ctime = 0
+
+    @property
+    def nlink(self):
+        # "." and the entry in the parent, plus ".." in every subdir
+        return 2 + self.subdir_count
+
+class SnapshotTree(object):
+    def __init__(self, bloblist, first_inode = 1):
+        """Builds the directory tree for the given bloblist. Inode
+        numbers are allocated sequentially, starting with the root
+        directory at first_inode."""
+        self.first_inode = first_inode
+        self.next_inode = first_inode
+        self.root = self.__new_dir()
+        for blobinfo in bloblist:
+            self.__add_file(blobinfo)
+
+    def __new_dir(self):
+        node = DirNode(self.next_inode)
+        self.next_inode += 1
+        return node
+
+    def __add_file(self, blobinfo):
+        parts = blobinfo['filename'].split("/")
+        dirs = [self.root]
+        for name in parts[:-1]:
+            node = dirs[-1].children.get(name)
+            if node == None:
+                node = self.__new_dir()
+                dirs[-1].children[name] = node
+                dirs[-1].subdir_count += 1
+            elif not node.is_dir:
+                raise CorruptionError("Bloblist contains both a file and a directory named %s" % name)
+            dirs.append(node)
+        if parts[-1] in dirs[-1].children:
+            raise CorruptionError("Dupes in bloblist: %s" % blobinfo['filename'])
+        dirs[-1].children[parts[-1]] = FileNode(self.next_inode, blobinfo)
+        self.next_inode += 1
+        # A directory gets the timestamps of the most recent file below it
+        for node in dirs:
+            node.mtime = max(node.mtime, blobinfo['mtime'])
+            node.ctime = max(node.ctime, blobinfo['ctime'])
+
+    def get_inode_count(self):
+        return self.next_inode - self.first_inode
+
+    def lookup(self, path, load = True):
+        """Returns the node for the given absolute path (such as
+        "/dir/file.txt"), or None if there is no such file or
+        directory. The load argument exists for compatibility with
+        RepositoryTree.lookup() and is ignored."""
+        assert path.startswith("/"), path
+        node = self.root
+        for name in path.split("/"):
+            if not name:
+                continue
+            if not node.is_dir:
+                return None
+            node = node.children.get(name)
+            if node == None:
+                return None
+        return node
+
+    def get_approx_size(self):
+        """Returns the approximate memory used by this tree, in
+        bytes."""
+        return self.get_inode_count() * APPROX_NODE_SIZE
+
+class SymlinkNode(object):
+    __slots__ = ('inode', 'target')
+
+    is_dir = False
+    is_link = True
+    nlink = 1
+    mtime = 0
+    ctime = 0
+
+    def __init__(self, inode, target):
+        self.inode = inode
+        self.target = target
+
+    @property
+    def size(self):
+        return len(self.target)
+
+class RevisionNode(object):
+    """A placeholder for the root directory of a snapshot that may not
+    be loaded yet. It reports a link count of 1, which tells tools like
+    find(1) that the number of subdirectories is unknown."""
+    __slots__ = ('inode', 'rev')
+
+    is_dir = True
+    is_link = False
+    nlink = 1
+    size = 0
+    mtime = 0
+    ctime = 0
+
+    def __init__(self, rev):
+        self.rev = rev
+        self.inode = rev << SNAPSHOT_INODE_BITS
+
+class SnapshotTreeCache(object):
+    def __init__(self, load_bloblist, max_size):
+        """Keeps the most recently used snapshot trees in memory, as
+        long as their approximate total size is below max_size
+        bytes. The most recently used tree is always kept, however
+        large it is. The load_bloblist argument must be a function
+        that returns the bloblist for a given revision."""
+        assert max_size >= 0
+        self.load_bloblist = load_bloblist
+        self.max_size = max_size
+        self.total_size = 0
+        self.trees = OrderedDict()
+        # Revisions that are being loaded (rev -> threading.Event)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, rev, load = True):
+        """Returns the tree for the given revision. If load is False,
+        None is returned for a revision that is not in the cache. The
+        tree is built without holding the lock, so that other
+        snapshots can be accessed meanwhile. Threads asking for a
+        revision that is already being loaded will wait for it."""
+        while True:
+            with self.lock:
+                tree = self.trees.pop(rev, None)
+                if tree != None:
+                    self.trees[rev] = tree
+                    return tree
+                if not load:
+                    return None
+                loading = self.pending.get(rev)
+                if loading == None:
+                    loading = self.pending[rev] = threading.Event()
+                    break
+            # Someone else is loading this revision. If that fails,
+            # we will try again ourselves.
+            loading.wait()
+        try:
+            tree = SnapshotTree(self.load_bloblist(rev),
+                                first_inode = rev << SNAPSHOT_INODE_BITS)
+            assert tree.get_inode_count() < 2**SNAPSHOT_INODE_BITS
+            with self.lock:
+                self.total_size += tree.get_approx_size()
+                self.trees[rev] = tree
+                while self.total_size > self.max_size and len(self.trees) > 1:
+                    evicted_rev, evicted = self.trees.popitem(last = False)
+                    self.total_size -= evicted.get_approx_size()
+        finally:
+            with self.lock:
+                del self.pending[rev]
+            loading.set()
+        return tree
+
+class RepositoryTree(object):
+    def __init__(self, sessions, tree_cache):
+        """Creates the top levels of a tree presenting all the given
+        sessions. The sessions argument must be a dict mapping session
+        names to a list of their revisions. Every session directory
+        contains one directory per revision, and a symlink named
+        "latest" pointing to the highest revision."""
+        self.tree_cache = tree_cache
+        self.next_inode = 1
+        self.root = self.__new_dir()
+        for name, revs in sessions.items():
+            if "/" in name or name in (".", ".."):
+                warn("Session name can not be used as a directory name: %s" % name)
+                continue
+            session_dir = self.__new_dir()
+            self.root.children[name] = session_dir
+            self.root.subdir_count += 1
+            for rev in revs:
+                session_dir.children[str(rev)] = RevisionNode(rev)
+                session_dir.subdir_count += 1
+            if revs:
+                session_dir.children["latest"] = SymlinkNode(self.next_inode, str(max(revs)))
+                self.next_inode += 1
+        assert self.next_inode < 2**SNAPSHOT_INODE_BITS
+
+    def __new_dir(self):
+        node = DirNode(self.next_inode)
+        self.next_inode += 1
+        return node
+
+    def lookup(self, path, load = True):
+        """Returns the node for the given absolute path, or None if
+        there is no such node. A snapshot is loaded when a path inside
+        it is looked up. If the path is the root of a snapshot, the
+        snapshot is only loaded if load is True, otherwise a
+        RevisionNode may be returned."""
+        assert path.startswith("/"), path
+        names = [name for name in path.split("/") if name]
+        node = self.root
+        for n, name in enumerate(names):
+            if not node.is_dir:
+                return None
+            node = node.children.get(name)
+            if node == None:
+                return None
+            if isinstance(node, RevisionNode):
+                is_last = (n == len(names) - 1)
+                tree = self.tree_cache.get(node.rev, load = load or not is_last)
+                if tree:
+                    node = tree.root
+        return node
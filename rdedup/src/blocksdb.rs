@@ -19,14 +19,20 @@
 //! integrity check are all reproduced exactly so that databases written by
 //! the original C `cdedup` and by `rdedup` are byte-for-byte interchangeable.
 
+use std::collections::HashMap;
 use std::time::Duration;
 
-use rusqlite::{params, Connection};
+use rusqlite::{params, params_from_iter, CachedStatement, Connection, Row};
 
 use crate::crc16::crc16;
 
 const MAGIC_BLOCK_SIZE_PROP: &str = "block_size";
 
+/// The number of md5 sums resolved by each query in
+/// `get_many_block_locations`. Kept well below SQLITE_MAX_VARIABLE_NUMBER
+/// (999 in older SQLite versions).
+const LOCATIONS_BATCH_SIZE: usize = 500;
+
 /// Result-kind discriminator mirroring `BLOCKSDB_RESULT`'s error variants.
 #[derive(Debug)]
 pub enum ErrKind {
@@ -106,6 +112,59 @@ fn crc16_row(blob_hex: &[u8], offset: u64, md5_hex: &[u8]) -> u16 {
     crc16(&data)
 }
 
+/// The per-row CRC-16 of the chunks table, over "blob!offset!size!md5!".
+fn crc16_chunk_row(blob_hex: &[u8], offset: u64, size: u64, md5_hex: &[u8]) -> u16 {
+    let mut data = Vec::with_capacity(blob_hex.len() + md5_hex.len() + 48);
+    data.extend_from_slice(blob_hex);
+    data.push(b'!');
+    data.extend_from_slice(offset.to_string().as_bytes());
+    data.push(b'!');
+    data.extend_from_slice(size.to_string().as_bytes());
+    data.push(b'!');
+    data.extend_from_slice(md5_hex);
+    data.push(b'!');
+    crc16(&data)
+}
+
+/// Decode a (blob, offset, row_crc, md5) row from the blocks table into
+/// (blob_hex, offset, md5_hex), verifying the per-row CRC.
+fn decode_block_row(row: &Row<'_>) -> Result<(Vec<u8>, u64, Vec<u8>)> {
+    let blob_col: Vec<u8> = row
+        .get(0)
+        .map_err(|e| BlocksDbError::other(format!("blob column read failed: {}", e)))?;
+    if blob_col.len() != 16 {
+        return Err(BlocksDbError::corrupt(
+            "Unexpected blob column length in get_blocks_next()",
+        ));
+    }
+    let offset = row
+        .get::<_, i64>(1)
+        .map_err(|e| BlocksDbError::other(format!("offset column read failed: {}", e)))?
+        as u64;
+    let row_crc = row
+        .get::<_, i64>(2)
+        .map_err(|e| BlocksDbError::other(format!("row_crc column read failed: {}", e)))?;
+    let md5_col: Vec<u8> = row
+        .get(3)
+        .map_err(|e| BlocksDbError::other(format!("md5 column read failed: {}", e)))?;
+    if md5_col.len() != 16 {
+        return Err(BlocksDbError::corrupt(
+            "Unexpected md5 column length in get_blocks_next()",
+        ));
+    }
+
+    let blob_hex = unpack_md5(&blob_col);
+    let md5_hex_row = unpack_md5(&md5_col);
+    let expected_crc = crc16_row(&blob_hex, offset, &md5_hex_row) as i64;
+    if row_crc != expected_crc {
+        return Err(BlocksDbError::corrupt(format!(
+            "An entry in the blocks database is corrupt (block id {})",
+            String::from_utf8_lossy(&md5_hex_row)
+        )));
+    }
+    Ok((blob_hex, offset, md5_hex_row))
+}
+
 // ---------------------------------------------------------------------------
 // BlocksDb
 // ---------------------------------------------------------------------------
@@ -137,10 +196,13 @@ impl BlocksDb {
              BEGIN EXCLUSIVE;\n\
              CREATE TABLE IF NOT EXISTS blocks (blob BLOB(16) NOT NULL, offset LONG NOT NULL, md5_short BLOB(4) NOT NULL, md5 BLOB(16) NOT NULL, row_crc INT NOT NULL);\n\
              CREATE TABLE IF NOT EXISTS rolling (value LONG NOT NULL);\n\
+             CREATE TABLE IF NOT EXISTS chunks (blob BLOB(16) NOT NULL, offset LONG NOT NULL, size LONG NOT NULL, md5_short BLOB(4) NOT NULL, md5 BLOB(16) NOT NULL, row_crc INT NOT NULL);\n\
              CREATE TABLE IF NOT EXISTS props (name TEXT PRIMARY KEY, value TEXT);\n\
              INSERT OR IGNORE INTO props VALUES ('modification_counter', 0);\n\
              CREATE UNIQUE INDEX IF NOT EXISTS index_offset ON blocks (blob, offset);\n\
              CREATE INDEX IF NOT EXISTS index_block_md5 ON blocks (md5_short);\n\
+             CREATE UNIQUE INDEX IF NOT EXISTS index_chunk_offset ON chunks (blob, offset);\n\
+             CREATE INDEX IF NOT EXISTS index_chunk_md5 ON chunks (md5_short);\n\
              INSERT OR IGNORE INTO props VALUES ('block_size', {});\n\
              COMMIT;",
             block_size
@@ -207,6 +269,58 @@ impl BlocksDb {
 
     /// Mirror of `add_block`. `blob_hex` and `md5_hex` are 32-char hex.
     pub fn add_block(&self, blob_hex: &[u8], offset: u64, md5_hex: &[u8]) -> Result<()> {
+        let mut stmt = self.prepare_add_block()?;
+        Self::insert_block(&mut stmt, blob_hex, offset, md5_hex)
+    }
+
+    /// Add many blocks, given as (blob_hex, offset, md5_hex). Same as
+    /// calling `add_block()` for each of them, but the insert statement is
+    /// only prepared once.
+    pub fn add_blocks(&self, blocks: &[(Vec<u8>, u64, Vec<u8>)]) -> Result<()> {
+        let mut stmt = self.prepare_add_block()?;
+        for (blob_hex, offset, md5_hex) in blocks {
+            Self::insert_block(&mut stmt, blob_hex, *offset, md5_hex)?;
+        }
+        Ok(())
+    }
+
+    fn prepare_add_block(&self) -> Result<CachedStatement<'_>> {
+        self.conn
+            .prepare_cached(
+                "INSERT OR IGNORE INTO blocks (blob, offset, md5_short, md5, row_crc) VALUES (?, ?, ?, ?, ?)",
+            )
+            .map_err(|e| BlocksDbError::other(format!("add_block() prepare failed: {}", e)))
+    }
+
+    /// An upper bound of the number of rows in the blocks table, without
+    /// counting them (which would be a full table scan).
+    pub fn get_max_block_rowid(&self) -> Result<i64> {
+        self.conn
+            .query_row("SELECT IFNULL(MAX(rowid), 0) FROM blocks", [], |row| row.get::<_, i64>(0))
+            .map_err(|e| BlocksDbError::other(format!("get_max_block_rowid() failed: {}", e)))
+    }
+
+    /// Drop the index on the block md5 sums. Inserting a large number of
+    /// blocks, and then rebuilding the index with `create_block_md5_index()`
+    /// in the same transaction, is much faster than updating the index for
+    /// every row. The unique (blob, offset) index is kept, as it is needed
+    /// to ignore blocks that already exist.
+    pub fn drop_block_md5_index(&self) -> Result<()> {
+        self.exec_simple("DROP INDEX IF EXISTS index_block_md5")
+    }
+
+    pub fn create_block_md5_index(&self) -> Result<()> {
+        self.exec_simple("CREATE INDEX IF NOT EXISTS index_block_md5 ON blocks (md5_short)")
+    }
+
+    /// Validate and insert a single block with a statement from
+    /// `prepare_add_block()`.
+    fn insert_block(
+        stmt: &mut CachedStatement<'_>,
+        blob_hex: &[u8],
+        offset: u64,
+        md5_hex: &[u8],
+    ) -> Result<()> {
         if !is_md5sum(blob_hex) {
             return Err(BlocksDbError::other(format!(
                 "add_block(): Not a valid blob name: {}",
@@ -220,24 +334,24 @@ impl BlocksDb {
             )));
         }
 
-        let row_crc = crc16_row(blob_hex, offset, md5_hex) as i64;
-        let packed_md5 = pack_md5(md5_hex);
-        let packed_blob = pack_md5(blob_hex);
+        // The row crc is checked against the lowercase hex when the row is
+        // read back, see decode_block_row().
+        let blob_hex = blob_hex.to_ascii_lowercase();
+        let md5_hex = md5_hex.to_ascii_lowercase();
+        let row_crc = crc16_row(&blob_hex, offset, &md5_hex) as i64;
+        let packed_md5 = pack_md5(&md5_hex);
+        let packed_blob = pack_md5(&blob_hex);
         let md5_short = &packed_md5[0..4];
 
-        self.conn
-            .execute(
-                "INSERT OR IGNORE INTO blocks (blob, offset, md5_short, md5, row_crc) VALUES (?, ?, ?, ?, ?)",
-                params![
-                    packed_blob.as_slice(),
-                    offset as i64,
-                    md5_short,
-                    packed_md5.as_slice(),
-                    row_crc
-                ],
-            )
-            .map(|_| ())
-            .map_err(|e| BlocksDbError::other(format!("Error while inserting new block: {}", e)))
+        stmt.execute(params![
+            packed_blob.as_slice(),
+            offset as i64,
+            md5_short,
+            packed_md5.as_slice(),
+            row_crc
+        ])
+        .map(|_| ())
+        .map_err(|e| BlocksDbError::other(format!("Error while inserting new block: {}", e)))
     }
 
     /// Mirror of `get_blocks_*`. Returns (blob_hex_bytes, offset) pairs and
@@ -277,51 +391,187 @@ impl BlocksDb {
                 }
             };
 
-            let blob_col: Vec<u8> = row
-                .get(0)
-                .map_err(|e| BlocksDbError::other(format!("blob column read failed: {}", e)))?;
-            if blob_col.len() != 16 {
-                return Err(BlocksDbError::corrupt(
-                    "Unexpected blob column length in get_blocks_next()",
-                ));
+            let (blob_hex, offset, _) = decode_block_row(row)?;
+            result.push((blob_hex, offset));
+        }
+        Ok(result)
+    }
+
+    /// Batched `get_block_locations`. Returns the locations of every given
+    /// md5 sum, keyed by the lowercase hex md5 sum. Md5 sums that are not
+    /// in the database map to an empty list. The rows are found through the
+    /// `md5_short` index, `LOCATIONS_BATCH_SIZE` sums per query.
+    pub fn get_many_block_locations(
+        &self,
+        md5s_hex: &[Vec<u8>],
+    ) -> Result<HashMap<Vec<u8>, Vec<(Vec<u8>, u64)>>> {
+        let mut result: HashMap<Vec<u8>, Vec<(Vec<u8>, u64)>> = HashMap::new();
+        for md5_hex in md5s_hex {
+            if !is_md5sum(md5_hex) {
+                return Err(BlocksDbError::other(format!(
+                    "get_many_block_locations(): Not a valid md5 sum: {}",
+                    String::from_utf8_lossy(md5_hex)
+                )));
             }
-            let offset = row
-                .get::<_, i64>(1)
-                .map_err(|e| BlocksDbError::other(format!("offset column read failed: {}", e)))?
-                as u64;
-            let row_crc = row
-                .get::<_, i64>(2)
-                .map_err(|e| BlocksDbError::other(format!("row_crc column read failed: {}", e)))?;
-            let md5_col: Vec<u8> = row
-                .get(3)
-                .map_err(|e| BlocksDbError::other(format!("md5 column read failed: {}", e)))?;
-            if md5_col.len() != 16 {
-                return Err(BlocksDbError::corrupt(
-                    "Unexpected md5 column length in get_blocks_next()",
-                ));
+            result.insert(md5_hex.to_ascii_lowercase(), Vec::new());
+        }
+        let wanted: Vec<Vec<u8>> = result.keys().cloned().collect();
+        for chunk in wanted.chunks(LOCATIONS_BATCH_SIZE) {
+            let placeholders = vec!["?"; chunk.len()].join(", ");
+            let sql = format!(
+                "SELECT blocks.blob, blocks.offset, blocks.row_crc, blocks.md5 FROM blocks \
+                 WHERE md5_short IN ({})",
+                placeholders
+            );
+            let shorts: Vec<Vec<u8>> = chunk.iter().map(|md5| pack_md5(md5)[0..4].to_vec()).collect();
+            let mut stmt = self.conn.prepare(&sql).map_err(|e| {
+                BlocksDbError::other(format!("get_many_block_locations() prepare failed: {}", e))
+            })?;
+            let mut rows = stmt
+                .query(params_from_iter(shorts.iter()))
+                .map_err(|e| BlocksDbError::other(format!("get_blocks query failed: {}", e)))?;
+            loop {
+                let row = match rows.next() {
+                    Ok(Some(row)) => row,
+                    Ok(None) => break,
+                    Err(e) => {
+                        return Err(BlocksDbError::corrupt(format!(
+                            "Unexpected result while reading blocks: {}",
+                            e
+                        )))
+                    }
+                };
+                let (blob_hex, offset, md5_hex_row) = decode_block_row(row)?;
+                // md5_short only narrows the search, rows for other md5
+                // sums sharing the prefix are skipped here.
+                if let Some(locations) = result.get_mut(&md5_hex_row) {
+                    locations.push((blob_hex, offset));
+                }
             }
+        }
+        Ok(result)
+    }
+
+    /// Register a content-defined chunk of `size` bytes found at `offset`
+    /// in the raw blob `blob_hex`.
+    pub fn add_chunk(&self, blob_hex: &[u8], offset: u64, size: u64, md5_hex: &[u8]) -> Result<()> {
+        if !is_md5sum(blob_hex) {
+            return Err(BlocksDbError::other(format!(
+                "add_chunk(): Not a valid blob name: {}",
+                String::from_utf8_lossy(blob_hex)
+            )));
+        }
+        if !is_md5sum(md5_hex) {
+            return Err(BlocksDbError::other(format!(
+                "add_chunk(): Not a valid md5 sum: {}",
+                String::from_utf8_lossy(md5_hex)
+            )));
+        }
+        let blob_hex = blob_hex.to_ascii_lowercase();
+        let md5_hex = md5_hex.to_ascii_lowercase();
+        let row_crc = crc16_chunk_row(&blob_hex, offset, size, &md5_hex) as i64;
+        let packed_md5 = pack_md5(&md5_hex);
+        let packed_blob = pack_md5(&blob_hex);
+        self.conn
+            .execute(
+                "INSERT OR IGNORE INTO chunks (blob, offset, size, md5_short, md5, row_crc) VALUES (?, ?, ?, ?, ?, ?)",
+                params![
+                    packed_blob.as_slice(),
+                    offset as i64,
+                    size as i64,
+                    &packed_md5[0..4],
+                    packed_md5.as_slice(),
+                    row_crc
+                ],
+            )
+            .map(|_| ())
+            .map_err(|e| BlocksDbError::other(format!("Error while inserting new chunk: {}", e)))
+    }
 
-            let blob_hex = unpack_md5(&blob_col);
-            let md5_hex_row = unpack_md5(&md5_col);
-            let expected_crc = crc16_row(&blob_hex, offset, &md5_hex_row) as i64;
-            if row_crc != expected_crc {
-                return Err(BlocksDbError::corrupt(format!(
-                    "An entry in the blocks database is corrupt (block id {})",
-                    String::from_utf8_lossy(&md5_hex_row)
+    /// Returns a location (blob_hex, offset, size) for each of the given
+    /// chunk md5 sums that is known, keyed by the lowercase hex md5 sum.
+    /// Unknown chunks are left out.
+    pub fn get_many_chunk_locations(
+        &self,
+        md5s_hex: &[Vec<u8>],
+    ) -> Result<HashMap<Vec<u8>, (Vec<u8>, u64, u64)>> {
+        let mut wanted = Vec::with_capacity(md5s_hex.len());
+        for md5_hex in md5s_hex {
+            if !is_md5sum(md5_hex) {
+                return Err(BlocksDbError::other(format!(
+                    "get_many_chunk_locations(): Not a valid md5 sum: {}",
+                    String::from_utf8_lossy(md5_hex)
                 )));
             }
-
-            result.push((blob_hex, offset));
+            wanted.push(md5_hex.to_ascii_lowercase());
+        }
+        wanted.sort();
+        wanted.dedup();
+        let mut result = HashMap::new();
+        for chunk in wanted.chunks(LOCATIONS_BATCH_SIZE) {
+            let placeholders = vec!["?"; chunk.len()].join(", ");
+            let sql = format!(
+                "SELECT blob, offset, size, row_crc, md5 FROM chunks WHERE md5_short IN ({})",
+                placeholders
+            );
+            let shorts: Vec<Vec<u8>> = chunk.iter().map(|md5| pack_md5(md5)[0..4].to_vec()).collect();
+            let mut stmt = self.conn.prepare(&sql).map_err(|e| {
+                BlocksDbError::other(format!("get_many_chunk_locations() prepare failed: {}", e))
+            })?;
+            let mut rows = stmt
+                .query(params_from_iter(shorts.iter()))
+                .map_err(|e| BlocksDbError::other(format!("get_chunks query failed: {}", e)))?;
+            loop {
+                let row = match rows.next() {
+                    Ok(Some(row)) => row,
+                    Ok(None) => break,
+                    Err(e) => {
+                        return Err(BlocksDbError::corrupt(format!(
+                            "Unexpected result while reading chunks: {}",
+                            e
+                        )))
+                    }
+                };
+                let blob_col: Vec<u8> = row
+                    .get(0)
+                    .map_err(|e| BlocksDbError::other(format!("blob column read failed: {}", e)))?;
+                let offset = row
+                    .get::<_, i64>(1)
+                    .map_err(|e| BlocksDbError::other(format!("offset column read failed: {}", e)))?
+                    as u64;
+                let size = row
+                    .get::<_, i64>(2)
+                    .map_err(|e| BlocksDbError::other(format!("size column read failed: {}", e)))?
+                    as u64;
+                let row_crc = row
+                    .get::<_, i64>(3)
+                    .map_err(|e| BlocksDbError::other(format!("row_crc column read failed: {}", e)))?;
+                let md5_col: Vec<u8> = row
+                    .get(4)
+                    .map_err(|e| BlocksDbError::other(format!("md5 column read failed: {}", e)))?;
+                if blob_col.len() != 16 || md5_col.len() != 16 {
+                    return Err(BlocksDbError::corrupt("Unexpected column length in chunks table"));
+                }
+                let blob_hex = unpack_md5(&blob_col);
+                let md5_hex_row = unpack_md5(&md5_col);
+                if row_crc != crc16_chunk_row(&blob_hex, offset, size, &md5_hex_row) as i64 {
+                    return Err(BlocksDbError::corrupt(format!(
+                        "An entry in the blocks database is corrupt (chunk id {})",
+                        String::from_utf8_lossy(&md5_hex_row)
+                    )));
+                }
+                if chunk.binary_search(&md5_hex_row).is_ok() {
+                    result.entry(md5_hex_row).or_insert((blob_hex, offset, size));
+                }
+            }
         }
         Ok(result)
     }
 
     pub fn add_rolling(&self, rolling: u64) -> Result<()> {
         self.conn
-            .execute(
-                "INSERT INTO rolling (value) VALUES (?)",
-                params![rolling as i64],
-            )
+            .prepare_cached("INSERT INTO rolling (value) VALUES (?)")
+            .and_then(|mut stmt| stmt.execute(params![rolling as i64]))
             .map(|_| ())
             .map_err(|e| BlocksDbError::other(format!("add_rolling() failed: {}", e)))
     }
@@ -364,6 +614,7 @@ impl BlocksDb {
                 })?;
         }
         self.exec_simple("DELETE FROM blocks WHERE blocks.blob IN blocks_to_delete")?;
+        self.exec_simple("DELETE FROM chunks WHERE chunks.blob IN blocks_to_delete")?;
         self.exec_simple("DROP TABLE blocks_to_delete")?;
         Ok(())
     }
@@ -409,6 +660,137 @@ mod tests {
         assert_eq!(locs[0].1, 0);
     }
 
+    #[test]
+    fn add_blocks_with_deferred_index() {
+        let db = BlocksDb::open(":memory:", 3).unwrap();
+        assert_eq!(db.get_max_block_rowid().unwrap(), 0);
+        db.begin().unwrap();
+        db.drop_block_md5_index().unwrap();
+        let blocks = vec![
+            (b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 0, b"47bce5c74f589f4867dbd57e9ca9f808".to_vec()),
+            (b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 3, b"08f8e0260c64418510cefb2b06eee5cd".to_vec()),
+            // Already added, ignored
+            (b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 0, b"47bce5c74f589f4867dbd57e9ca9f808".to_vec()),
+        ];
+        db.add_blocks(&blocks).unwrap();
+        db.create_block_md5_index().unwrap();
+        db.commit().unwrap();
+        assert_eq!(db.get_max_block_rowid().unwrap(), 2);
+        let locs = db
+            .get_block_locations(b"08f8e0260c64418510cefb2b06eee5cd", -1)
+            .unwrap();
+        assert_eq!(locs, vec![(b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 3)]);
+        let bad = vec![(b"nonsense".to_vec(), 0, b"47bce5c74f589f4867dbd57e9ca9f808".to_vec())];
+        db.begin().unwrap();
+        db.drop_block_md5_index().unwrap();
+        assert!(db.add_blocks(&bad).is_err());
+        db.create_block_md5_index().unwrap();
+        db.commit().unwrap();
+        let indexes: i64 = db
+            .conn
+            .query_row(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = 'index_block_md5'",
+                [],
+                |row| row.get(0),
+            )
+            .unwrap();
+        assert_eq!(indexes, 1);
+    }
+
+    #[test]
+    fn many_block_locations() {
+        let db = BlocksDb::open(":memory:", 3).unwrap();
+        db.begin().unwrap();
+        db.add_block(b"47bce5c74f589f4867dbd57e9ca9f808", 0, b"47bce5c74f589f4867dbd57e9ca9f808")
+            .unwrap();
+        db.add_block(b"47bce5c74f589f4867dbd57e9ca9f808", 3, b"08f8e0260c64418510cefb2b06eee5cd")
+            .unwrap();
+        db.add_block(b"08f8e0260c64418510cefb2b06eee5cd", 0, b"08f8e0260c64418510cefb2b06eee5cd")
+            .unwrap();
+        // Shares md5_short with the block above but is not asked for
+        db.add_block(b"08f8e0260c64418510cefb2b06eee5cd", 3, b"08f8e026ffffffffffffffffffffffff")
+            .unwrap();
+        db.commit().unwrap();
+        let md5s: Vec<Vec<u8>> = vec![
+            b"08F8E0260C64418510CEFB2B06EEE5CD".to_vec(),
+            b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(),
+            b"9df62e693988eb4e1e1444ece0578579".to_vec(),
+        ];
+        let locs = db.get_many_block_locations(&md5s).unwrap();
+        assert_eq!(locs.len(), 3);
+        let mut bbb = locs[&b"08f8e0260c64418510cefb2b06eee5cd".to_vec()].clone();
+        bbb.sort();
+        assert_eq!(
+            bbb,
+            vec![
+                (b"08f8e0260c64418510cefb2b06eee5cd".to_vec(), 0),
+                (b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 3),
+            ]
+        );
+        assert_eq!(
+            locs[&b"47bce5c74f589f4867dbd57e9ca9f808".to_vec()],
+            vec![(b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 0)]
+        );
+        assert!(locs[&b"9df62e693988eb4e1e1444ece0578579".to_vec()].is_empty());
+        assert!(db.get_many_block_locations(&[b"nonsense".to_vec()]).is_err());
+    }
+
+    #[test]
+    fn many_block_locations_mixed_case() {
+        let db = BlocksDb::open(":memory:", 3).unwrap();
+        db.begin().unwrap();
+        db.add_block(b"47bce5c74f589f4867dbd57e9ca9f808", 0, b"08F8E0260C64418510CEFB2B06EEE5CD")
+            .unwrap();
+        db.add_block(b"47BCE5C74F589F4867DBD57E9CA9F808", 3, b"08f8e0260c64418510cefb2b06eee5cd")
+            .unwrap();
+        db.add_block(b"08f8e0260c64418510cefb2b06eee5cd", 0, b"9Df62e693988eb4e1e1444ece0578579")
+            .unwrap();
+        db.commit().unwrap();
+        let md5s: Vec<Vec<u8>> = vec![
+            b"08f8e0260c64418510cefb2b06eee5cd".to_vec(),
+            b"08F8E0260C64418510CEFB2B06EEE5CD".to_vec(),
+            b"9dF62E693988EB4E1E1444ECE0578579".to_vec(),
+            b"47bce5c74f589f4867dbd57e9ca9F808".to_vec(),
+        ];
+        let locs = db.get_many_block_locations(&md5s).unwrap();
+        assert_eq!(locs.len(), 3);
+        for md5 in &md5s {
+            let mut single = db.get_block_locations(md5, -1).unwrap();
+            let mut batched = locs[&md5.to_ascii_lowercase()].clone();
+            single.sort();
+            batched.sort();
+            assert_eq!(single, batched);
+        }
+        assert_eq!(locs[&b"08f8e0260c64418510cefb2b06eee5cd".to_vec()].len(), 2);
+        assert_eq!(locs[&b"9df62e693988eb4e1e1444ece0578579".to_vec()].len(), 1);
+        assert!(locs[&b"47bce5c74f589f4867dbd57e9ca9f808".to_vec()].is_empty());
+    }
+
+    #[test]
+    fn chunk_roundtrip() {
+        let db = BlocksDb::open(":memory:", 3).unwrap();
+        db.begin().unwrap();
+        db.add_chunk(b"47bce5c74f589f4867dbd57e9ca9f808", 10, 4711, b"08f8e0260c64418510cefb2b06eee5cd")
+            .unwrap();
+        db.add_chunk(b"47bce5c74f589f4867dbd57e9ca9f808", 4721, 17, b"9df62e693988eb4e1e1444ece0578579")
+            .unwrap();
+        db.commit().unwrap();
+        let md5s = vec![
+            b"08f8e0260c64418510cefb2b06eee5cd".to_vec(),
+            b"08f8e026ffffffffffffffffffffffff".to_vec(),
+        ];
+        let locs = db.get_many_chunk_locations(&md5s).unwrap();
+        assert_eq!(locs.len(), 1);
+        assert_eq!(
+            locs[&b"08f8e0260c64418510cefb2b06eee5cd".to_vec()],
+            (b"47bce5c74f589f4867dbd57e9ca9f808".to_vec(), 10, 4711)
+        );
+        db.begin().unwrap();
+        db.delete_blocks(&[b"47bce5c74f589f4867dbd57e9ca9f808".to_vec()]).unwrap();
+        db.commit().unwrap();
+        assert!(db.get_many_chunk_locations(&md5s).unwrap().is_empty());
+    }
+
     #[test]
     fn rolling_roundtrip_full_range() {
         let db = BlocksDb::open(":memory:", 65536).unwrap();
@@ -0,0 +1,246 @@
+// Copyright 2013 Mats Ekberg
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//   http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! Content-defined chunking for the "chunks" deduplication mode.
+//!
+//! This is FastCDC (Xia et al., USENIX ATC 2016) with normalized chunking.
+//! A gear hash is rolled over the data, and a chunk ends where the hash
+//! has enough zero bits. Until the chunk reaches `avg_size`, a stricter
+//! mask (two more bits) is used, and a looser one (two fewer bits) after
+//! that, which keeps the chunk sizes close to the average. A chunk is
+//! always cut at `max_size`, and never before `min_size`.
+//!
+//! The gear hash only depends on the last 64 bytes, as every older byte
+//! has been shifted out. So most of the first `min_size` bytes of a chunk
+//! are skipped entirely, only the last 64 of them are hashed. Unlike in
+//! the paper, the hash is not reset at a cut point. That way, whether a
+//! position is a cut point only depends on the data right before it, and
+//! not on where the chunk started, so two streams that differ in the
+//! beginning soon find the same cut points.
+//!
+//! The state is kept between calls, so the cut points do not depend on how
+//! the data is split up when it is fed.
+//!
+//! NOTE: The gear table and the masks define where chunks are cut, and
+//! therefore which chunks in a repository can be deduplicated against each
+//! other. They must never change for an existing repository.
+
+/// The gear table. Generated by splitmix64 from a fixed seed, so that it
+/// is fully determined by this file.
+const GEAR: [u64; 256] = build_gear_table();
+
+/// The number of bytes that the gear hash depends on.
+const HASH_WINDOW: usize = 64;
+
+const fn build_gear_table() -> [u64; 256] {
+    let mut table = [0u64; 256];
+    let mut state: u64 = 0x626f_6172_6364_6331; // "boarcdc1"
+    let mut i = 0;
+    while i < 256 {
+        state = state.wrapping_add(0x9e37_79b9_7f4a_7c15);
+        let mut z = state;
+        z = (z ^ (z >> 30)).wrapping_mul(0xbf58_476d_1ce4_e5b9);
+        z = (z ^ (z >> 27)).wrapping_mul(0x94d0_49bb_1331_11eb);
+        table[i] = z ^ (z >> 31);
+        i += 1;
+    }
+    table
+}
+
+/// A mask of the `bits` most significant bits. The gear hash is shifted
+/// left for every byte, so the high bits depend on the most bytes.
+fn high_bits_mask(bits: u32) -> u64 {
+    assert!(bits > 0 && bits < 64);
+    !0u64 << (64 - bits)
+}
+
+pub const MIN_AVG_SIZE: usize = 64;
+
+pub struct Chunker {
+    min_size: usize,
+    avg_size: usize,
+    max_size: usize,
+    mask_small: u64,
+    mask_large: u64,
+    hash: u64,
+    chunk_length: usize,
+    position: u64,
+}
+
+impl Chunker {
+    /// `avg_size` must be a power of two, at least `MIN_AVG_SIZE`, and
+    /// `min_size <= avg_size <= max_size`. Returns an error message
+    /// otherwise.
+    pub fn new(min_size: usize, avg_size: usize, max_size: usize) -> Result<Chunker, String> {
+        if !avg_size.is_power_of_two() || avg_size < MIN_AVG_SIZE {
+            return Err(format!(
+                "Average chunk size must be a power of two, and at least {} (was {})",
+                MIN_AVG_SIZE, avg_size
+            ));
+        }
+        if min_size == 0 || min_size > avg_size || avg_size > max_size {
+            return Err(format!(
+                "Invalid chunk sizes (min {}, avg {}, max {})",
+                min_size, avg_size, max_size
+            ));
+        }
+        let bits = avg_size.trailing_zeros();
+        Ok(Chunker {
+            min_size,
+            avg_size,
+            max_size,
+            mask_small: high_bits_mask(bits + 2),
+            mask_large: high_bits_mask(bits - 2),
+            hash: 0,
+            chunk_length: 0,
+            position: 0,
+        })
+    }
+
+    /// Scan `data`, which directly follows the previously scanned data.
+    /// Returns the absolute stream offsets where chunks end. The last
+    /// chunk of the stream ends at the end of the data, which is not
+    /// reported (see `position()`).
+    pub fn scan(&mut self, data: &[u8]) -> Vec<u64> {
+        let mut cuts = Vec::new();
+        let hash_from = self.min_size.saturating_sub(HASH_WINDOW);
+        let mut i = 0;
+        while i < data.len() {
+            if self.chunk_length < hash_from {
+                // Cut-point skipping. These bytes can never end a chunk,
+                // and are too far from the first possible cut point to
+                // affect the hash there.
+                let skip = (hash_from - self.chunk_length).min(data.len() - i);
+                self.chunk_length += skip;
+                i += skip;
+                continue;
+            }
+            self.hash = (self.hash << 1).wrapping_add(GEAR[data[i] as usize]);
+            self.chunk_length += 1;
+            i += 1;
+            if self.chunk_length < self.min_size {
+                continue;
+            }
+            let mask = if self.chunk_length < self.avg_size {
+                self.mask_small
+            } else {
+                self.mask_large
+            };
+            if self.hash & mask == 0 || self.chunk_length >= self.max_size {
+                cuts.push(self.position + i as u64);
+                self.chunk_length = 0;
+            }
+        }
+        self.position += data.len() as u64;
+        cuts
+    }
+
+    /// The total number of bytes scanned so far.
+    pub fn position(&self) -> u64 {
+        self.position
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn pseudo_random(len: usize, seed: u64) -> Vec<u8> {
+        let mut state = seed;
+        (0..len)
+            .map(|_| {
+                state = state.wrapping_mul(6364136223846793005).wrapping_add(1442695040888963407);
+                (state >> 56) as u8
+            })
+            .collect()
+    }
+
+    fn chunk_lengths(data: &[u8], pieces: usize) -> Vec<u64> {
+        let mut chunker = Chunker::new(256, 1024, 4096).unwrap();
+        let mut cuts = Vec::new();
+        for piece in data.chunks((data.len() / pieces).max(1)) {
+            cuts.extend(chunker.scan(piece));
+        }
+        let mut lengths = Vec::new();
+        let mut last = 0;
+        for cut in cuts {
+            lengths.push(cut - last);
+            last = cut;
+        }
+        lengths.push(chunker.position() - last);
+        lengths
+    }
+
+    #[test]
+    fn rejects_bad_sizes() {
+        assert!(Chunker::new(256, 1000, 4096).is_err());
+        assert!(Chunker::new(256, 32, 4096).is_err());
+        assert!(Chunker::new(2048, 1024, 4096).is_err());
+        assert!(Chunker::new(256, 1024, 512).is_err());
+        assert!(Chunker::new(0, 1024, 4096).is_err());
+    }
+
+    #[test]
+    fn sizes_are_within_bounds() {
+        let data = pseudo_random(1 << 20, 1);
+        let lengths = chunk_lengths(&data, 1);
+        assert_eq!(lengths.iter().sum::<u64>(), data.len() as u64);
+        for &length in &lengths[..lengths.len() - 1] {
+            assert!(length >= 256 && length <= 4096, "{}", length);
+        }
+        let avg = data.len() / lengths.len();
+        assert!(avg > 512 && avg < 2048, "{}", avg);
+    }
+
+    #[test]
+    fn independent_of_feeding() {
+        let data = pseudo_random(100000, 2);
+        assert_eq!(chunk_lengths(&data, 1), chunk_lengths(&data, 7));
+        assert_eq!(chunk_lengths(&data, 1), chunk_lengths(&data, 100000));
+    }
+
+    #[test]
+    fn constant_data_is_cut_at_max() {
+        let data = vec![0u8; 10000];
+        assert_eq!(chunk_lengths(&data, 3), vec![4096, 4096, 1808]);
+    }
+
+    #[test]
+    fn boundaries_survive_insertion() {
+        let data = pseudo_random(200000, 3);
+        let mut shifted = b"inserted".to_vec();
+        shifted.extend_from_slice(&data);
+        let a = chunk_lengths(&data, 1);
+        let b = chunk_lengths(&shifted, 1);
+        // All but the first few chunks should be identical
+        let common = a.iter().rev().zip(b.iter().rev()).take_while(|(x, y)| x == y).count();
+        assert!(common + 3 >= a.len(), "{} of {}", common, a.len());
+    }
+
+    #[test]
+    fn small_chunks_resynchronize() {
+        // Chunks that are not much longer than the hash window
+        let data = pseudo_random(20000, 4);
+        let mut shifted = b"inserted".to_vec();
+        shifted.extend_from_slice(&data);
+        let cuts = |data: &[u8]| {
+            let mut chunker = Chunker::new(16, 64, 256).unwrap();
+            chunker.scan(data)
+        };
+        let a = cuts(&data);
+        let b: Vec<u64> = cuts(&shifted).iter().map(|cut| cut - 8).collect();
+        let common = a.iter().filter(|cut| b.contains(cut)).count();
+        assert!(common + 5 >= a.len(), "{} of {}", common, a.len());
+    }
+}
@@ -27,6 +27,13 @@
 //! interleaved bucket struct (≈L3). The slot vectors are consulted only on
 //! the rare mask pass.
 
+/// Membership test used by the rolling checksum scan. Implemented by the
+/// in-memory `IntSet`, the persistent `RollingTable`, and combinations of
+/// the two.
+pub trait RollingLookup {
+    fn lookup(&self, value: u64) -> bool;
+}
+
 pub struct IntSet {
     value_count: usize,
     bucket_count: usize, // always a power of two
@@ -103,6 +110,13 @@ impl IntSet {
     }
 }
 
+impl RollingLookup for IntSet {
+    #[inline]
+    fn lookup(&self, value: u64) -> bool {
+        self.contains(value)
+    }
+}
+
 #[cfg(test)]
 mod tests {
     use super::IntSet;
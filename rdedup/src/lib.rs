@@ -21,22 +21,30 @@
 
 mod blocksdb;
 mod crc16;
+mod chunker;
 mod intset;
+mod rollset;
 mod rollsum;
 
-use std::collections::{HashSet, VecDeque};
+use std::collections::VecDeque;
+use std::sync::Arc;
 
 use pyo3::exceptions::{PyAssertionError, PyException};
 use pyo3::prelude::*;
-use pyo3::types::{PyByteArray, PyBytes};
+use pyo3::types::{PyByteArray, PyBytes, PyDict};
 
 use blocksdb::{BlocksDb, BlocksDbError, ErrKind};
-use intset::IntSet;
+use chunker::Chunker;
+use intset::{IntSet, RollingLookup};
+use rollset::{RollingTable, DIRTY_MODCOUNT};
 use rollsum::{calc_rolling_digest, RollingState};
 
-/// Major.minor version. Major bumps signal API changes; kept identical to
-/// `cdedup.__version__` so `deduplication.py`'s compatibility assertion holds.
-const VERSION: &str = "1.0";
+/// Major.minor version. Major bumps signal API changes. Must match
+/// `REQUIRED_CDEDUP_VERSION` in `deduplication.py`, or the module is not used.
+const VERSION: &str = "1.1";
+
+/// The number of blocks that `BlocksDB.add_blocks()` inserts at a time.
+const ADD_BLOCKS_BATCH_SIZE: usize = 10000;
 
 // ---------------------------------------------------------------------------
 // Error helpers
@@ -72,14 +80,20 @@ fn map_db_error(py: Python<'_>, err: BlocksDbError) -> PyErr {
 #[pyclass]
 pub struct IntegerSet {
     inner: IntSet,
+    /// A read-only persistent set of the values that were already in the
+    /// blocks database, see `BlocksDB.get_rolling_set()`. Values added
+    /// through this object go to `inner`.
+    base: Option<Arc<RollingTable>>,
 }
 
-impl IntegerSet {
-    /// Crate-internal access to the backing set for `RollingChecksum`'s hot
-    /// scan loop.
+impl RollingLookup for IntegerSet {
     #[inline]
-    fn inner_set(&self) -> &IntSet {
-        &self.inner
+    fn lookup(&self, value: u64) -> bool {
+        self.inner.contains(value)
+            || match &self.base {
+                Some(base) => base.contains(value),
+                None => false,
+            }
     }
 }
 
@@ -89,7 +103,7 @@ impl IntegerSet {
     fn new(bucket_count: usize) -> Self {
         // The C constructor rounds the bucket count up to a power of two;
         // for us it is only a capacity hint, so we pass it through.
-        IntegerSet { inner: IntSet::new(bucket_count) }
+        IntegerSet { inner: IntSet::new(bucket_count), base: None }
     }
 
     fn add(&mut self, int_to_add: u64) {
@@ -103,7 +117,7 @@ impl IntegerSet {
     }
 
     fn contains(&self, int_to_find: u64) -> bool {
-        self.inner.contains(int_to_find)
+        self.lookup(int_to_find)
     }
 }
 
@@ -161,6 +175,20 @@ impl RollingChecksum {
         Ok(())
     }
 
+    /// Queue `s` and scan all the queued data, returning the offsets of
+    /// all hits. Same result as `feed_string()` followed by iterating, but
+    /// the GIL is released during the scan, so that other threads (such as
+    /// one reading the next part of the file) can run meanwhile.
+    fn scan_string(mut slf: PyRefMut<'_, Self>, s: &Bound<'_, PyAny>) -> PyResult<Vec<u64>> {
+        slf.feed_string(s)?;
+        let py = slf.py();
+        let intset_handle = slf.intset.clone_ref(py);
+        let intset_guard = intset_handle.bind(py).borrow();
+        let intset: &IntegerSet = &intset_guard;
+        let this = &mut *slf;
+        Ok(py.allow_threads(|| this.scan_queued(intset)))
+    }
+
     fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
         slf
     }
@@ -174,7 +202,7 @@ impl RollingChecksum {
         // across the scan loop without aliasing `slf`.
         let intset_handle = slf.intset.clone_ref(py);
         let intset_guard = intset_handle.bind(py).borrow();
-        let intset = intset_guard.inner_set();
+        let intset: &IntegerSet = &intset_guard;
         let window = slf.window_size;
 
         // Disjoint borrows of `slf`'s fields let the per-byte loop live
@@ -232,18 +260,86 @@ impl RollingChecksum {
     }
 }
 
+impl RollingChecksum {
+    /// Scan all queued data, collecting the offsets of the hits. Does not
+    /// touch any Python objects, so it can run without the GIL.
+    fn scan_queued(&mut self, intset: &IntegerSet) -> Vec<u64> {
+        let mut hits = Vec::new();
+        loop {
+            if self.feed_pos == self.feed_s.len() {
+                match self.feed_queue.pop_front() {
+                    Some(s) => {
+                        self.feed_s = s;
+                        self.feed_pos = 0;
+                    }
+                    None => return hits,
+                }
+            }
+            match self.state.scan(
+                &self.feed_s,
+                self.feed_pos,
+                self.window_size,
+                &mut self.feeded_bytecount,
+                intset,
+            ) {
+                Some(hit) => {
+                    self.feed_pos = hit.next_pos;
+                    hits.push(hit.offset);
+                }
+                None => {
+                    self.feed_pos = self.feed_s.len();
+                }
+            }
+        }
+    }
+}
+
 // ---------------------------------------------------------------------------
 // calc_rolling
 // ---------------------------------------------------------------------------
 
 /// Convenience function: the rolling digest of a single block no larger than
-/// `window_size`. Mirrors `cdedup.calc_rolling`.
+/// `window_size`. Mirrors `cdedup.calc_rolling`. The GIL is released
+/// while the digest is calculated.
 #[pyfunction]
-fn calc_rolling(s: &[u8], window_size: usize) -> PyResult<u64> {
+fn calc_rolling(py: Python<'_>, s: &[u8], window_size: usize) -> PyResult<u64> {
     if s.len() > window_size {
         return Err(PyAssertionError::new_err("calc_rolling: block larger than window"));
     }
-    Ok(calc_rolling_digest(s))
+    Ok(py.allow_threads(|| calc_rolling_digest(s)))
+}
+
+// ---------------------------------------------------------------------------
+// ChunkFinder
+// ---------------------------------------------------------------------------
+
+/// Content-defined chunking, see chunker.rs. Feed the data with
+/// feed_string(), which returns the stream offsets where chunks end. The
+/// last chunk ends at the end of the data.
+#[pyclass]
+pub struct ChunkFinder {
+    chunker: Chunker,
+}
+
+#[pymethods]
+impl ChunkFinder {
+    #[new]
+    fn new(min_size: usize, avg_size: usize, max_size: usize) -> PyResult<Self> {
+        let chunker = Chunker::new(min_size, avg_size, max_size).map_err(PyAssertionError::new_err)?;
+        Ok(ChunkFinder { chunker })
+    }
+
+    /// The GIL is released during the scan.
+    fn feed_string(&mut self, py: Python<'_>, s: &Bound<'_, PyBytes>) -> Vec<u64> {
+        let data = s.as_bytes();
+        let chunker = &mut self.chunker;
+        py.allow_threads(|| chunker.scan(data))
+    }
+
+    /// The number of bytes fed so far.
+    fn position(&self) -> u64 {
+        self.chunker.position()
+    }
 }
 
 // ---------------------------------------------------------------------------
@@ -254,25 +350,122 @@ fn calc_rolling(s: &[u8], window_size: usize) -> PyResult<u64> {
 pub struct BlocksDB {
     db: BlocksDb,
     in_transaction: bool,
-    all_rolling: HashSet<u64>,
     is_modified: bool,
-    last_seen_modcount: i64,
-    rolling_loaded: bool,
+    /// Where the persistent set of rolling checksums is kept, or None for
+    /// an in-memory database. See rollset.rs.
+    rolling_path: Option<String>,
+    /// The persistent rolling set, opened for writing by begin(). For an
+    /// in-memory database, an in-memory set is used instead.
+    rolling_table: Option<RollingTable>,
+    memory_rolling: IntSet,
+}
+
+fn rolling_error(err: std::io::Error) -> BlocksDbError {
+    BlocksDbError {
+        kind: ErrKind::Other,
+        message: format!("Error while updating the rolling checksum set: {}", err),
+    }
 }
 
 impl BlocksDB {
-    fn load_rolling_lazy(&mut self) -> Result<(), BlocksDbError> {
-        if self.rolling_loaded {
+    /// Open the persistent rolling set for writing, rebuilding it from the
+    /// `rolling` table if it is missing or does not match the database. Must
+    /// be called inside a database transaction. The set is marked dirty
+    /// until commit() stamps it with the new modcount.
+    fn open_rolling_table(&mut self) -> Result<(), BlocksDbError> {
+        let path = match &self.rolling_path {
+            Some(path) => path.clone(),
+            None => return Ok(()),
+        };
+        let modcount = self.db.get_modcount()?;
+        if let Some(table) = &self.rolling_table {
+            if table.modcount() != modcount {
+                self.rolling_table = None;
+            }
+        }
+        if self.rolling_table.is_none() {
+            let mut table = RollingTable::open(&path, true).map_err(rolling_error)?;
+            if table.as_ref().map_or(true, |t| t.modcount() != modcount) {
+                drop(table);
+                let rolling = self.db.get_all_rolling()?;
+                let count = rolling.len() as u64;
+                RollingTable::create(&path, rolling, count, modcount).map_err(rolling_error)?;
+                table = RollingTable::open(&path, true).map_err(rolling_error)?;
+            }
+            self.rolling_table = Some(table.ok_or_else(|| rolling_error(std::io::Error::new(
+                std::io::ErrorKind::InvalidData,
+                "rolling set is invalid",
+            )))?);
+        }
+        let table = self.rolling_table.as_mut().unwrap();
+        table.set_modcount(DIRTY_MODCOUNT);
+        table.flush().map_err(rolling_error)
+    }
+
+    fn has_rolling(&self, rolling: u64) -> bool {
+        match &self.rolling_table {
+            Some(table) => table.contains(rolling),
+            None => self.memory_rolling.contains(rolling),
+        }
+    }
+
+    fn insert_rolling(&mut self, rolling: u64) -> Result<(), BlocksDbError> {
+        if self.rolling_path.is_none() {
+            self.memory_rolling.add(rolling);
             return Ok(());
         }
-        self.rolling_loaded = true;
-        self.reload_rolling()
+        let mut table = self.rolling_table.take().expect("rolling set not opened");
+        if table.needs_grow() {
+            table = table
+                .grow(self.rolling_path.as_ref().unwrap())
+                .map_err(rolling_error)?;
+        }
+        table.insert(rolling);
+        self.rolling_table = Some(table);
+        Ok(())
     }
 
-    fn reload_rolling(&mut self) -> Result<(), BlocksDbError> {
-        let rolling = self.db.get_all_rolling()?;
-        self.all_rolling = rolling.into_iter().collect();
-        self.last_seen_modcount = self.db.get_modcount()?;
+    /// The body of add_blocks(). Sets index_dropped as soon as the md5
+    /// index has been dropped, so that the caller can rebuild it also
+    /// when an error is returned.
+    fn insert_blocks_batched(
+        &mut self,
+        py: Python<'_>,
+        blocks: &Bound<'_, PyAny>,
+        index_dropped: &mut bool,
+    ) -> PyResult<()> {
+        let existing_rows = self.db.get_max_block_rowid().map_err(|e| map_db_error(py, e))?;
+        let mut added_rows: i64 = 0;
+        let mut batch = Vec::with_capacity(ADD_BLOCKS_BATCH_SIZE);
+        let mut items = blocks.iter()?;
+        loop {
+            let item = items.next().transpose()?;
+            if let Some(item) = &item {
+                let (blob, offset, rolling, md5): (Bound<'_, PyBytes>, u64, u64, Bound<'_, PyBytes>) =
+                    item.extract()?;
+                batch.push((blob.as_bytes().to_vec(), offset, md5.as_bytes().to_vec()));
+                if !self.has_rolling(rolling) {
+                    self.insert_rolling(rolling).map_err(|e| map_db_error(py, e))?;
+                    self.db.add_rolling(rolling).map_err(|e| map_db_error(py, e))?;
+                }
+                if batch.len() < ADD_BLOCKS_BATCH_SIZE {
+                    continue;
+                }
+            }
+            if !batch.is_empty() {
+                self.is_modified = true;
+                if !*index_dropped && added_rows + batch.len() as i64 > existing_rows {
+                    self.db.drop_block_md5_index().map_err(|e| map_db_error(py, e))?;
+                    *index_dropped = true;
+                }
+                self.db.add_blocks(&batch).map_err(|e| map_db_error(py, e))?;
+                added_rows += batch.len() as i64;
+                batch.clear();
+            }
+            if item.is_none() {
+                break;
+            }
+        }
         Ok(())
     }
 }
@@ -292,21 +485,54 @@ impl BlocksDB {
         // The pyx __init__ raises SoftCorruptionError for *any* init failure.
         let db = BlocksDb::open(&path, block_size)
             .map_err(|e| soft_corruption_error(py, &e.message))?;
+        let mut memory_rolling = IntSet::new(1);
+        let rolling_path = if path == ":memory:" {
+            for rolling in db.get_all_rolling().map_err(|e| map_db_error(py, e))? {
+                memory_rolling.add(rolling);
+            }
+            None
+        } else {
+            Some(format!("{}-rolling", path))
+        };
         Ok(BlocksDB {
             db,
             in_transaction: false,
-            all_rolling: HashSet::new(),
             is_modified: false,
-            last_seen_modcount: -1,
-            rolling_loaded: false,
+            rolling_path,
+            rolling_table: None,
+            memory_rolling,
         })
     }
 
     fn get_all_rolling(&mut self, py: Python<'_>) -> PyResult<Vec<u64>> {
-        self.load_rolling_lazy().map_err(|e| map_db_error(py, e))?;
         self.db.get_all_rolling().map_err(|e| map_db_error(py, e))
     }
 
+    /// Returns an IntegerSet containing every rolling checksum in the
+    /// database. It is backed by the persistent rolling set if that is up to
+    /// date, which makes this O(1). Otherwise (the set has not been built
+    /// yet, or the database is being modified right now) the values are
+    /// loaded from the database. Values added to the returned set are kept
+    /// in memory only.
+    fn get_rolling_set(&self, py: Python<'_>) -> PyResult<IntegerSet> {
+        if let Some(path) = &self.rolling_path {
+            let modcount = self.db.get_modcount().map_err(|e| map_db_error(py, e))?;
+            let table = RollingTable::open(path, false)
+                .map_err(|e| map_db_error(py, rolling_error(e)))?;
+            if let Some(table) = table {
+                if table.modcount() == modcount {
+                    return Ok(IntegerSet { inner: IntSet::new(1), base: Some(Arc::new(table)) });
+                }
+            }
+        }
+        let rolling = self.db.get_all_rolling().map_err(|e| map_db_error(py, e))?;
+        let mut inner = IntSet::new(rolling.len().max(100000));
+        for value in rolling {
+            inner.add(value);
+        }
+        Ok(IntegerSet { inner, base: None })
+    }
+
     fn has_block(&self, py: Python<'_>, md5: &[u8]) -> PyResult<bool> {
         let locs = self
             .db
@@ -332,15 +558,38 @@ impl BlocksDB {
             .collect())
     }
 
+    /// Returns a dict mapping each of the given md5 sums (lowercase hex
+    /// bytes) to a list of its (blob, offset) locations, which is empty for
+    /// unknown blocks. Equivalent to calling get_block_locations() for every
+    /// md5 sum, but with a few queries instead of one per block.
+    fn get_many_block_locations<'py>(
+        &self,
+        py: Python<'py>,
+        md5s: Vec<Vec<u8>>,
+    ) -> PyResult<Bound<'py, PyDict>> {
+        let locs = self
+            .db
+            .get_many_block_locations(&md5s)
+            .map_err(|e| map_db_error(py, e))?;
+        let result = PyDict::new_bound(py);
+        for (md5, locations) in locs {
+            let locations: Vec<(Py<PyBytes>, u64)> = locations
+                .into_iter()
+                .map(|(blob, offset)| (PyBytes::new_bound(py, &blob).unbind(), offset))
+                .collect();
+            result.set_item(PyBytes::new_bound(py, &md5), locations)?;
+        }
+        Ok(result)
+    }
+
     fn add_rolling(&mut self, py: Python<'_>, rolling: u64) -> PyResult<()> {
-        self.load_rolling_lazy().map_err(|e| map_db_error(py, e))?;
         if !self.in_transaction {
             return Err(PyAssertionError::new_err(
                 "Tried to add a rolling cs outside of a transaction",
             ));
         }
-        if !self.all_rolling.contains(&rolling) {
-            self.all_rolling.insert(rolling);
+        if !self.has_rolling(rolling) {
+            self.insert_rolling(rolling).map_err(|e| map_db_error(py, e))?;
             self.is_modified = true;
             self.db.add_rolling(rolling).map_err(|e| map_db_error(py, e))?;
         }
@@ -356,6 +605,47 @@ impl BlocksDB {
         self.db.delete_blocks(&blobs).map_err(|e| map_db_error(py, e))
     }
 
+    fn add_chunk(
+        &mut self,
+        py: Python<'_>,
+        blob: &[u8],
+        offset: u64,
+        size: u64,
+        md5: &[u8],
+    ) -> PyResult<()> {
+        if !self.in_transaction {
+            return Err(PyAssertionError::new_err(
+                "Tried to add a chunk outside of a transaction",
+            ));
+        }
+        self.db
+            .add_chunk(blob, offset, size, md5)
+            .map_err(|e| map_db_error(py, e))?;
+        self.is_modified = true;
+        Ok(())
+    }
+
+    /// Returns a dict mapping the given chunk md5 sums (lowercase hex
+    /// bytes) that are known to a (blob, offset, size) location.
+    fn get_many_chunk_locations<'py>(
+        &self,
+        py: Python<'py>,
+        md5s: Vec<Vec<u8>>,
+    ) -> PyResult<Bound<'py, PyDict>> {
+        let locs = self
+            .db
+            .get_many_chunk_locations(&md5s)
+            .map_err(|e| map_db_error(py, e))?;
+        let result = PyDict::new_bound(py);
+        for (md5, (blob, offset, size)) in locs {
+            result.set_item(
+                PyBytes::new_bound(py, &md5),
+                (PyBytes::new_bound(py, &blob), offset, size),
+            )?;
+        }
+        Ok(result)
+    }
+
     fn add_block(&mut self, py: Python<'_>, blob: &[u8], offset: u64, md5: &[u8]) -> PyResult<()> {
         if !self.in_transaction {
             return Err(PyAssertionError::new_err(
@@ -369,18 +659,41 @@ impl BlocksDB {
         Ok(())
     }
 
+    /// Adds every (blob, offset, rolling, md5) block from the given
+    /// iterable, just like add_block() followed by add_rolling() for each
+    /// of them, but much faster for a large number of blocks. The blocks
+    /// are inserted in batches, with a prepared statement. When more
+    /// blocks are added than the table already contained, the md5 index is
+    /// dropped, and rebuilt once all the blocks are added.
+    fn add_blocks(&mut self, py: Python<'_>, blocks: &Bound<'_, PyAny>) -> PyResult<()> {
+        if !self.in_transaction {
+            return Err(PyAssertionError::new_err(
+                "Tried to add blocks outside of a transaction",
+            ));
+        }
+        let mut index_dropped = false;
+        let result = self.insert_blocks_batched(py, blocks, &mut index_dropped);
+        if index_dropped {
+            // Rebuild the index even if inserting failed. The error may
+            // be caught and the transaction committed anyway, and the
+            // database must never be left without the md5 index.
+            let rebuilt = self
+                .db
+                .create_block_md5_index()
+                .map_err(|e| map_db_error(py, e));
+            return result.and(rebuilt);
+        }
+        result
+    }
+
     fn begin(&mut self, py: Python<'_>) -> PyResult<()> {
-        self.load_rolling_lazy().map_err(|e| map_db_error(py, e))?;
         if self.in_transaction {
             return Err(PyAssertionError::new_err(
                 "Tried to start a transaction while one was already in progress",
             ));
         }
         self.db.begin().map_err(|e| map_db_error(py, e))?;
-        let current = self.db.get_modcount().map_err(|e| map_db_error(py, e))?;
-        if self.last_seen_modcount != current {
-            self.reload_rolling().map_err(|e| map_db_error(py, e))?;
-        }
+        self.open_rolling_table().map_err(|e| map_db_error(py, e))?;
         self.in_transaction = true;
         Ok(())
     }
@@ -398,8 +711,14 @@ impl BlocksDB {
                 .map_err(|e| map_db_error(py, e))?;
             self.is_modified = false;
         }
-        self.last_seen_modcount = self.db.get_modcount().map_err(|e| map_db_error(py, e))?;
-        self.db.commit().map_err(|e| map_db_error(py, e))
+        let modcount = self.db.get_modcount().map_err(|e| map_db_error(py, e))?;
+        self.db.commit().map_err(|e| map_db_error(py, e))?;
+        // Only now is the rolling set known to match the database.
+        if let Some(table) = self.rolling_table.as_mut() {
+            table.set_modcount(modcount);
+            table.flush().map_err(|e| map_db_error(py, rolling_error(e)))?;
+        }
+        Ok(())
     }
 
     fn get_block_size(&self, py: Python<'_>) -> PyResult<i64> {
@@ -417,6 +736,7 @@ fn rdedup(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_class::<IntegerSet>()?;
     m.add_class::<RollingChecksum>()?;
     m.add_class::<BlocksDB>()?;
+    m.add_class::<ChunkFinder>()?;
     m.add_function(wrap_pyfunction!(calc_rolling, m)?)?;
 
     // Re-export SoftCorruptionError, mirroring cdedup's namespace.
@@ -0,0 +1,503 @@
+// Copyright 2013 Mats Ekberg
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//   http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+//! A persistent, memory-mapped set of rolling checksums.
+//!
+//! Before this existed, every new session loaded the whole `rolling` table
+//! of the blocks database into an `IntSet`, which costs time and memory in
+//! proportion to every block ever stored. The set below lives in a file
+//! next to the blocks database and is mapped into memory, so opening it is
+//! O(1) and only the pages that the scan actually touches are read.
+//!
+//! The file is an open-addressing hash table of `u64` slots with linear
+//! probing. An empty slot is 0, so the value 0 is recorded by a header
+//! flag instead. The table is kept at most half full, so a miss (the
+//! common case in the per-byte scan) usually costs a single load.
+//!
+//! Layout (all integers little-endian):
+//!
+//! | offset | size | field                                   |
+//! | ------ | ---- | --------------------------------------- |
+//! | 0      | 8    | magic `BRLSET01`                        |
+//! | 8      | 8    | blocks database modcount (-1 = dirty)   |
+//! | 16     | 4    | log2 of the slot count                  |
+//! | 20     | 4    | reserved                                |
+//! | 24     | 8    | number of values                        |
+//! | 32     | 8    | 1 if the value 0 is a member            |
+//! | 40     | 24   | reserved                                |
+//! | 64     | 8*n  | slots                                   |
+//!
+//! The modcount ties the file to the state of the blocks database it was
+//! built from. Only the blocks database writer (which holds the repository
+//! lock) modifies the file. It marks the file dirty before changing it and
+//! stamps the new modcount after the database commit, so a reader that
+//! finds a mismatching modcount knows not to trust the file.
+
+use std::fs::{self, OpenOptions};
+use std::io::{self, Write};
+
+use crate::intset::RollingLookup;
+
+const MAGIC: &[u8; 8] = b"BRLSET01";
+const HEADER_SIZE: usize = 64;
+const MIN_LOG2_CAPACITY: u32 = 16;
+
+/// The modcount stored while the file is being modified.
+pub const DIRTY_MODCOUNT: i64 = -1;
+
+#[cfg(unix)]
+mod mapping {
+    use std::fs::File;
+    use std::io;
+    use std::os::unix::io::AsRawFd;
+    use std::ptr;
+
+    /// A shared memory mapping of a whole file.
+    pub struct Mapping {
+        ptr: *mut u8,
+        len: usize,
+    }
+
+    // SAFETY: the mapping is plain memory. Writable mappings are only
+    // modified through `&mut self`, so the usual borrow rules apply.
+    unsafe impl Send for Mapping {}
+    unsafe impl Sync for Mapping {}
+
+    impl Mapping {
+        pub fn map(file: &File, len: usize, writable: bool) -> io::Result<Mapping> {
+            let prot = if writable {
+                libc::PROT_READ | libc::PROT_WRITE
+            } else {
+                libc::PROT_READ
+            };
+            // SAFETY: a fresh mapping of a file we hold open, checked below.
+            let ptr = unsafe {
+                libc::mmap(ptr::null_mut(), len, prot, libc::MAP_SHARED, file.as_raw_fd(), 0)
+            };
+            if ptr == libc::MAP_FAILED {
+                return Err(io::Error::last_os_error());
+            }
+            Ok(Mapping { ptr: ptr as *mut u8, len })
+        }
+
+        #[inline]
+        pub fn as_ptr(&self) -> *const u8 {
+            self.ptr
+        }
+
+        #[inline]
+        pub fn as_mut_ptr(&mut self) -> *mut u8 {
+            self.ptr
+        }
+
+        #[allow(dead_code)] // used by debug assertions
+        pub fn len(&self) -> usize {
+            self.len
+        }
+
+        pub fn flush(&mut self) -> io::Result<()> {
+            // SAFETY: ptr/len describe a live mapping.
+            if unsafe { libc::msync(self.ptr as *mut libc::c_void, self.len, libc::MS_SYNC) } != 0 {
+                return Err(io::Error::last_os_error());
+            }
+            Ok(())
+        }
+    }
+
+    impl Drop for Mapping {
+        fn drop(&mut self) {
+            // SAFETY: ptr/len describe a live mapping that is not used again.
+            unsafe {
+                libc::munmap(self.ptr as *mut libc::c_void, self.len);
+            }
+        }
+    }
+}
+
+#[cfg(not(unix))]
+mod mapping {
+    use std::fs::File;
+    use std::io::{self, Read, Seek, SeekFrom, Write};
+
+    /// Fallback for platforms without mmap: the file is read into memory,
+    /// and written back in full on flush() if it is writable.
+    pub struct Mapping {
+        data: Vec<u8>,
+        file: Option<File>,
+    }
+
+    impl Mapping {
+        pub fn map(file: &File, len: usize, writable: bool) -> io::Result<Mapping> {
+            let mut data = Vec::with_capacity(len);
+            let mut reader = file.try_clone()?;
+            reader.seek(SeekFrom::Start(0))?;
+            reader.take(len as u64).read_to_end(&mut data)?;
+            if data.len() != len {
+                return Err(io::Error::new(io::ErrorKind::UnexpectedEof, "rolling set file truncated"));
+            }
+            let file = if writable { Some(file.try_clone()?) } else { None };
+            Ok(Mapping { data, file })
+        }
+
+        #[inline]
+        pub fn as_ptr(&self) -> *const u8 {
+            self.data.as_ptr()
+        }
+
+        #[inline]
+        pub fn as_mut_ptr(&mut self) -> *mut u8 {
+            self.data.as_mut_ptr()
+        }
+
+        #[allow(dead_code)] // used by debug assertions
+        pub fn len(&self) -> usize {
+            self.data.len()
+        }
+
+        pub fn flush(&mut self) -> io::Result<()> {
+            if let Some(file) = self.file.as_mut() {
+                file.seek(SeekFrom::Start(0))?;
+                file.write_all(&self.data)?;
+                file.sync_all()?;
+            }
+            Ok(())
+        }
+    }
+}
+
+use mapping::Mapping;
+
+#[inline]
+fn round_up_log2(n: u64) -> u32 {
+    let mut log2 = MIN_LOG2_CAPACITY;
+    while (1u64 << log2) < n {
+        log2 += 1;
+    }
+    log2
+}
+
+/// The slot count used for a table holding `count` values: between two
+/// and four times the count, so that the table can grow for a while
+/// before it has to be rebuilt.
+fn log2_capacity_for(count: u64) -> u32 {
+    round_up_log2(count.saturating_mul(4))
+}
+
+pub struct RollingTable {
+    map: Mapping,
+    slot_mask: u64,
+    shift: u32,
+    writable: bool,
+}
+
+impl RollingTable {
+    /// Open an existing set file. Returns `Ok(None)` if the file does not
+    /// exist or is not a valid set file.
+    pub fn open(path: &str, writable: bool) -> io::Result<Option<RollingTable>> {
+        let file = match OpenOptions::new().read(true).write(writable).open(path) {
+            Ok(f) => f,
+            Err(e) if e.kind() == io::ErrorKind::NotFound => return Ok(None),
+            Err(e) => return Err(e),
+        };
+        let file_len = file.metadata()?.len();
+        if file_len < HEADER_SIZE as u64 {
+            return Ok(None);
+        }
+        let map = Mapping::map(&file, file_len as usize, writable)?;
+        let table = RollingTable::from_mapping(map, writable);
+        if table.is_valid(file_len) {
+            Ok(Some(table))
+        } else {
+            Ok(None)
+        }
+    }
+
+    /// Create a new set file at `path` containing the given values,
+    /// stamped with `modcount`. The file is written under a temporary
+    /// name and then renamed into place, so readers never see a half
+    /// written set.
+    pub fn create<I: IntoIterator<Item = u64>>(
+        path: &str,
+        values: I,
+        count_hint: u64,
+        modcount: i64,
+    ) -> io::Result<()> {
+        let log2 = log2_capacity_for(count_hint);
+        let tmp_path = format!("{}.tmp", path);
+        {
+            let mut file = OpenOptions::new()
+                .read(true)
+                .write(true)
+                .create(true)
+                .truncate(true)
+                .open(&tmp_path)?;
+            let mut header = [0u8; HEADER_SIZE];
+            header[0..8].copy_from_slice(MAGIC);
+            header[8..16].copy_from_slice(&DIRTY_MODCOUNT.to_le_bytes());
+            header[16..20].copy_from_slice(&log2.to_le_bytes());
+            file.write_all(&header)?;
+            // Zero filled (and sparse where supported).
+            let len = HEADER_SIZE as u64 + (8u64 << log2);
+            file.set_len(len)?;
+            let map = Mapping::map(&file, len as usize, true)?;
+            let mut table = RollingTable::from_mapping(map, true);
+            for value in values {
+                if !table.contains(value) {
+                    if table.needs_grow() {
+                        return Err(io::Error::new(
+                            io::ErrorKind::InvalidInput,
+                            "rolling set count hint too small",
+                        ));
+                    }
+                    table.insert(value);
+                }
+            }
+            table.set_modcount(modcount);
+            table.flush()?;
+        }
+        fs::rename(&tmp_path, path)
+    }
+
+    fn from_mapping(map: Mapping, writable: bool) -> RollingTable {
+        let mut table = RollingTable { map, slot_mask: 0, shift: 64, writable };
+        let log2 = table.log2_capacity();
+        if log2 >= MIN_LOG2_CAPACITY && log2 < 64 {
+            table.slot_mask = (1u64 << log2) - 1;
+            table.shift = 64 - log2;
+        }
+        table
+    }
+
+    fn is_valid(&self, file_len: u64) -> bool {
+        let log2 = self.log2_capacity();
+        // SAFETY: the mapping is at least HEADER_SIZE bytes.
+        let magic = unsafe { std::slice::from_raw_parts(self.map.as_ptr(), 8) };
+        magic == MAGIC
+            && log2 >= MIN_LOG2_CAPACITY
+            && log2 < 48
+            && file_len == HEADER_SIZE as u64 + (8u64 << log2)
+    }
+
+    #[inline]
+    fn read_u64(&self, offset: usize) -> u64 {
+        debug_assert!(offset + 8 <= self.map.len());
+        // SAFETY: callers only pass offsets inside the header or slot array,
+        // which is_valid() has checked against the mapping size.
+        u64::from_le(unsafe { std::ptr::read_unaligned(self.map.as_ptr().add(offset) as *const u64) })
+    }
+
+    #[inline]
+    fn write_u64(&mut self, offset: usize, value: u64) {
+        assert!(self.writable, "rolling set is read-only");
+        debug_assert!(offset + 8 <= self.map.len());
+        // SAFETY: as for read_u64, and the mapping is writable.
+        unsafe {
+            std::ptr::write_unaligned(self.map.as_mut_ptr().add(offset) as *mut u64, value.to_le())
+        }
+    }
+
+    fn log2_capacity(&self) -> u32 {
+        // SAFETY: the mapping is at least HEADER_SIZE bytes.
+        let bytes = unsafe { std::slice::from_raw_parts(self.map.as_ptr().add(16), 4) };
+        u32::from_le_bytes([bytes[0], bytes[1], bytes[2], bytes[3]])
+    }
+
+    pub fn modcount(&self) -> i64 {
+        self.read_u64(8) as i64
+    }
+
+    pub fn set_modcount(&mut self, modcount: i64) {
+        self.write_u64(8, modcount as u64);
+    }
+
+    pub fn len(&self) -> u64 {
+        self.read_u64(24)
+    }
+
+    fn has_zero(&self) -> bool {
+        self.read_u64(32) != 0
+    }
+
+    fn capacity(&self) -> u64 {
+        self.slot_mask + 1
+    }
+
+    /// True if inserting one more value would make the table more than
+    /// half full. The owner must then rebuild it with `create()`.
+    pub fn needs_grow(&self) -> bool {
+        (self.len() + 1) * 2 > self.capacity()
+    }
+
+    #[inline]
+    fn home_slot(&self, value: u64) -> u64 {
+        // Fibonacci hashing: the rolling digest keeps most of its entropy
+        // in the low bits, so spread it before picking a slot.
+        value.wrapping_mul(0x9E37_79B9_7F4A_7C15) >> self.shift
+    }
+
+    #[inline]
+    pub fn contains(&self, value: u64) -> bool {
+        if value == 0 {
+            return self.has_zero();
+        }
+        let mut slot = self.home_slot(value);
+        loop {
+            let stored = self.read_u64(HEADER_SIZE + 8 * slot as usize);
+            if stored == value {
+                return true;
+            }
+            if stored == 0 {
+                return false;
+            }
+            slot = (slot + 1) & self.slot_mask;
+        }
+    }
+
+    /// Add a value that is not already a member. The caller must have
+    /// checked `needs_grow()` first.
+    pub fn insert(&mut self, value: u64) {
+        debug_assert!(!self.contains(value));
+        assert!(!self.needs_grow(), "rolling set is full");
+        if value == 0 {
+            self.write_u64(32, 1);
+        } else {
+            let mut slot = self.home_slot(value);
+            while self.read_u64(HEADER_SIZE + 8 * slot as usize) != 0 {
+                slot = (slot + 1) & self.slot_mask;
+            }
+            self.write_u64(HEADER_SIZE + 8 * slot as usize, value);
+        }
+        let count = self.len() + 1;
+        self.write_u64(24, count);
+    }
+
+    /// All values in the set, in no particular order.
+    pub fn values(&self) -> impl Iterator<Item = u64> + '_ {
+        let zero = if self.has_zero() { Some(0u64) } else { None };
+        zero.into_iter().chain(
+            (0..self.capacity())
+                .map(move |slot| self.read_u64(HEADER_SIZE + 8 * slot as usize))
+                .filter(|&v| v != 0),
+        )
+    }
+
+    pub fn flush(&mut self) -> io::Result<()> {
+        self.map.flush()
+    }
+
+    /// Rebuild this table with room to grow, and reopen it.
+    pub fn grow(self, path: &str) -> io::Result<RollingTable> {
+        let modcount = self.modcount();
+        let count = self.len() + 1;
+        let values: Vec<u64> = self.values().collect();
+        drop(self);
+        RollingTable::create(path, values, count, modcount)?;
+        RollingTable::open(path, true)?
+            .ok_or_else(|| io::Error::new(io::ErrorKind::InvalidData, "rebuilt rolling set is invalid"))
+    }
+}
+
+impl RollingLookup for RollingTable {
+    #[inline]
+    fn lookup(&self, value: u64) -> bool {
+        self.contains(value)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn tmp_path(name: &str) -> String {
+        let dir = std::env::temp_dir().join(format!("rdedup_rollset_{}_{}", name, std::process::id()));
+        let _ = fs::create_dir_all(&dir);
+        dir.join("blocks.db-rolling").to_string_lossy().into_owned()
+    }
+
+    #[test]
+    fn missing_file_is_none() {
+        let path = tmp_path("missing");
+        let _ = fs::remove_file(&path);
+        assert!(RollingTable::open(&path, false).unwrap().is_none());
+    }
+
+    #[test]
+    fn create_and_lookup() {
+        let path = tmp_path("create");
+        RollingTable::create(&path, vec![0, 17, u64::MAX, 17], 3, 42).unwrap();
+        let table = RollingTable::open(&path, false).unwrap().unwrap();
+        assert_eq!(table.modcount(), 42);
+        assert_eq!(table.len(), 3);
+        assert!(table.contains(0));
+        assert!(table.contains(17));
+        assert!(table.contains(u64::MAX));
+        assert!(!table.contains(18));
+        let mut values: Vec<u64> = table.values().collect();
+        values.sort();
+        assert_eq!(values, vec![0, 17, u64::MAX]);
+    }
+
+    #[test]
+    fn insert_and_grow() {
+        let path = tmp_path("grow");
+        RollingTable::create(&path, Vec::new(), 0, 0).unwrap();
+        let mut table = RollingTable::open(&path, true).unwrap().unwrap();
+        let values: Vec<u64> = (1..200_000u64).map(|i| i.wrapping_mul(2654435761)).collect();
+        for &v in &values {
+            if table.contains(v) {
+                continue;
+            }
+            if table.needs_grow() {
+                table = table.grow(&path).unwrap();
+            }
+            table.insert(v);
+        }
+        table.set_modcount(7);
+        table.flush().unwrap();
+        drop(table);
+        let table = RollingTable::open(&path, false).unwrap().unwrap();
+        assert_eq!(table.modcount(), 7);
+        for &v in &values {
+            assert!(table.contains(v), "missing value {}", v);
+        }
+        assert!(!table.contains(0));
+    }
+
+    #[test]
+    fn interrupted_writer_leaves_table_dirty() {
+        // What a writer that is killed between begin() and commit()
+        // leaves behind: the dirty mark, and values that were never
+        // committed. The table must not be taken to match modcount 5.
+        let path = tmp_path("dirty");
+        RollingTable::create(&path, vec![17], 1, 5).unwrap();
+        let mut table = RollingTable::open(&path, true).unwrap().unwrap();
+        table.set_modcount(DIRTY_MODCOUNT);
+        table.flush().unwrap();
+        table.insert(4711);
+        // Growing in the middle of the transaction keeps the mark
+        let table = table.grow(&path).unwrap();
+        drop(table);
+        let table = RollingTable::open(&path, false).unwrap().unwrap();
+        assert_eq!(table.modcount(), DIRTY_MODCOUNT);
+        assert!(table.contains(17));
+        assert!(table.contains(4711));
+    }
+
+    #[test]
+    fn garbage_is_rejected() {
+        let path = tmp_path("garbage");
+        fs::write(&path, vec![b'X'; 100_000]).unwrap();
+        assert!(RollingTable::open(&path, false).unwrap().is_none());
+    }
+}
@@ -24,7 +24,7 @@
 //! semantics exactly. The 64-bit digest is `(s2 << 32) | s1`, identical
 //! to `RollsumDigest64` in the original header.
 
-use crate::intset::IntSet;
+use crate::intset::RollingLookup;
 
 const ROLLSUM_CHAR_OFFSET: u64 = 31;
 
@@ -116,6 +116,8 @@ impl RollingState {
     /// The hot path: feed `buf[from..]` byte-by-byte, returning the first
     /// position (with at least `window` bytes fed) whose rolling digest is in
     /// `intset`, or `None` if the whole slice is consumed without a hit.
+    /// The lookup is generic so that each kind of set gets its own inlined
+    /// copy of the loop.
     ///
     /// `feeded` is the running total of bytes ever fed (across chunks) and is
     /// advanced as bytes are consumed. The accumulator and window state are
@@ -123,13 +125,13 @@ impl RollingState {
     /// optimiser can keep them in registers — this is what closes the gap with
     /// the fully-inlined C inner loop.
     #[inline]
-    pub fn scan(
+    pub fn scan<S: RollingLookup + ?Sized>(
         &mut self,
         buf: &[u8],
         from: usize,
         window: u64,
         feeded: &mut u64,
-        intset: &IntSet,
+        intset: &S,
     ) -> Option<ScanHit> {
         let mut s1 = self.s1;
         let mut s2 = self.s2;
@@ -170,7 +172,7 @@ impl RollingState {
             fed += 1;
             if fed >= window {
                 let rolling = (s2 << 32) | s1;
-                if intset.contains(rolling) {
+                if intset.lookup(rolling) {
                     result = Some(ScanHit {
                         offset: fed - window,
                         rolling,
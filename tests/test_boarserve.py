@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, shutil, tempfile, socket, threading, io
+
+TMPDIR=tempfile.gettempdir()
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobrepo import repository
+import boarserve, client
+from front import Front, add_file_simple, front_supports, iter_session_bloblist
+from common import md5sum
+from jsonrpc import WireCompression, FileDataSource
+
+class TestSharedRepoServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="boar_test_boarserve_", dir=TMPDIR)
+        self.repopath = os.path.join(self.tmp, "repo")
+        repository.create_repository(self.repopath)
+        fr = Front(repository.Repo(self.repopath))
+        fr.mksession("S")
+        fr.create_session("S", base_session = fr.find_last_revision("S"))
+        add_file_simple(fr, "a.txt", "a")
+        self.rev = fr.commit("S")
+        self.shared_repo = repository.Repo(self.repopath)
+        self.connections = []
+
+    def tearDown(self):
+        for sock, thread in self.connections:
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+            thread.join()
+        shutil.rmtree(self.tmp, ignore_errors = True)
+
+    def connect(self, compression = None):
+        client_sock, server_sock = socket.socketpair()
+        server = boarserve.SharedRepoBoarServer(self.shared_repo,
+                                                server_sock.makefile(mode="rb"),
+                                                server_sock.makefile(mode="wb"))
+        def serve():
+            try:
+                server.serve()
+            except Exception:
+                pass # The client hung up
+            finally:
+                server_sock.close()
+        thread = threading.Thread(target = serve)
+        thread.start()
+        self.connections.append((client_sock, thread))
+        proxy = client.create_boar_proxy(client_sock.makefile(mode="wb"),
+                                         client_sock.makefile(mode="rb"), compression)
+        return server, client.get_remote_front(proxy)
+
+    def testReadersShareRepo(self):
+        server1, front1 = self.connect()
+        server2, front2 = self.connect()
+        self.assertEqual(front1.find_last_revision("S"), self.rev)
+        self.assertEqual([b['filename'] for b in front2.get_session_bloblist(self.rev)], ["a.txt"])
+        self.assertEqual(front2.get_blob(md5sum(b"a")).read(), b"a")
+        self.assertEqual(server1.repo, None)
+        self.assertEqual(server2.repo, None)
+        self.assertTrue(self.rev in self.shared_repo.session_readers)
+
+    def testWriterGetsPrivateRepo(self):
+        server, fr = self.connect()
+        self.assertEqual(fr.find_last_revision("S"), self.rev)
+        fr.create_session("S", self.rev)
+        self.assertTrue(server.repo)
+        self.assertTrue(server.repo is not self.shared_repo)
+        fr.remove("a.txt")
+        rev = fr.commit("S")
+        # Other clients see the new snapshot through the shared repo
+        server2, front2 = self.connect()
+        self.assertEqual(front2.find_last_revision("S"), rev)
+        self.assertEqual(front2.get_session_bloblist(rev), [])
+        self.assertEqual(server2.repo, None)
+
+    def testCompression(self):
+        server, fr = self.connect(WireCompression("zlib:1"))
+        fr.create_session("S", self.rev)
+        self.assertEqual(server.server.compression.get_spec(), "zlib:1")
+        data = b"compressible text\n" * 100000
+        fr.add_blobs_streamed(blobs = [[md5sum(data), len(data)]],
+                              datasource = FileDataSource(io.BytesIO(data), len(data)))
+        fr.add_bloblist_entries([{'filename': "b%s.txt" % n, 'md5sum': md5sum(data), 'size': len(data),
+                                  'mtime': 1000, 'ctime': 1000} for n in range(1000)])
+        rev = fr.commit("S")
+        self.assertEqual(len(fr.get_session_bloblist(rev)), 1001)
+        self.assertEqual(fr.get_blob(md5sum(data)).read(), data)
+
+    def testSharedRepoIsNotSerialized(self):
+        server, fr = self.connect()
+        result = []
+        # A call that has to sync the session index must not stop
+        # other clients from reading blobs.
+        with self.shared_repo.session_index_lock:
+            thread = threading.Thread(target = lambda: result.append(fr.get_blob(md5sum(b"a")).read()))
+            thread.start()
+            thread.join(10)
+            self.assertEqual(result, [b"a"])
+
+    def testConcurrentReaders(self):
+        fronts = [self.connect()[1] for n in range(4)]
+        errors = []
+        def read(fr):
+            try:
+                for n in range(20):
+                    self.shared_repo.forget_session_reader()
+                    assert fr.find_last_revision("S") == self.rev
+                    assert [b['filename'] for b in fr.get_session_bloblist(self.rev)] == ["a.txt"]
+                    assert fr.get_blobs([md5sum(b"a")] * 3).read() == b"aaa"
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target = read, args = (fr,)) for fr in fronts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def testCapabilities(self):
+        server, fr = self.connect()
+        self.assertTrue(front_supports(fr, "has_blobs"))
+        self.assertFalse(front_supports(fr, "no_such_method"))
+        fr.capabilities = None # As reported by an old server
+        self.assertFalse(front_supports(fr, "has_blobs"))
+        self.assertTrue(front_supports(Front(self.shared_repo), "has_blobs"))
+
+    def testBloblistStream(self):
+        server, fr = self.connect()
+        self.assertEqual([b['filename'] for b in iter_session_bloblist(fr, self.rev)], ["a.txt"])
+        fr.capabilities = None # An old server, without the stream
+        self.assertEqual([b['filename'] for b in iter_session_bloblist(fr, self.rev)], ["a.txt"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,21 +15,24 @@
 # limitations under the License.
 
 """
-Tests for ChecksumCache, specifically verifying that row checksums
-are calculated compatible with Python 2.7's float-to-string behavior.
+Tests for ChecksumCache, specifically verifying that old style cache
+entries with row checksums calculated by Python 2.7's float-to-string
+behavior are still accepted.
 
 Python 2.7's str(float) uses 12 significant digits (like '%.12g')
 while Python 3's str(float) uses full precision. Old workdir caches
 created with Python 2.7 must remain readable by modern Python.
 """
 
-import sys, os, unittest, sqlite3, hashlib
+import sys, os, unittest, sqlite3, hashlib, tempfile, shutil
+from unittest import mock
 
 if __name__ == '__main__':
     sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import workdir
 from workdir import ChecksumCache
-from common import md5sum
+from common import md5sum, walk_tree
 
 
 def python27_row_md5(path, mtime, md5):
@@ -45,48 +48,113 @@ def python27_row_md5(path, mtime, md5):
     return md5sum(path.encode("utf8") + b"!" + s.encode("utf8") + b"!" + md5.encode("utf8"))
 
 
-class TestChecksumCachePy27Compat(unittest.TestCase):
-    """Verify that ChecksumCache produces and accepts checksums
-    compatible with Python 2.7's float formatting."""
+class FakeStat(object):
+    def __init__(self, mtime, size = 100, inode = 4711, ctime_ns = 1234567890000000000):
+        self.st_mtime = mtime
+        self.st_mtime_ns = int(mtime * 10**9)
+        self.st_size = size
+        self.st_ino = inode
+        self.st_ctime_ns = ctime_ns
 
-    def test_cache_set_get_with_precise_mtime(self):
-        """A cache entry with a high-precision mtime (more than 12
-        significant digits) must round-trip correctly through set/get."""
+
+class LegacyCacheHelper(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix = "boar_test_ccache_")
+        self.dbpath = os.path.join(self.tmpdir, "ccache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors = True)
+
+    def write_legacy_rows(self, rows):
+        """Creates a cache database in the format used before the stat
+        based cache, containing the given (path, mtime, md5, row_md5)
+        rows."""
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute("CREATE TABLE IF NOT EXISTS ccache (path text, mtime unsigned int, md5 char(32), row_md5 char(32))")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ccache_index ON ccache (path, mtime)")
+        for row in rows:
+            conn.execute("REPLACE INTO ccache (path, mtime, md5, row_md5) VALUES (?, ?, ?, ?)", row)
+        conn.commit()
+        conn.close()
+
+
+class TestChecksumCache(LegacyCacheHelper, unittest.TestCase):
+    def test_cache_set_get(self):
         cache = ChecksumCache(":memory:")
         path = "some/file.txt"
-        mtime = 1234567890.123456  # 16 sig digits - differs between py2/py3
+        stat = FakeStat(1234567890.123456)
         md5 = "d41d8cd98f00b204e9800998ecf8427e"
-        cache.set(path, mtime, md5)
-        result = cache.get(path, mtime)
-        self.assertEqual(result, md5)
-
-    def test_cache_accepts_python27_checksums(self):
-        """A cache database written by Python 2.7 must be readable.
+        cache.set(path, stat, md5)
+        self.assertEqual(cache.get(path, stat), md5)
 
-        We simulate this by directly inserting a row with a checksum
-        computed using Python 2.7's str(float) formatting."""
+    def test_changed_stat_is_a_miss(self):
         cache = ChecksumCache(":memory:")
         path = "some/file.txt"
-        mtime = 1234567890.123456
         md5 = "d41d8cd98f00b204e9800998ecf8427e"
+        cache.set(path, FakeStat(1234567890.5), md5)
+        self.assertEqual(cache.get(path, FakeStat(1234567890.5)), md5)
+        self.assertEqual(cache.get(path, FakeStat(1234567890.6)), None)
+        self.assertEqual(cache.get(path, FakeStat(1234567890.5, size = 101)), None)
+        self.assertEqual(cache.get(path, FakeStat(1234567890.5, inode = 4712)), None)
+        self.assertEqual(cache.get(path, FakeStat(1234567890.5, ctime_ns = 1)), None)
+        self.assertEqual(cache.get("other/file.txt", FakeStat(1234567890.5)), None)
+
+    def test_walk_tree_stat_matches(self):
+        # Entries are stored with the result of os.stat(), but looked
+        # up with the stat results from walk_tree().
+        with open(os.path.join(self.tmpdir, "file.txt"), "wb") as f:
+            f.write(b"data")
+        md5 = md5sum(b"data")
+        cache = ChecksumCache(":memory:")
+        cache.set("file.txt", os.stat(os.path.join(self.tmpdir, "file.txt")), md5)
+        stats = dict(walk_tree(self.tmpdir, sep = "/"))
+        self.assertEqual(cache.get("file.txt", stats["file.txt"]), md5)
 
-        # Compute row checksum the way Python 2.7 would have
-        row_md5 = python27_row_md5(path, mtime, md5)
+    def test_windows_scandir_inode(self):
+        # os.scandir() on Windows does not give the inode number
+        cache = ChecksumCache(":memory:")
+        md5 = "d41d8cd98f00b204e9800998ecf8427e"
+        with mock.patch.object(workdir.os, "name", "nt"):
+            cache.set("file.txt", FakeStat(1609459200.5), md5)
+            self.assertEqual(cache.get("file.txt", FakeStat(1609459200.5, inode = 0)), md5)
 
-        # Directly insert the row as if Python 2.7 had written it
-        cache.conn.execute(
-            "REPLACE INTO ccache (path, mtime, md5, row_md5) VALUES (?, ?, ?, ?)",
-            (path, mtime, md5, row_md5)
-        )
+    def test_entries_are_persistent(self):
+        md5 = "d41d8cd98f00b204e9800998ecf8427e"
+        cache = ChecksumCache(self.dbpath)
+        cache.set("file.txt", FakeStat(1609459200.123456), md5)
+        cache.sync()
+        cache.conn.close()
+        cache.conn = None
+        cache = ChecksumCache(self.dbpath)
+        self.assertEqual(cache.entries["file.txt"][1], md5)
+        self.assertEqual(cache.get("file.txt", FakeStat(1609459200.123456)), md5)
+
+    def test_corrupted_entry_detected(self):
+        cache = ChecksumCache(":memory:")
+        stat = FakeStat(1609459200.0)
+        cache.set("file.txt", stat, "d41d8cd98f00b204e9800998ecf8427e")
+        key, md5, row_md5 = cache.entries["file.txt"]
+        cache.entries["file.txt"] = (key, "abc123def456abc123def456abc123de", row_md5)
+        self.assertRaises(AssertionError, cache.get, "file.txt", stat)
 
+
+class TestChecksumCachePy27Compat(LegacyCacheHelper, unittest.TestCase):
+    """Verify that ChecksumCache accepts entries from old style caches
+    with checksums compatible with Python 2.7's float formatting."""
+
+    def test_cache_accepts_python27_checksums(self):
+        """A cache database written by Python 2.7 must be readable."""
+        path = "some/file.txt"
+        mtime = 1234567890.123456
+        md5 = "d41d8cd98f00b204e9800998ecf8427e"
+        self.write_legacy_rows([(path, mtime, md5, python27_row_md5(path, mtime, md5))])
+        cache = ChecksumCache(self.dbpath)
         # Reading it back must succeed (not raise "cache corrupted")
-        result = cache.get(path, mtime)
-        self.assertEqual(result, md5)
+        self.assertEqual(cache.get(path, FakeStat(mtime)), md5)
 
     def test_cache_accepts_python27_checksums_various_mtimes(self):
         """Test several mtime values that produce different strings
         in Python 2.7 vs Python 3."""
-        cache = ChecksumCache(":memory:")
         md5 = "d41d8cd98f00b204e9800998ecf8427e"
 
         test_cases = [
@@ -97,46 +165,32 @@ class TestChecksumCachePy27Compat(unittest.TestCase):
             ("file5.txt", 1234567890.5),         # same in both
             ("file6.txt", 0.1),                  # same in both
         ]
-
+        self.write_legacy_rows([(path, mtime, md5, python27_row_md5(path, mtime, md5))
+                                for path, mtime in test_cases])
+        cache = ChecksumCache(self.dbpath)
         for path, mtime in test_cases:
-            row_md5 = python27_row_md5(path, mtime, md5)
-            cache.conn.execute(
-                "REPLACE INTO ccache (path, mtime, md5, row_md5) VALUES (?, ?, ?, ?)",
-                (path, mtime, md5, row_md5)
-            )
             with self.subTest(path=path, mtime=mtime):
-                result = cache.get(path, mtime)
+                result = cache.get(path, FakeStat(mtime))
                 self.assertEqual(result, md5,
                     f"Failed to read Python 2.7 cache entry for mtime={mtime}")
 
-    def test_newly_written_entries_readable(self):
-        """Entries written by the current code must also be readable."""
-        cache = ChecksumCache(":memory:")
-        path = "another/file.txt"
-        mtime = 1609459200.123456
-        md5 = "abc123def456abc123def456abc123de"
-        cache.set(path, mtime, md5)
-        result = cache.get(path, mtime)
-        self.assertEqual(result, md5)
-
-    def test_newly_written_entries_use_py27_format(self):
-        """New entries should use Python 2.7-compatible checksums so
-        that the cache format is consistent regardless of Python version."""
-        cache = ChecksumCache(":memory:")
+    def test_legacy_entries_are_migrated(self):
         path = "test/file.txt"
         mtime = 1234567890.123456
         md5 = "d41d8cd98f00b204e9800998ecf8427e"
-        cache.set(path, mtime, md5)
-
-        # Read back the raw row_md5 from the database
+        self.write_legacy_rows([(path, mtime, md5, python27_row_md5(path, mtime, md5)),
+                                ("unvisited.txt", mtime, md5, python27_row_md5("unvisited.txt", mtime, md5))])
+        cache = ChecksumCache(self.dbpath)
+        self.assertTrue(cache.has_legacy_table)
+        self.assertEqual(cache.get(path, FakeStat(mtime)), md5)
+        self.assertEqual(cache.get(path, FakeStat(mtime + 1.0)), None)
+        cache.finish_migration()
+        self.assertFalse(cache.has_legacy_table)
+        self.assertEqual(cache.get(path, FakeStat(mtime)), md5)
+        self.assertEqual(cache.get("unvisited.txt", FakeStat(mtime)), None)
         c = cache.conn.cursor()
-        c.execute("SELECT row_md5 FROM ccache WHERE path = ? AND mtime = ?", (path, mtime))
-        stored_row_md5 = c.fetchone()[0]
-
-        # It should match the Python 2.7 computation
-        expected = python27_row_md5(path, mtime, md5)
-        self.assertEqual(stored_row_md5, expected,
-            "New cache entries should use Python 2.7-compatible row checksums")
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'ccache'")
+        self.assertEqual(c.fetchall(), [])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, shutil, tempfile
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client
+from boar_exceptions import UserError
+
+@unittest.skipUnless(os.name == "posix", "ssh connection sharing is only used on posix systems")
+class TestSshMultiplexing(unittest.TestCase):
+    def setUp(self):
+        self.saved_env = os.environ.get("BOAR_SSH_CONTROL_PERSIST")
+        self.saved_tempdir = tempfile.tempdir
+        self.tmp = tempfile.mkdtemp(prefix="boar_test_client_")
+        tempfile.tempdir = self.tmp
+        self.control_dir = os.path.join(self.tmp, "boar-ssh-%s" % os.getuid())
+
+    def tearDown(self):
+        tempfile.tempdir = self.saved_tempdir
+        if self.saved_env == None:
+            os.environ.pop("BOAR_SSH_CONTROL_PERSIST", None)
+        else:
+            os.environ["BOAR_SSH_CONTROL_PERSIST"] = self.saved_env
+        shutil.rmtree(self.tmp, ignore_errors = True)
+
+    def testOptions(self):
+        os.environ.pop("BOAR_SSH_CONTROL_PERSIST", None)
+        options = client.get_ssh_multiplexing_options("ssh")
+        self.assertTrue("ControlMaster=auto" in options)
+        self.assertTrue("ControlPersist=%s" % client.SSH_CONTROL_PERSIST in options)
+        self.assertTrue(os.path.join(self.control_dir, "%C") in options)
+        self.assertEqual(os.stat(self.control_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(client.get_ssh_multiplexing_options("plink.exe"), "")
+
+    def testEnvironment(self):
+        os.environ["BOAR_SSH_CONTROL_PERSIST"] = "17"
+        self.assertTrue("ControlPersist=17" in client.get_ssh_multiplexing_options("ssh"))
+        os.environ["BOAR_SSH_CONTROL_PERSIST"] = "0"
+        self.assertEqual(client.get_ssh_multiplexing_options("ssh"), "")
+        os.environ["BOAR_SSH_CONTROL_PERSIST"] = "forever"
+        self.assertRaises(UserError, client.get_ssh_multiplexing_options, "ssh")
+
+    def testUnsafeControlDir(self):
+        os.environ.pop("BOAR_SSH_CONTROL_PERSIST", None)
+        os.mkdir(self.control_dir)
+        os.chmod(self.control_dir, 0o777)
+        self.assertEqual(client.get_ssh_multiplexing_options("ssh"), "")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, shutil, tempfile, io
+
+TMPDIR=tempfile.gettempdir()
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobrepo import repository
+import front as front_module
+from front import Front, clone, add_file_simple, verify_repo
+from jsonrpc import ConcatDataSource, FileDataSource
+from common import md5sum, decode_bitmap
+
+class TestConcatDataSource(unittest.TestCase):
+    def testConcat(self):
+        parts = [b"abc", b"", b"defgh", b"", b"i"]
+        opened = []
+        def opener(data):
+            opened.append(data)
+            return FileDataSource(io.BytesIO(data), len(data))
+        source = ConcatDataSource([(len(p), lambda p = p: opener(p)) for p in parts])
+        self.assertEqual(source.bytes_left(), 9)
+        self.assertEqual(source.read(2), b"ab")
+        self.assertEqual(opened, [b"abc"])
+        self.assertEqual(source.read(4), b"cdef")
+        self.assertEqual(source.read(), b"ghi")
+        self.assertEqual(source.bytes_left(), 0)
+        self.assertEqual(source.read(), b"")
+
+    def testEmpty(self):
+        source = ConcatDataSource([])
+        self.assertEqual(source.bytes_left(), 0)
+        self.assertEqual(source.read(), b"")
+
+class TestClone(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="boar_test_clone_", dir=TMPDIR)
+        self.saved = front_module.CLONE_BATCH_SIZE, front_module.CLONE_BATCH_COUNT, \
+            front_module.CLONE_ENTRY_BATCH_COUNT
+        front_module.CLONE_BATCH_SIZE = 10
+        front_module.CLONE_BATCH_COUNT = 2
+        front_module.CLONE_ENTRY_BATCH_COUNT = 3
+
+    def tearDown(self):
+        front_module.CLONE_BATCH_SIZE, front_module.CLONE_BATCH_COUNT, \
+            front_module.CLONE_ENTRY_BATCH_COUNT = self.saved
+        shutil.rmtree(self.tmp, ignore_errors = True)
+
+    def testBatchedClone(self):
+        src_path = os.path.join(self.tmp, "src")
+        dst_path = os.path.join(self.tmp, "dst")
+        repository.create_repository(src_path)
+        src = Front(repository.Repo(src_path))
+        src.mksession("S")
+        contents = {}
+        src.create_session("S", base_session = src.find_last_revision("S"))
+        for n in range(7):
+            # Some identical contents, some blobs larger than a batch
+            contents["file%s.txt" % n] = ("content %s" % (n % 5)) * (n + 1)
+            add_file_simple(src, "file%s.txt" % n, contents["file%s.txt" % n])
+        add_file_simple(src, "empty.txt", "")
+        src.commit("S")
+        src.create_session("S", base_session = src.find_last_revision("S"))
+        src.remove("file0.txt")
+        add_file_simple(src, "new.txt", "new content")
+        src.commit("S")
+
+        repository.create_repository(dst_path)
+        dst = Front(repository.Repo(dst_path))
+        stats = clone(src, dst)
+        self.assertEqual(stats, {"reflinked": 0, "copied": 9})
+        self.assertEqual(dst.get_session_ids(), src.get_session_ids())
+        for rev in src.get_session_ids():
+            self.assertEqual(dst.get_session_fingerprint(rev), src.get_session_fingerprint(rev))
+        bloblist = dst.get_session_bloblist(dst.find_last_revision("S"))
+        self.assertEqual(sorted([b['filename'] for b in bloblist]),
+                         ["empty.txt", "file1.txt", "file2.txt", "file3.txt", "file4.txt",
+                          "file5.txt", "file6.txt", "new.txt"])
+        for b in bloblist:
+            self.assertEqual(b['md5sum'], md5sum(dst.get_blob(b['md5sum']).read()))
+        self.assertTrue(verify_repo(dst, verbose = False))
+
+    def testCloneFromOldServer(self):
+        class OldServerFront(object):
+            """Looks like a remote front of a server without any
+            optional methods."""
+            def __init__(self, realfront):
+                self.realfront = realfront
+                self.capabilities = {}
+            def __getattr__(self, name):
+                if name in ("has_blobs", "get_blobs", "add_blobs_streamed", "add_bloblist_entries"):
+                    raise AssertionError("Unsupported method called: " + name)
+                return getattr(self.realfront, name)
+
+        src_path = os.path.join(self.tmp, "src")
+        dst_path = os.path.join(self.tmp, "dst")
+        repository.create_repository(src_path)
+        src = Front(repository.Repo(src_path))
+        src.mksession("S")
+        src.create_session("S", base_session = src.find_last_revision("S"))
+        for n in range(5):
+            add_file_simple(src, "file%s.txt" % n, "content %s" % n)
+        src.commit("S")
+        src.create_session("S", base_session = src.find_last_revision("S"))
+        src.remove("file0.txt")
+        src.commit("S")
+
+        repository.create_repository(dst_path)
+        dst = Front(repository.Repo(dst_path))
+        stats = clone(OldServerFront(src), OldServerFront(dst))
+        self.assertEqual(stats, {"reflinked": 0, "copied": 5})
+        for rev in src.get_session_ids():
+            self.assertEqual(dst.get_session_fingerprint(rev), src.get_session_fingerprint(rev))
+        self.assertTrue(verify_repo(dst, verbose = False))
+
+    def testHasBlobs(self):
+        repository.create_repository(os.path.join(self.tmp, "repo"))
+        fr = Front(repository.Repo(os.path.join(self.tmp, "repo")))
+        fr.mksession("S")
+        fr.create_session("S", base_session = fr.find_last_revision("S"))
+        add_file_simple(fr, "a.txt", "a")
+        fr.commit("S")
+        fr.create_session("S", base_session = fr.find_last_revision("S"))
+        add_file_simple(fr, "b.txt", "b")
+        sums = [md5sum(b"a"), md5sum(b"b"), md5sum(b"c")]
+        self.assertEqual(decode_bitmap(fr.has_blobs(sums), 3), [True, True, False])
+        fr.cancel_snapshot()
+        self.assertEqual(decode_bitmap(fr.has_blobs(sums), 3), [True, False, False])
+        self.assertEqual(decode_bitmap(fr.has_blobs([]), 0), [])
+
+if __name__ == '__main__':
+    unittest.main()
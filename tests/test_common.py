@@ -138,6 +138,24 @@ class TestGetTree(unittest.TestCase):
                                      self.fullpath(u'räksmörgåsar' + os.sep + u'räksmörgås.txt')])
         self.assertTreeExists(tree)
 
+    def testWalkTreeStats(self):
+        self.addFile('test1.txt', b'a')
+        self.addFile('subdir/test2.txt', b'bb')
+        self.addFile(u'räksmörgåsar/deeper/räksmörgås.txt', b'ccc')
+
+        old_cwd = os.getcwd()
+        walked = dict(common.walk_tree(self.testdir, sep = "/", max_workers = 3))
+        self.assertEqual(os.getcwd(), old_cwd)
+        self.assertEqual(sorted(walked.keys()), [u'räksmörgåsar/deeper/räksmörgås.txt',
+                                                 u'subdir/test2.txt',
+                                                 u'test1.txt'])
+        self.assertEqual(walked[u'test1.txt'].st_size, 1)
+        self.assertEqual(walked[u'subdir/test2.txt'].st_size, 2)
+        self.assertEqual(walked[u'räksmörgåsar/deeper/räksmörgås.txt'].st_size, 3)
+
+    def testWalkTreeMissingRoot(self):
+        self.assertRaises(OSError, common.get_tree, self.fullpath(u'nonexisting'))
+
 class TestStrictFileWriterBasics(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp(prefix='testcommon_', dir=TMPDIR)
@@ -322,6 +340,68 @@ class TestMisc(unittest.TestCase):
         self.assertEqual(set(inv_d["v2"]), set(["k2", "kx"]))
         self.assertEqual(inv_d["v3"], ["k3"])
 
+    def test_bitmap(self):
+        for bools in ([], [True], [False] * 8, [True, False, True] * 7):
+            bitmap = common.encode_bitmap(bools)
+            self.assertTrue(isinstance(bitmap, str))
+            self.assertEqual(common.decode_bitmap(bitmap, len(bools)), bools)
+        self.assertRaises(AssertionError, common.decode_bitmap, common.encode_bitmap([True] * 9), 8)
+
+class TestRunParallelTasks(unittest.TestCase):
+    def test_progress(self):
+        results = []
+        progress = []
+        def task(n):
+            def run(report_work):
+                results.append(n)
+                report_work(n)
+            return run
+        common.run_parallel_tasks([task(n) for n in range(10)], sum(range(10)), progress.append)
+        self.assertEqual(sorted(results), list(range(10)))
+        self.assertTrue(progress)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+
+    def test_exception(self):
+        def failing_task(report_work):
+            assert False, "Task failed"
+        def happy_task(report_work):
+            report_work(1)
+        self.assertRaises(AssertionError, common.run_parallel_tasks,
+                          [happy_task, failing_task, happy_task], 2)
+
+    def test_no_tasks(self):
+        common.run_parallel_tasks([], 0)
+
+class TestReadAhead(unittest.TestCase):
+    def datasource(self, data):
+        import io, jsonrpc
+        return jsonrpc.StreamDataSource(io.BytesIO(data), len(data))
+
+    def test_blocks(self):
+        data = os.urandom(10 * 1000 + 1)
+        blocks = list(common.read_ahead(self.datasource(data), 1000, max_blocks = 2))
+        self.assertEqual([len(block) for block in blocks], [1000] * 10 + [1])
+        self.assertEqual(b"".join(blocks), data)
+
+    def test_small(self):
+        self.assertEqual(list(common.read_ahead(self.datasource(b"abc"), 3)), [b"abc"])
+        self.assertEqual(list(common.read_ahead(self.datasource(b""), 3)), [])
+
+    def test_exception(self):
+        datasource = self.datasource(b"x" * 100)
+        def failing_read(n = None):
+            raise IOError("Read failed")
+        datasource.read = failing_read
+        self.assertRaises(IOError, list, common.read_ahead(datasource, 10))
+
+    def test_stop_early(self):
+        datasource = self.datasource(b"x" * 100)
+        blocks = common.read_ahead(datasource, 10, max_blocks = 1)
+        self.assertEqual(next(blocks), b"x" * 10)
+        blocks.close()
+        # The reader thread stops without reading everything
+        self.assertTrue(datasource.bytes_left() > 0)
 
 if __name__ == '__main__':
     unittest.main()
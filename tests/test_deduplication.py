@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys, os, unittest, shutil
+import sys, os, unittest, shutil, io, subprocess
 import sqlite3
 
 if os.getenv("BOAR_SKIP_DEDUP_TESTS") == "1":
@@ -29,18 +29,21 @@ import workdir
 from blobrepo import repository
 repository.DEDUP_BLOCK_SIZE = 3 # Make deduplication cases more manageble
 
-from common import get_tree, my_relpath, convert_win_path_to_unix, md5sum, DevNull, str2bytes, bytes2str
-from boar_exceptions import UserError, SoftCorruptionError
+from common import get_tree, my_relpath, convert_win_path_to_unix, md5sum, DevNull, str2bytes, bytes2str, \
+    read_ahead, write_json
+from jsonrpc import FileDataSource
+from boar_exceptions import UserError, SoftCorruptionError, CorruptionError
 from front import Front, verify_repo
 from wdtools import read_tree, write_tree, WorkdirHelper, boar_dirs, write_file
 
+import deduplication
 from deduplication import dedup_available
 assert dedup_available, "No deduplication module installed"
 
 from deduplication import print_recipe
 from deduplication import RecipeFinder
-from deduplication import BlocksDB
-from cdedup import IntegerSet, calc_rolling
+from deduplication import BlocksDB, TmpBlocksDB
+from cdedup import IntegerSet, RollingChecksum, calc_rolling
 
 class FakePieceHandler(object):
     def init_piece(self, index): pass
@@ -78,6 +81,37 @@ class TestRecipeFinder(unittest.TestCase, WorkdirHelper):
                                                'original': False, 'repeat': 1, 'offset': 0}]
                                    })
 
+    def testScanString(self):
+        self.integer_set.add(calc_rolling(b"abc", 3))
+        iterated = RollingChecksum(3, self.integer_set)
+        scanned = RollingChecksum(3, self.integer_set)
+        for s in (b"xxab", b"cab", b"", b"cxabc"):
+            iterated.feed_string(s)
+            self.assertEqual(scanned.scan_string(s), [offset for offset, rolling in iterated])
+        self.assertEqual(scanned.value(), iterated.value())
+
+    def testReadAhead(self):
+        # The recipe must not depend on how the data is split up when
+        # it is fed, as it is when read by read_ahead()
+        self.integer_set.add(calc_rolling(b"aaa", 3))
+        self.integer_set.add(calc_rolling(b"bbb", 3))
+        self.blocksdb.begin()
+        self.blocksdb.add_block(b"47bce5c74f589f4867dbd57e9ca9f808", 0, b"47bce5c74f589f4867dbd57e9ca9f808")
+        self.blocksdb.add_block(b"08f8e0260c64418510cefb2b06eee5cd", 0, b"08f8e0260c64418510cefb2b06eee5cd")
+        self.blocksdb.commit()
+        data = b"XaaabbbXXaaaYbbbbbbaaZZbbaaaaab" * 5
+        recipes = []
+        for block_size in (len(data), 1, 2, 4, 7):
+            recipe_finder = RecipeFinder(self.blocksdb, 3, self.integer_set, None,
+                                         original_piece_handler = self.piece_handler)
+            for block in read_ahead(FileDataSource(io.BytesIO(data), len(data)), block_size):
+                recipe_finder.feed(block)
+            recipe_finder.close()
+            recipes.append(recipe_finder.get_recipe())
+        self.assertTrue([p for p in recipes[0]['pieces'] if not p['original']])
+        for recipe in recipes[1:]:
+            self.assertEqual(recipe, recipes[0])
+
 
 class TestConcurrentCommit(unittest.TestCase, WorkdirHelper):
     def setUp(self):
@@ -487,7 +521,161 @@ class TestDeduplicationWorkdir(unittest.TestCase, WorkdirHelper):
 
 
 
+    def testIntegrateBlockLists(self):
+        # Transactions queued by older versions list their blocks in
+        # blocks.json, newer ones in blocks.bin. Both must be integrated.
+        blob = self.addWorkdirFile("a.txt", "abcdef")
+        self.wd.checkin()
+        session_path = self.repo.get_session_path(self.wd.front.find_last_revision(u"TestSession"))
+        missing_blob = md5sum(b"missing")
+        legacy = os.path.join(self.createTmpName(), "legacy")
+        shutil.copytree(session_path, legacy)
+        write_json(os.path.join(legacy, repository.LEGACY_BLOCKS_FILE),
+                   [[blob, 1, calc_rolling(b"bcd", 3), md5sum(b"bcd")],
+                    [missing_blob, 0, calc_rolling(b"xyz", 3), md5sum(b"xyz")]])
+        binary = os.path.join(self.createTmpName(), "binary")
+        shutil.copytree(session_path, binary)
+        writer = deduplication.BlockListWriter(os.path.join(binary, repository.BLOCK_LIST_FILE))
+        writer.add_block(blob, 2, calc_rolling(b"cde", 3), md5sum(b"cde"))
+        writer.add_block(missing_blob, 3, calc_rolling(b"xyz", 3), md5sum(b"xyz"))
+        writer.close()
+        for path, block_list in ((legacy, repository.LEGACY_BLOCKS_FILE),
+                                 (binary, repository.BLOCK_LIST_FILE)):
+            repository.Transaction(self.repo, path).integrate_blocks()
+            self.assertFalse(os.path.exists(os.path.join(path, block_list)))
+        blocksdb = self.repo.blocksdb
+        self.assertEqual(blocksdb.get_block_locations(str2bytes(md5sum(b"bcd"))), [(str2bytes(blob), 1)])
+        self.assertEqual(blocksdb.get_block_locations(str2bytes(md5sum(b"cde"))), [(str2bytes(blob), 2)])
+        # Blocks of blobs that are not in the repository are ignored
+        self.assertEqual(blocksdb.get_block_locations(str2bytes(md5sum(b"xyz"))), [])
+        rolling = blocksdb.get_all_rolling()
+        self.assertTrue(calc_rolling(b"bcd", 3) in rolling)
+        self.assertTrue(calc_rolling(b"cde", 3) in rolling)
+        self.assertFalse(calc_rolling(b"xyz", 3) in rolling)
+
+    def tearDown(self):
+        verify_repo(self.wd.get_front())
+        self.assertFalse(self.wd.get_front().repo.get_orphan_blobs())
+        for d in self.remove_at_teardown:
+            shutil.rmtree(d, ignore_errors = True)
+
+def pseudo_random_text(size, seed):
+    """Returns size bytes of deterministic, incompressible looking text."""
+    result = []
+    data = seed
+    while sum(map(len, result)) < size:
+        data = md5sum(str2bytes(data))
+        result.append(data)
+    return "".join(result)[:size]
+
+class TestChunkDeduplicationWorkdir(unittest.TestCase, WorkdirHelper):
+    def setUp(self):
+        self.remove_at_teardown = []
+        self.saved_chunk_sizes = repository.DEDUP_CHUNK_SIZES
+        repository.DEDUP_CHUNK_SIZES = (16, 64, 256)
+        self.workdir = self.createTmpName()
+        self.repopath = self.createTmpName()
+        repository.create_repository(self.repopath, enable_deduplication = repository.DEDUP_MODE_CHUNKS)
+        os.mkdir(self.workdir)
+        self.wd = workdir.Workdir(self.repopath, u"TestSession", u"", None, self.workdir)
+        self.wd.setLogOutput(DevNull())
+        self.wd.use_progress_printer(False)
+        self.repo = self.wd.front.repo
+        id = self.wd.get_front().mksession(u"TestSession")
+        assert id == 1
+
+    def original_size(self, recipe):
+        return sum([piece['size'] * piece['repeat'] for piece in recipe['pieces'] if piece['original']])
+
+    def testDeduplicationMode(self):
+        self.assertEqual(self.repo.get_deduplication_mode(), repository.DEDUP_MODE_CHUNKS)
+        self.assertTrue(self.repo.deduplication_enabled())
+        repopath = self.createTmpName()
+        repository.create_repository(repopath, enable_deduplication = True)
+        self.assertEqual(repository.Repo(repopath).get_deduplication_mode(), repository.DEDUP_MODE_BLOCKS)
+        self.assertRaises(UserError, repository.create_repository, self.createTmpName(),
+                          enable_deduplication = "nonsense")
+
+    def testChunksRepoFormat(self):
+        # Older boar versions only know about LATEST_REPO_FORMAT, and must
+        # not mistake a chunks repository for a blocks repository.
+        version_file = os.path.join(self.repopath, repository.VERSION_FILE)
+        with open(version_file) as f:
+            self.assertEqual(int(f.read()), repository.CHUNKS_REPO_FORMAT)
+        repopath = self.createTmpName()
+        repository.create_repository(repopath, enable_deduplication = True)
+        with open(os.path.join(repopath, repository.VERSION_FILE)) as f:
+            self.assertEqual(int(f.read()), repository.LATEST_REPO_FORMAT)
+        # A chunks repository without the format version is marked
+        # when it is opened.
+        with open(version_file, "w") as f:
+            f.write(str(repository.LATEST_REPO_FORMAT))
+        repository.Repo(self.repopath)
+        with open(version_file) as f:
+            self.assertEqual(int(f.read()), repository.CHUNKS_REPO_FORMAT)
+
+    def testShiftedDataIsDeduplicated(self):
+        data = pseudo_random_text(5000, "shifted")
+        self.addWorkdirFile("a.txt", data)
+        self.wd.checkin()
+        blob = self.addWorkdirFile("b.txt", "inserted" + data[:2500] + "inserted" + data[2500:])
+        self.wd.checkin()
+        recipe = self.repo.get_recipe(blob)
+        self.assertTrue(recipe)
+        self.assertTrue(self.original_size(recipe) < 2000, self.original_size(recipe))
+        self.assertEqual(md5sum(self.wd.front.get_blob(blob).read()), blob)
+
+    def testDeduplicationWithinCommit(self):
+        data = pseudo_random_text(3000, "within")
+        self.addWorkdirFile("a.txt", data + "X")
+        self.addWorkdirFile("b.txt", data + "Y")
+        self.wd.checkin()
+        recipes = [self.repo.get_recipe(blob) for blob in (md5sum(str2bytes(data + "X")), md5sum(str2bytes(data + "Y")))]
+        self.assertTrue(recipes[0] or recipes[1])
+
+    def testRepeatedDataWithinFile(self):
+        data = pseudo_random_text(1000, "repeated")
+        blob = self.addWorkdirFile("a.txt", data * 10)
+        self.wd.checkin()
+        recipe = self.repo.get_recipe(blob)
+        self.assertTrue(recipe)
+        self.assertTrue(self.original_size(recipe) < 2500, self.original_size(recipe))
+        self.assertEqual(md5sum(self.wd.front.get_blob(blob).read()), blob)
+
+    def testChunksAreRegistered(self):
+        data = pseudo_random_text(2000, "registered")
+        self.addWorkdirFile("a.txt", data)
+        self.wd.checkin()
+        blob = self.addWorkdirFile("b.txt", data[1000:])
+        self.wd.checkin()
+        recipe = self.repo.get_recipe(blob)
+        # Only the data up to where the chunk boundaries are in sync is new
+        self.assertTrue(self.original_size(recipe) < 500, self.original_size(recipe))
+
+    def testEmptyFile(self):
+        self.addWorkdirFile("empty.txt", "")
+        self.wd.checkin()
+        self.assertTrue("d41d8cd98f00b204e9800998ecf8427e" in self.wd.get_front().get_all_raw_blobs())
+
+    def testCheckinCheckout(self):
+        data = pseudo_random_text(4000, "roundtrip")
+        self.addWorkdirFile("a.txt", data)
+        self.wd.checkin()
+        self.addWorkdirFile("b.txt", data[1000:] + "appended")
+        self.addWorkdirFile("sub/c.txt", "prefix" + data[:3000])
+        self.wd.checkin()
+        self.assertTrue(self.wd.front.get_all_recipes())
+        expected = read_tree(self.workdir, skiplist = boar_dirs)
+        wdroot = self.createTmpName()
+        os.mkdir(wdroot)
+        wd = workdir.Workdir(self.repopath, u"TestSession", u"", None, wdroot)
+        wd.setLogOutput(DevNull())
+        wd.use_progress_printer(False)
+        wd.checkout()
+        self.assertEqual(read_tree(wdroot, skiplist = boar_dirs), expected)
+
     def tearDown(self):
+        repository.DEDUP_CHUNK_SIZES = self.saved_chunk_sizes
         verify_repo(self.wd.get_front())
         self.assertFalse(self.wd.get_front().repo.get_orphan_blobs())
         for d in self.remove_at_teardown:
@@ -542,6 +730,104 @@ class TestBlockLocationsDB(unittest.TestCase, WorkdirHelper):
         self.assertRaises(OverflowError, self.db.add_rolling, -1)
         self.assertRaises(OverflowError, self.db.add_rolling, 2**64)
 
+    def testRollingSet(self):
+        self.db.begin()
+        self.db.add_rolling(17)
+        self.db.add_rolling(2**64 - 1)
+        self.db.commit()
+        rolling_set = self.db.get_rolling_set()
+        self.assertTrue(rolling_set.contains(17))
+        self.assertTrue(rolling_set.contains(2**64 - 1))
+        self.assertFalse(rolling_set.contains(18))
+        rolling_set.add(18)
+        self.assertTrue(rolling_set.contains(18))
+        self.assertFalse(self.db.get_rolling_set().contains(18))
+
+    def testRollingSetReopened(self):
+        self.db.begin()
+        for n in range(10000):
+            self.db.add_rolling(n * 7919)
+        self.db.commit()
+        del self.db
+        db = BlocksDB(self.dbfile, 2**16)
+        rolling_set = db.get_rolling_set()
+        self.assertTrue(all(rolling_set.contains(n * 7919) for n in range(10000)))
+        self.assertFalse(rolling_set.contains(7920))
+
+    def testRollingSetGrow(self):
+        # Enough values for the persistent set to grow, some of them in a
+        # transaction that started before the growth.
+        for first in range(0, 3 * 2**15, 2**14):
+            self.db.begin()
+            for n in range(first, first + 2**14):
+                self.db.add_rolling(n * 7919)
+            self.db.commit()
+        rolling_set = self.db.get_rolling_set()
+        self.assertTrue(all(rolling_set.contains(n * 7919) for n in range(3 * 2**15)))
+        self.assertFalse(rolling_set.contains(7920))
+        del self.db, rolling_set
+        db = BlocksDB(self.dbfile, 2**16)
+        db.begin()
+        db.add_rolling(7920)
+        db.commit()
+        rolling_set = db.get_rolling_set()
+        self.assertTrue(all(rolling_set.contains(n * 7919) for n in range(3 * 2**15)))
+        self.assertTrue(rolling_set.contains(7920))
+        self.assertEqual(len(db.get_all_rolling()), 3 * 2**15 + 1)
+
+    def testRollingSetStale(self):
+        self.db.begin()
+        self.db.add_rolling(17)
+        self.db.commit()
+        # Modify the database behind the back of the rolling set
+        con = sqlite3.connect(self.dbfile)
+        con.execute("INSERT INTO rolling (value) VALUES (4711)")
+        con.execute("UPDATE props SET value = value + 1 WHERE name = 'modification_counter'")
+        con.commit()
+        con.close()
+        self.assertTrue(self.db.get_rolling_set().contains(4711))
+        db = BlocksDB(self.dbfile, 2**16)
+        db.begin()
+        db.add_rolling(18)
+        db.commit()
+        rolling_set = db.get_rolling_set()
+        self.assertTrue(rolling_set.contains(17))
+        self.assertTrue(rolling_set.contains(4711))
+        self.assertTrue(rolling_set.contains(18))
+
+    def testRollingSetInterruptedTransaction(self):
+        # A process that dies in the middle of a transaction leaves the
+        # persistent rolling set marked as dirty, possibly after growing
+        # it. Neither the set nor the database may keep the values that
+        # were never committed.
+        self.db.begin()
+        self.db.add_rolling(17)
+        self.db.commit()
+        boar_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = ("import sys, os\n"
+                  "sys.path.insert(0, %r)\n"
+                  "from cdedup import BlocksDB\n"
+                  "db = BlocksDB(%r, 2**16)\n"
+                  "db.begin()\n"
+                  "for n in range(1, 3 * 2**15):\n"
+                  "    db.add_rolling(n * 7919)\n"
+                  "os._exit(0)\n") % (boar_dir, self.dbfile)
+        subprocess.check_call([sys.executable, "-c", script])
+        del self.db
+        db = BlocksDB(self.dbfile, 2**16)
+        rolling_set = db.get_rolling_set()
+        self.assertTrue(rolling_set.contains(17))
+        self.assertFalse(any(rolling_set.contains(n * 7919) for n in range(1, 3 * 2**15)))
+        self.assertEqual(db.get_all_rolling(), [17])
+        db.begin()
+        db.add_rolling(18)
+        db.commit()
+        rolling_set = db.get_rolling_set()
+        self.assertTrue(rolling_set.contains(17))
+        self.assertTrue(rolling_set.contains(18))
+        self.assertFalse(rolling_set.contains(7919))
+        self.assertEqual(sorted(db.get_all_rolling()), [17, 18])
+
     def testHighBlock(self):
         self.db.begin()
         self.db.add_block(b"d41d8cd98f00b204e9800998ecf8427e", 2**32 + 1, b"00000000000000000000000000000000")
@@ -568,6 +854,81 @@ class TestBlockLocationsDB(unittest.TestCase, WorkdirHelper):
         self.assertEqual(list(self.db.get_block_locations(b"00000000000000000000000000000000")),
                           [(b"d41d8cd98f00b204e9800998ecf8427e", 0)])
 
+    def testManyBlockLocations(self):
+        self.db.begin()
+        self.db.add_block(b"d41d8cd98f00b204e9800998ecf8427e", 0, b"00000000000000000000000000000000")
+        self.db.add_block(b"d41d8cd98f00b204e9800998ecf8427e", 3, b"00000000000000000000000000000001")
+        self.db.add_block(b"47bce5c74f589f4867dbd57e9ca9f808", 6, b"00000000000000000000000000000001")
+        self.db.commit()
+        locations = self.db.get_many_block_locations([b"00000000000000000000000000000001",
+                                                      b"00000000000000000000000000000002"])
+        self.assertEqual(set(locations.keys()), set([b"00000000000000000000000000000001",
+                                                     b"00000000000000000000000000000002"]))
+        self.assertEqual(sorted(locations[b"00000000000000000000000000000001"]),
+                         [(b"47bce5c74f589f4867dbd57e9ca9f808", 6),
+                          (b"d41d8cd98f00b204e9800998ecf8427e", 3)])
+        self.assertEqual(locations[b"00000000000000000000000000000002"], [])
+        self.assertEqual(self.db.get_many_block_locations([]), {})
+
+    def testManyBlockLocationsMixedCase(self):
+        self.db.begin()
+        self.db.add_block(b"d41d8cd98f00b204e9800998ecf8427e", 0, b"0000000000000000000000000000000A")
+        self.db.add_block(b"D41D8CD98F00B204E9800998ECF8427E", 3, b"0000000000000000000000000000000a")
+        self.db.add_block(b"47bce5c74f589f4867dbd57e9ca9f808", 6, b"000000000000000000000000000000bB")
+        self.db.commit()
+        md5s = [b"0000000000000000000000000000000a", b"0000000000000000000000000000000A",
+                b"000000000000000000000000000000Bb", b"000000000000000000000000000000cc"]
+        locations = self.db.get_many_block_locations(md5s)
+        self.assertEqual(set(locations.keys()), set([md5.lower() for md5 in md5s]))
+        tmpdb = TmpBlocksDB(self.db)
+        tmp_locations = tmpdb.get_many_block_locations(md5s)
+        for md5 in md5s:
+            single = sorted(self.db.get_block_locations(md5))
+            self.assertEqual(sorted(locations[md5.lower()]), single)
+            self.assertEqual(sorted(tmp_locations[md5.lower()]), single)
+            self.assertEqual(sorted(tmpdb.get_block_locations(md5)), single)
+        self.assertEqual(sorted(locations[b"0000000000000000000000000000000a"]),
+                         [(b"d41d8cd98f00b204e9800998ecf8427e", 0),
+                          (b"d41d8cd98f00b204e9800998ecf8427e", 3)])
+        self.assertEqual(locations[b"000000000000000000000000000000bb"],
+                         [(b"47bce5c74f589f4867dbd57e9ca9f808", 6)])
+        self.assertEqual(locations[b"000000000000000000000000000000cc"], [])
+
+    def testTmpBlocksDBChunksMixedCase(self):
+        self.db.begin()
+        self.db.add_chunk(b"d41d8cd98f00b204e9800998ecf8427e", 0, 10, b"0000000000000000000000000000000A")
+        self.db.commit()
+        tmpdb = TmpBlocksDB(self.db)
+        tmpdb.add_tmp_chunk(b"000000000000000000000000000000Bb", b"47BCE5C74F589F4867DBD57E9CA9F808", 3, 7)
+        md5s = [b"0000000000000000000000000000000a", b"000000000000000000000000000000bB",
+                b"000000000000000000000000000000cc"]
+        self.assertEqual(tmpdb.get_many_chunk_locations(md5s),
+                         {b"0000000000000000000000000000000a": (b"d41d8cd98f00b204e9800998ecf8427e", 0, 10),
+                          b"000000000000000000000000000000bb": (b"47BCE5C74F589F4867DBD57E9CA9F808", 3, 7)})
+
+    def testTmpBlocksDBManyBlockLocations(self):
+        self.db.begin()
+        self.db.add_block(b"d41d8cd98f00b204e9800998ecf8427e", 0, b"00000000000000000000000000000000")
+        self.db.commit()
+        tmpdb = TmpBlocksDB(self.db)
+        tmpdb.add_tmp_block(b"00000000000000000000000000000000", b"47bce5c74f589f4867dbd57e9ca9f808", 3)
+        locations = tmpdb.get_many_block_locations([b"00000000000000000000000000000000",
+                                                    b"00000000000000000000000000000001"])
+        self.assertEqual(sorted(locations[b"00000000000000000000000000000000"]),
+                         [(b"47bce5c74f589f4867dbd57e9ca9f808", 3),
+                          (b"d41d8cd98f00b204e9800998ecf8427e", 0)])
+        self.assertEqual(locations[b"00000000000000000000000000000001"], [])
+        locations = tmpdb.get_many_block_locations([b"0000000000000000000000000000000A"])
+        self.assertEqual(locations, {b"0000000000000000000000000000000a": []})
+        # Found blocks are remembered, even if the database changes
+        con = sqlite3.connect(self.dbfile)
+        con.execute("DELETE FROM blocks")
+        con.commit()
+        con.close()
+        self.assertEqual(sorted(tmpdb.get_block_locations(b"00000000000000000000000000000000")),
+                         [(b"47bce5c74f589f4867dbd57e9ca9f808", 3),
+                          (b"d41d8cd98f00b204e9800998ecf8427e", 0)])
+
     def testBlockDuplicate(self):
         # blob, offset, md5
         self.db.begin()
@@ -577,6 +938,81 @@ class TestBlockLocationsDB(unittest.TestCase, WorkdirHelper):
         self.assertEqual(list(self.db.get_block_locations(b"00000000000000000000000000000000")),
                           [(b"d41d8cd98f00b204e9800998ecf8427e", 0)])
 
+    def testAddBlocks(self):
+        blocks = [(b"d41d8cd98f00b204e9800998ecf8427e", n * 3, n % 2, b"%032x" % n) for n in range(25000)]
+        self.assertRaises(AssertionError, self.db.add_blocks, blocks)
+        self.db.begin()
+        self.db.add_block(b"d41d8cd98f00b204e9800998ecf8427e", 0, b"00000000000000000000000000000000")
+        self.db.add_blocks(block for block in blocks)
+        self.db.commit()
+        self.assertEqual(sorted(self.db.get_all_rolling()), [0, 1])
+        self.assertEqual(self.db.get_block_locations(b"%032x" % 24999), [(b"d41d8cd98f00b204e9800998ecf8427e", 74997)])
+        self.assertEqual(self.db.get_block_locations(b"00000000000000000000000000000000"),
+                         [(b"d41d8cd98f00b204e9800998ecf8427e", 0)])
+        con = sqlite3.connect(self.dbfile)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM blocks").fetchone()[0], 25000)
+        con.close()
+
+    def testAddBlocksFailureKeepsIndex(self):
+        # The md5 index is dropped while many blocks are added. It must
+        # be back even if adding fails, as the transaction may still be
+        # committed.
+        blocks = [(b"d41d8cd98f00b204e9800998ecf8427e", n * 3, 0, b"%032x" % n) for n in range(25000)]
+        blocks.append((b"nonsense", 0, 0, b"d41d8cd98f00b204e9800998ecf8427e"))
+        self.db.begin()
+        self.assertRaises(Exception, self.db.add_blocks, blocks)
+        self.db.commit()
+        con = sqlite3.connect(self.dbfile)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'index_block_md5'").fetchone()[0], 1)
+        con.close()
+
+    def tearDown(self):
+        for d in self.remove_at_teardown:
+            shutil.rmtree(d, ignore_errors = True)
+
+class TestBlockList(unittest.TestCase, WorkdirHelper):
+    def setUp(self):
+        self.remove_at_teardown = []
+        self.workdir = self.createTmpName()
+        os.mkdir(self.workdir)
+        self.path = os.path.join(self.workdir, "blocks.bin")
+
+    def testRoundtrip(self):
+        writer = deduplication.BlockListWriter(self.path)
+        writer.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, 2**64 - 1, "47BCE5C74F589F4867DBD57E9CA9F808")
+        writer.add_block("47bce5c74f589f4867dbd57e9ca9f808", 2**16, 17, "d41d8cd98f00b204e9800998ecf8427e")
+        writer.close()
+        deduplication.verify_block_list(self.path)
+        self.assertEqual(list(deduplication.read_block_list(self.path, records_per_read = 1)),
+                         [(b"d41d8cd98f00b204e9800998ecf8427e", 0, 2**64 - 1, b"47bce5c74f589f4867dbd57e9ca9f808"),
+                          (b"47bce5c74f589f4867dbd57e9ca9f808", 2**16, 17, b"d41d8cd98f00b204e9800998ecf8427e")])
+
+    def testEmpty(self):
+        deduplication.BlockListWriter(self.path).close()
+        self.assertEqual(list(deduplication.read_block_list(self.path)), [])
+
+    def testChunkList(self):
+        writer = deduplication.BlockListWriter(self.path, magic = deduplication.CHUNK_LIST_MAGIC)
+        writer.add_block("d41d8cd98f00b204e9800998ecf8427e", 10, 4096, "47bce5c74f589f4867dbd57e9ca9f808")
+        writer.close()
+        deduplication.verify_block_list(self.path, deduplication.CHUNK_LIST_MAGIC)
+        self.assertEqual(list(deduplication.read_block_list(self.path, magic = deduplication.CHUNK_LIST_MAGIC)),
+                         [(b"d41d8cd98f00b204e9800998ecf8427e", 10, 4096, b"47bce5c74f589f4867dbd57e9ca9f808")])
+        # A chunk list must never be mistaken for a block list
+        self.assertRaises(CorruptionError, deduplication.verify_block_list, self.path)
+
+    def testCorrupt(self):
+        writer = deduplication.BlockListWriter(self.path)
+        writer.add_block("d41d8cd98f00b204e9800998ecf8427e", 0, 0, "d41d8cd98f00b204e9800998ecf8427e")
+        writer.close()
+        with open(self.path, "ab") as f:
+            f.write(b"X")
+        self.assertRaises(CorruptionError, deduplication.verify_block_list, self.path)
+        self.assertRaises(CorruptionError, list, deduplication.read_block_list(self.path))
+        with open(self.path, "wb") as f:
+            f.write(b"[]")
+        self.assertRaises(CorruptionError, list, deduplication.read_block_list(self.path))
+
     def tearDown(self):
         for d in self.remove_at_teardown:
             shutil.rmtree(d, ignore_errors = True)
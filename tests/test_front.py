@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, shutil, tempfile, io, time
+
+TMPDIR=tempfile.gettempdir()
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobrepo import repository
+from blobrepo import sessions
+import front as front_module
+from front import Front, DryRunFront, add_file_simple, iter_session_bloblist, verify_repo
+from jsonrpc import FileDataSource
+from boar_exceptions import CorruptionError
+from boar_common import apply_delta, bloblist_to_dict
+from common import md5sum
+
+def blobinfo(n):
+    return {'filename': u"dir/file%s_å.txt" % n, 'size': n, 'mtime': 1000 + n,
+            'ctime': 1000 + n, 'md5sum': "%032x" % n}
+
+class TestBloblistStream(unittest.TestCase):
+    def stream(self, bloblist):
+        f = io.BytesIO()
+        front_module.write_bloblist_stream(bloblist, f)
+        return f.getvalue()
+
+    def testRoundtrip(self):
+        bloblist = [blobinfo(n) for n in range(5000)]
+        data = self.stream(bloblist)
+        source = FileDataSource(io.BytesIO(data), len(data))
+        self.assertEqual(list(front_module.read_bloblist_stream(source)), bloblist)
+        self.assertEqual(source.bytes_left(), 0)
+        data = self.stream([])
+        self.assertEqual(list(front_module.read_bloblist_stream(FileDataSource(io.BytesIO(data), len(data)))), [])
+
+    def testTruncated(self):
+        data = self.stream([blobinfo(n) for n in range(10)])[:-5]
+        source = FileDataSource(io.BytesIO(data), len(data))
+        self.assertRaises(CorruptionError, list, front_module.read_bloblist_stream(source))
+
+    def testAbandonedReaderExhaustsSource(self):
+        data = self.stream([blobinfo(n) for n in range(5000)])
+        source = FileDataSource(io.BytesIO(data), len(data))
+        reader = front_module.read_bloblist_stream(source)
+        self.assertEqual(next(reader), blobinfo(0))
+        reader.close()
+        self.assertEqual(source.bytes_left(), 0)
+
+    def testSessionBloblistStream(self):
+        tmp = tempfile.mkdtemp(prefix="boar_test_front_", dir=TMPDIR)
+        try:
+            repository.create_repository(os.path.join(tmp, "repo"))
+            fr = Front(repository.Repo(os.path.join(tmp, "repo")))
+            fr.mksession("S")
+            fr.create_session("S", base_session = fr.find_last_revision("S"))
+            add_file_simple(fr, "a.txt", "a")
+            add_file_simple(fr, "b.txt", "b")
+            rev = fr.commit("S")
+            expected = fr.get_session_bloblist(rev)
+            # The dry run front is not a Front, so the stream is used
+            self.assertEqual(list(iter_session_bloblist(DryRunFront(fr), rev)), expected)
+            self.assertEqual(list(iter_session_bloblist(fr, rev)), expected)
+        finally:
+            shutil.rmtree(tmp, ignore_errors = True)
+
+class TestBloblistDelta(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="boar_test_front_", dir=TMPDIR)
+        repository.create_repository(os.path.join(self.tmp, "repo"))
+        self.front = Front(repository.Repo(os.path.join(self.tmp, "repo")))
+        self.front.mksession("S")
+        self.front.mksession("T")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors = True)
+
+    def commit(self, session_name, files, removed = (), force_base_snapshot = False):
+        fr = self.front
+        fr.create_session(session_name, base_session = fr.find_last_revision(session_name),
+                          force_base_snapshot = force_base_snapshot)
+        for filename, contents in files.items():
+            add_file_simple(fr, filename, contents)
+        for filename in removed:
+            fr.remove(filename)
+        return fr.commit(session_name)
+
+    def assertDelta(self, from_rev, to_rev):
+        bloblist = bloblist_to_dict(self.front.get_session_bloblist(from_rev))
+        apply_delta(bloblist, self.front.get_bloblist_delta(from_rev, to_rev))
+        self.assertEqual(sorted(bloblist.values(), key = lambda b: b['filename']),
+                         sorted(self.front.get_session_bloblist(to_rev), key = lambda b: b['filename']))
+
+    def testDelta(self):
+        r1 = self.commit("S", {"a.txt": "a", "b.txt": "b", "c.txt": "c"})
+        r2 = self.commit("S", {"a.txt": "a2", "d.txt": "d"}, removed = ["b.txt"])
+        r3 = self.commit("S", {"b.txt": "b3"}, removed = ["d.txt"])
+        t1 = self.commit("T", {"x.txt": "x"})
+        r4 = self.commit("S", {"e.txt": "e"}, force_base_snapshot = True)
+        self.assertEqual(sorted([b['filename'] for b in self.front.get_bloblist_delta(r1, r3)]),
+                         ["a.txt", "b.txt", "d.txt"])
+        self.assertEqual(self.front.get_bloblist_delta(r3, r3), [])
+        for from_rev, to_rev in [(r1, r2), (r1, r3), (r2, r3), (r3, r1), (r1, t1), (r3, r4), (r1, r4)]:
+            self.assertDelta(from_rev, to_rev)
+
+class TestResumableUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="boar_test_front_", dir=TMPDIR)
+        self.saved_min_size = repository.RESUMABLE_UPLOAD_MIN_SIZE
+        repository.RESUMABLE_UPLOAD_MIN_SIZE = 100
+        self.data = b"".join([b"line %d\n" % n for n in range(20000)])
+        self.md5 = md5sum(self.data)
+
+    def tearDown(self):
+        repository.RESUMABLE_UPLOAD_MIN_SIZE = self.saved_min_size
+        shutil.rmtree(self.tmp, ignore_errors = True)
+
+    def new_front(self, max_blob_size = None):
+        repopath = os.path.join(self.tmp, "repo")
+        if not os.path.exists(repopath):
+            repository.create_repository(repopath, max_blob_size = max_blob_size)
+        fr = Front(repository.Repo(repopath))
+        if fr.find_last_revision("S") == None:
+            fr.mksession("S")
+        fr.create_session("S", base_session = fr.find_last_revision("S"))
+        return fr
+
+    def interrupted_upload(self, size):
+        fr = self.new_front()
+        fr.init_new_blob(self.md5, len(self.data))
+        self.assertEqual(fr.get_partial_offset(self.md5), 0)
+        for n in range(0, size, 1000):
+            fr.new_session.add_blob_data(self.md5, self.data[n:min(n + 1000, size)])
+        fr.cancel_snapshot() # The connection was lost
+
+    def finish_upload(self, fr, offset, session_name = "S"):
+        rest = self.data[offset:]
+        fr.add_blob_data_streamed(self.md5, FileDataSource(io.BytesIO(rest), len(rest)))
+        fr.blob_finished(self.md5)
+        fr.add({'filename': "big.txt", 'md5sum': self.md5, 'size': len(self.data),
+                'mtime': 1000, 'ctime': 1000})
+        rev = fr.commit(session_name)
+        self.assertEqual(fr.get_blob(self.md5).read(), self.data)
+        partial_dir = fr.repo.get_path(repository.PARTIAL_UPLOADS_DIR)
+        self.assertFalse(os.path.exists(partial_dir) and os.listdir(partial_dir))
+        return rev
+
+    def testResume(self):
+        self.interrupted_upload(50000)
+        fr = self.new_front()
+        fr.init_new_blob(self.md5, len(self.data))
+        self.assertEqual(fr.get_partial_offset(self.md5), 50000)
+        self.finish_upload(fr, 50000)
+        self.assertTrue(verify_repo(fr, verbose = False))
+
+    def testSplitBlobIsNotResumable(self):
+        # Only blobs that are stored verbatim are kept as partial uploads
+        self.new_front(max_blob_size = 2**16).cancel_snapshot()
+        self.interrupted_upload(100000)
+        fr = self.new_front()
+        fr.init_new_blob(self.md5, len(self.data))
+        self.assertEqual(fr.get_partial_offset(self.md5), 0)
+        self.finish_upload(fr, 0)
+        self.assertTrue(verify_repo(fr, verbose = False))
+
+    def testStalePartialUploadExpires(self):
+        self.interrupted_upload(50000)
+        fr = self.new_front()
+        partial_dir = fr.repo.get_path(repository.PARTIAL_UPLOADS_DIR)
+        fr.cancel_snapshot()
+        path, = [os.path.join(partial_dir, fn) for fn in os.listdir(partial_dir)]
+        old = time.time() - repository.PARTIAL_UPLOAD_MAX_AGE - 10
+        os.utime(path, (old, old))
+        fr = self.new_front()
+        self.assertEqual(os.listdir(partial_dir), [])
+        fr.init_new_blob(self.md5, len(self.data))
+        self.assertEqual(fr.get_partial_offset(self.md5), 0)
+        self.finish_upload(fr, 0)
+
+    def testUnclaimedDataIsReplaced(self):
+        self.interrupted_upload(50000)
+        fr = self.new_front()
+        fr.init_new_blob(self.md5, len(self.data))
+        self.finish_upload(fr, 0)
+
+    def testWithoutFileLocking(self):
+        # Uploads are not resumable where fcntl is not available
+        saved_fcntl = sessions.fcntl
+        sessions.fcntl = None
+        try:
+            self.interrupted_upload(50000)
+            fr = self.new_front()
+            partial_dir = fr.repo.get_path(repository.PARTIAL_UPLOADS_DIR)
+            self.assertFalse(os.path.exists(partial_dir) and os.listdir(partial_dir))
+            fr.init_new_blob(self.md5, len(self.data))
+            self.assertEqual(fr.get_partial_offset(self.md5), 0)
+            self.finish_upload(fr, 0)
+            self.assertTrue(verify_repo(fr, verbose = False))
+        finally:
+            sessions.fcntl = saved_fcntl
+
+    def testConcurrentUpload(self):
+        fr1 = self.new_front()
+        fr1.init_new_blob(self.md5, len(self.data))
+        fr2 = Front(repository.Repo(os.path.join(self.tmp, "repo")))
+        fr2.mksession("T")
+        fr2.create_session("T", base_session = fr2.find_last_revision("T"))
+        # The first upload has the partial data locked
+        fr2.init_new_blob(self.md5, len(self.data))
+        self.assertEqual(fr2.get_partial_offset(self.md5), 0)
+        fr1.cancel_snapshot()
+        self.finish_upload(fr2, 0, session_name = "T")
+
+if __name__ == '__main__':
+    unittest.main()
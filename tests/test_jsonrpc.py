@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, tempfile, io
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonrpc
+from jsonrpc import FileDataSource, StreamDataSource, copy_datasource, iter_chunks, \
+    WireCompression, CompressedStreamDataSource, parse_compression_spec
+from boar_exceptions import UserError, ConnectionLost
+
+DATA = bytes(range(256)) * 40 + b"tail"
+
+class TestDataCopying(unittest.TestCase):
+    def setUp(self):
+        self.saved = jsonrpc.MIN_CHUNK_SIZE, jsonrpc.MAX_CHUNK_SIZE
+        jsonrpc.MIN_CHUNK_SIZE = 100
+        jsonrpc.MAX_CHUNK_SIZE = 1000
+        self.progress = []
+
+    def tearDown(self):
+        jsonrpc.MIN_CHUNK_SIZE, jsonrpc.MAX_CHUNK_SIZE = self.saved
+
+    def testIterChunks(self):
+        chunks = list(iter_chunks(FileDataSource(io.BytesIO(DATA), len(DATA))))
+        self.assertEqual([len(c) for c in chunks[:5]], [100, 200, 400, 800, 1000])
+        self.assertEqual(b"".join(chunks), DATA)
+
+    def testBufferedCopy(self):
+        out = io.BytesIO()
+        source = FileDataSource(io.BytesIO(DATA), len(DATA), self.progress.append)
+        checks = []
+        copy_datasource(source, out, lambda: checks.append(True))
+        self.assertEqual(out.getvalue(), DATA)
+        self.assertEqual(source.bytes_left(), 0)
+        self.assertEqual(self.progress[-1], 1.0)
+        self.assertTrue(len(checks) > 1)
+
+    def testStreamReadinto(self):
+        source = StreamDataSource(io.BufferedReader(io.BytesIO(DATA + b"more")), len(DATA))
+        out = io.BytesIO()
+        copy_datasource(source, out)
+        self.assertEqual(out.getvalue(), DATA)
+
+    def testSendfile(self):
+        with tempfile.TemporaryFile() as infile, tempfile.TemporaryFile() as outfile:
+            infile.write(b"skipped" + DATA)
+            infile.seek(len(b"skipped"))
+            source = FileDataSource(infile, len(DATA), self.progress.append)
+            out = io.BufferedWriter(io.FileIO(os.dup(outfile.fileno()), "w"))
+            out.write(b"header")
+            copy_datasource(source, out)
+            out.close()
+            outfile.seek(0)
+            self.assertEqual(outfile.read(), b"header" + DATA)
+            self.assertEqual(source.bytes_left(), 0)
+            self.assertEqual(self.progress[-1], 1.0)
+
+    def testEmpty(self):
+        out = io.BytesIO()
+        copy_datasource(FileDataSource(io.BytesIO(b""), 0), out)
+        self.assertEqual(out.getvalue(), b"")
+
+class TestWireCompression(unittest.TestCase):
+    def testParseSpec(self):
+        self.assertEqual(parse_compression_spec("none"), None)
+        self.assertEqual(parse_compression_spec("fast"), ("zlib", 1))
+        self.assertEqual(parse_compression_spec("zlib"), ("zlib", 6))
+        self.assertEqual(parse_compression_spec("lzma:2"), ("lzma", 2))
+        for spec in ["gzip", "zlib:x", "zlib:10", ""]:
+            self.assertRaises(UserError, parse_compression_spec, spec)
+
+    def testJson(self):
+        compression = WireCompression("zlib")
+        small = b'{"result": "a"}'
+        self.assertEqual(compression.pack_json(small), small)
+        large = b'{"result": [' + b'"some text", ' * 1000 + b'"x"]}'
+        packed = compression.pack_json(large)
+        self.assertTrue(len(packed) < len(large) / 10)
+        self.assertEqual(compression.unpack_json(packed), large)
+        self.assertEqual(compression.unpack_json(small), small)
+
+    def testFrames(self):
+        random_data = os.urandom(50000)
+        for spec in ["fast", "lzma:1"]:
+            compression = WireCompression(spec)
+            for data in [DATA * 10, random_data, b""]:
+                wire = io.BytesIO()
+                copy_datasource(FileDataSource(io.BytesIO(data), len(data)), wire, compression = compression)
+                if data is random_data:
+                    # Incompressible data is sent as is
+                    self.assertEqual(len(wire.getvalue()), len(data) + jsonrpc.FRAME_HEADER_SIZE)
+                elif data:
+                    self.assertTrue(len(wire.getvalue()) < len(data) / 10)
+                wire.seek(0)
+                source = CompressedStreamDataSource(wire, len(data), compression)
+                self.assertEqual(source.read(7) + source.read(), data)
+                self.assertEqual(source.bytes_left(), 0)
+
+    def testDecompressionLimit(self):
+        for spec in ["fast", "lzma:1"]:
+            compression = WireCompression(spec)
+            data = b"\0" * 100000
+            self.assertEqual(compression.decompress(compression.compress(data), len(data)), data)
+            self.assertRaises(ConnectionLost, compression.decompress, compression.compress(data), len(data) - 1)
+            self.assertRaises(ConnectionLost, compression.decompress, compression.compress(data)[:-10], len(data))
+            # A frame that expands to more than the announced payload
+            wire = io.BytesIO()
+            compression.write_frame(wire, data)
+            wire.seek(0)
+            source = CompressedStreamDataSource(wire, 1000, compression)
+            self.assertRaises(ConnectionLost, source.read)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, unittest, threading
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mounttree import SnapshotTree, SnapshotTreeCache, RepositoryTree, RevisionNode
+import mounttree
+from boar_exceptions import CorruptionError
+
+def blobinfo(filename, mtime = 1000, size = 10):
+    return {'filename': filename, 'size': size, 'mtime': mtime, 'ctime': mtime,
+            'md5sum': "d41d8cd98f00b204e9800998ecf8427e"}
+
+class TestSnapshotTree(unittest.TestCase):
+    def setUp(self):
+        self.tree = SnapshotTree([blobinfo("a.txt", 100),
+                                  blobinfo("dir/b.txt", 300),
+                                  blobinfo("dir/sub1/c.txt", 200),
+                                  blobinfo("dir/sub2/d.txt", 400, size = 17)],
+                                 first_inode = 10)
+
+    def testLookup(self):
+        self.assertTrue(self.tree.lookup("/").is_dir)
+        self.assertTrue(self.tree.lookup("/dir/").is_dir)
+        self.assertEqual(self.tree.lookup("/dir/sub2/d.txt").size, 17)
+        self.assertEqual(self.tree.lookup("/missing"), None)
+        self.assertEqual(self.tree.lookup("/a.txt/x"), None)
+        self.assertEqual(sorted(self.tree.lookup("/dir").children.keys()), ["b.txt", "sub1", "sub2"])
+
+    def testNlink(self):
+        self.assertEqual(self.tree.lookup("/").nlink, 3)
+        self.assertEqual(self.tree.lookup("/dir").nlink, 4)
+        self.assertEqual(self.tree.lookup("/dir/sub1").nlink, 2)
+        self.assertEqual(self.tree.lookup("/a.txt").nlink, 1)
+
+    def testDirectoryTimes(self):
+        self.assertEqual(self.tree.lookup("/").mtime, 400)
+        self.assertEqual(self.tree.lookup("/dir/sub1").mtime, 200)
+        self.assertEqual(self.tree.lookup("/dir").ctime, 400)
+
+    def testInodes(self):
+        self.assertEqual(self.tree.root.inode, 10)
+        self.assertEqual(self.tree.get_inode_count(), 8)
+        inodes = set()
+        for path in ["/", "/a.txt", "/dir", "/dir/b.txt", "/dir/sub1",
+                     "/dir/sub1/c.txt", "/dir/sub2", "/dir/sub2/d.txt"]:
+            inodes.add(self.tree.lookup(path).inode)
+        self.assertEqual(inodes, set(range(10, 18)))
+
+    def testCorruptBloblist(self):
+        self.assertRaises(CorruptionError, SnapshotTree, [blobinfo("a"), blobinfo("a")])
+        self.assertRaises(CorruptionError, SnapshotTree, [blobinfo("a"), blobinfo("a/b")])
+
+class TestRepositoryTree(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.bloblists = {1: [blobinfo("a.txt")],
+                          2: [blobinfo("a.txt"), blobinfo("dir/b.txt")],
+                          3: [blobinfo("c.txt")]}
+        self.cache = SnapshotTreeCache(self.load_bloblist, 3 * mounttree.APPROX_NODE_SIZE)
+        self.tree = RepositoryTree({"s1": [1, 2], "s2": [3]}, self.cache)
+
+    def load_bloblist(self, rev):
+        self.loaded.append(rev)
+        return self.bloblists[rev]
+
+    def testTopLevels(self):
+        self.assertEqual(sorted(self.tree.root.children.keys()), ["s1", "s2"])
+        self.assertEqual(sorted(self.tree.lookup("/s1").children.keys()), ["1", "2", "latest"])
+        self.assertEqual(self.tree.lookup("/s1").nlink, 4)
+        self.assertEqual(self.tree.lookup("/s1/latest").target, "2")
+        self.assertEqual(self.tree.lookup("/s3"), None)
+        self.assertEqual(self.loaded, [])
+
+    def testLazyLoading(self):
+        self.assertTrue(isinstance(self.tree.lookup("/s1/2", load = False), RevisionNode))
+        self.assertEqual(self.loaded, [])
+        self.assertEqual(self.tree.lookup("/s1/2/dir/b.txt").size, 10)
+        self.assertEqual(self.loaded, [2])
+        self.assertEqual(self.tree.lookup("/s1/2", load = False).nlink, 3)
+        self.assertEqual(self.tree.lookup("/s1/2").inode, 2 << mounttree.SNAPSHOT_INODE_BITS)
+        self.assertEqual(self.loaded, [2])
+
+    def testEviction(self):
+        self.tree.lookup("/s1/1/a.txt") # 2 nodes
+        self.tree.lookup("/s2/3/c.txt") # 2 nodes, evicts rev 1
+        self.assertEqual(list(self.cache.trees.keys()), [3])
+        self.tree.lookup("/s1/2/a.txt") # 4 nodes, evicts rev 3 although over the limit
+        self.assertEqual(list(self.cache.trees.keys()), [2])
+        self.tree.lookup("/s1/1/a.txt")
+        self.assertEqual(self.loaded, [1, 3, 2, 1])
+        self.assertEqual(self.cache.total_size, 2 * mounttree.APPROX_NODE_SIZE)
+
+    def testInvalidSessionNames(self):
+        tree = RepositoryTree({"s1": [1], "a/b": [2], "..": [3]}, self.cache)
+        self.assertEqual(sorted(tree.root.children.keys()), ["s1"])
+
+    def testConcurrentLoading(self):
+        # Rev 1 is loaded only once, and rev 3 can be loaded while rev
+        # 1 is still loading.
+        release = threading.Event()
+        def load_bloblist(rev):
+            if rev == 1:
+                release.wait(10)
+            return self.load_bloblist(rev)
+        cache = SnapshotTreeCache(load_bloblist, 100 * mounttree.APPROX_NODE_SIZE)
+        trees = []
+        threads = [threading.Thread(target = lambda: trees.append(cache.get(1))) for n in range(2)]
+        for t in threads:
+            t.start()
+        self.assertEqual(cache.get(3).root.children["c.txt"].size, 10)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.loaded, [3, 1])
+        self.assertTrue(trees[0] is trees[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -254,6 +254,12 @@ class TestWorkdir(unittest.TestCase, WorkdirHelper):
         self.assertEqual(updated_tree, {'file2.txt': b'f2 mod1',
                                         'file3.txt': b'f3'})
 
+    def testBloblistCacheIsCopied(self):
+        wd = self.createWorkdir(self.repoUrl, {'file1.txt': 'f1'})
+        rev = wd.checkin()
+        wd.get_bloblist(rev)[0]['md5sum'] = "00000000000000000000000000000000"
+        self.assertEqual(wd.get_bloblist(rev)[0]['md5sum'], md5sum(b"f1"))
+
     def testUpdateResume(self):
         """ Test the case that some parts of the workdir are already
         up to date (like after an aborted update)."""
@@ -460,6 +466,40 @@ class TestWorkdir(unittest.TestCase, WorkdirHelper):
             write_tree(wd.root, {'file.txt': 'content 2'}, False, overwrite=True)
             self.assertEqual(wd.cached_md5sum(u"file.txt"), "6685cd62b95f2c58818cb20e7292168b")
 
+    def testParallelChecksums(self):
+        tree = {}
+        for n in range(0, 50):
+            tree['dir%s/file%s.txt' % (n % 3, n)] = b'content ' + str(n).encode() * n
+        wd = self.createWorkdir(self.repoUrl, tree)
+        wd.checksum_workers = 4
+        unchanged_files, new_files, modified_files, deleted_files, renamed_files, ignored_files = \
+            wd.get_changes_with_renames()
+        self.assertEqual(new_files, set(tree.keys()))
+        for fn, content in tree.items():
+            stat = os.stat(os.path.join(wd.root, fn))
+            self.assertEqual(wd.sqlcache.get(fn, stat), md5sum(content))
+
+    def testParallelChecksumsWithProcesses(self):
+        tree = {'a.txt': b'content a',
+                'b/b.txt': b'content b'}
+        wd = self.createWorkdir(self.repoUrl, tree)
+        wd.checksum_workers = 2
+        wd.checksum_processes = True
+        wd.checkin()
+        for fn, content in tree.items():
+            stat = os.stat(os.path.join(wd.root, fn))
+            self.assertEqual(wd.sqlcache.get(fn, stat), md5sum(content))
+
+    def testUnreadableFileDuringChecksum(self):
+        wd = self.createWorkdir(self.repoUrl, {'a.txt': b'content a'})
+        if os.name != "posix" or os.geteuid() == 0:
+            return # Permissions are not enforced
+        os.chmod(os.path.join(wd.root, "a.txt"), 0)
+        self.assertRaises(UserError, wd.get_changes_with_renames)
+        unchanged_files, new_files, modified_files, deleted_files, renamed_files, ignored_files = \
+            wd.get_changes_with_renames(ignore_errors = True)
+        self.assertEqual(new_files, set())
+
     def testIncludeModifications(self):
         """Expected behavior is that modifications of previously
         committed (but now ignored) files should be ignored. But they
@@ -15,13 +15,13 @@
 # limitations under the License.
 
 import os
-from front import Front, DryRunFront
+from front import Front, DryRunFront, iter_session_bloblist, front_supports
 import blobrepo.repository as repository
 from treecomp import TreeComparer
 from common import *
 from boar_exceptions import *
 from boar_common import *
-from jsonrpc import FileDataSource
+from jsonrpc import FileDataSource, iter_chunks
 
 import client
 
@@ -35,6 +35,8 @@ import tempfile
 import fnmatch
 import sqlite3
 import atexit
+import threading
+import concurrent.futures
 
 json = get_json_module()
 
@@ -43,6 +45,25 @@ CURRENT_VERSION = 3
 METADIR = ".boar"
 CCACHE_FILE = "ccache.db"
 
+# The read size used when calculating checksums of workdir files
+CHECKSUM_BLOCK_SIZE = 2**20
+
+def checksum_worker_settings():
+    """Returns a tuple (worker_count, use_processes) describing how
+    workdir files should be checksummed. The number of workers can be
+    set with the BOAR_CHECKSUM_WORKERS environment variable. Setting
+    BOAR_CHECKSUM_PROCESSES=1 makes the workers separate processes
+    instead of threads."""
+    workers = os.getenv("BOAR_CHECKSUM_WORKERS", str(default_worker_count()))
+    try:
+        workers = int(workers)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise UserError("BOAR_CHECKSUM_WORKERS must be a positive number, was: %s" % \
+                            os.getenv("BOAR_CHECKSUM_WORKERS"))
+    return workers, os.getenv("BOAR_CHECKSUM_PROCESSES") == "1"
+
 class Workdir(object):
     def __init__(self, repoUrl, sessionName, offset, revision, root, front = None):
         assert repoUrl == None or isinstance(repoUrl, str)
@@ -60,6 +81,7 @@ class Workdir(object):
         self.root = root
         self.metadir = os.path.join(self.root, METADIR)
         self.front = front
+        self.checksum_workers, self.checksum_processes = checksum_worker_settings()
         self.use_progress_printer(True)
         self.__upgrade()
 
@@ -80,6 +102,7 @@ class Workdir(object):
 
         assert self.revision == None or self.revision > 0
         self.revision_fronts = {}
+        self.last_bloblist = None # (revision, bloblist)
         self.tree_csums = None
         self.tree = None
         self.output = encoded_stdout()
@@ -116,17 +139,22 @@ class Workdir(object):
             self.__set_workdir_version(3)
 
     def __reload_tree(self):
+        """Rescans the workdir. Returns a dict with the stat results
+        of all the files found, keyed on the workdir path."""
         progress = self.ScanProgressPrinter()
         try:
-            self.tree = get_tree(self.root, skip = [METADIR], absolute_paths = False, \
-                                     progress_printer = progress)
+            stats = dict(walk_tree(self.root, skip = [METADIR], absolute_paths = False, \
+                                       progress_printer = progress))
             if os.name == 'nt':
-                self.tree = [fn.replace("\\", "/") for fn in self.tree]
+                stats = dict([(fn.replace("\\", "/"), st) for fn, st in stats.items()])
         except UndecodableFilenameException as e:
             raise UserError("Found a filename that is illegal under the current file system encoding (%s): '%s'" %
                             (sys.getfilesystemencoding(), e.human_readable_name))
+        # The order of the tree must be deterministic for tests to pass.
+        self.tree = sorted(stats.keys())
         self.tree_csums = None
         self.__reload_manifests()
+        return stats
 
     def __reload_manifests(self):
         self.manifest = {}
@@ -286,10 +314,10 @@ class Workdir(object):
         had its mtime adjusted, so that subsequent commands can find the
         cached checksum without re-reading the file."""
         try:
-            new_mtime = os.stat(target_path).st_mtime
+            stat = os.stat(target_path)
         except OSError:
             return
-        self.sqlcache.set(wd_relative_path, new_mtime, md5)
+        self.sqlcache.set(wd_relative_path, stat, md5)
 
     def update_revision(self, new_revision = None):
         assert new_revision == None or isinstance(new_revision, int)
@@ -324,8 +352,13 @@ class Workdir(object):
         if not front.has_snapshot(self.sessionName, new_revision):
             raise UserError("No such session or snapshot: %s@%s" % (self.sessionName, new_revision))
         old_bloblist = self.get_bloblist(old_revision)
-        new_bloblist = self.get_bloblist(new_revision)
-        new_bloblist_dict = bloblist_to_dict(new_bloblist)
+        if front_supports(front, "get_bloblist_delta"):
+            # Only the differences are fetched for the new revision
+            new_bloblist_dict = bloblist_to_dict(old_bloblist)
+            apply_delta(new_bloblist_dict, front.get_bloblist_delta(old_revision, new_revision))
+        else:
+            new_bloblist_dict = bloblist_to_dict(self.get_bloblist(new_revision))
+        new_bloblist = list(new_bloblist_dict.values())
         for b in sorted_bloblist(new_bloblist):
             if not is_child_path(self.offset, b['filename']):
                 continue
@@ -512,14 +545,30 @@ class Workdir(object):
         except FileMutex.MutexLocked as e:
             raise UserError("The session '%s' is in use (lockfile %s)" % (self.sessionName, e.mutex_file))
 
-        for sessionpath in sorted(files):
+        files = sorted(files)
+        expected_md5sums = [self.cached_md5sum(strip_path_offset(self.offset, sessionpath))
+                            for sessionpath in files]
+        # Blobs that are known to exist in the repository or in the
+        # new snapshot. Asking for them all in advance saves a round
+        # trip per file for remote repositories. Servers that can not
+        # answer for many blobs at once are asked once per file.
+        existing_blobs = None
+        if front_supports(front, "has_blobs"):
+            existing_blobs = set(get_existing_blobs(front, set(expected_md5sums)))
+
+        for sessionpath, expected_md5sum in zip(files, expected_md5sums):
             wd_path = strip_path_offset(self.offset, sessionpath)
             abspath = self.abspath(sessionpath)
-            expected_md5sum = self.cached_md5sum(wd_path)
             if sessionpath in self.manifest and self.manifest[sessionpath] != expected_md5sum:
                 raise UserError("File %s contents conflicts with manifest" % wd_path)
             try:
-                check_in_file(front, abspath, sessionpath, expected_md5sum, log = self.output)
+                blob_exists = None
+                if existing_blobs != None:
+                    blob_exists = expected_md5sum in existing_blobs
+                check_in_file(front, abspath, sessionpath, expected_md5sum, log = self.output,
+                              blob_exists = blob_exists)
+                if existing_blobs != None:
+                    existing_blobs.add(expected_md5sum)
             except ContentViolation:
                 raise UserError("File changed during commit: %s" % wd_path)
             except EnvironmentError as e:
@@ -547,7 +596,12 @@ class Workdir(object):
 
     def get_bloblist(self, revision):
         assert type(revision) == int, "Revision was '%s'" % revision
-        return self.front.get_session_bloblist(revision)
+        # Snapshots never change, so the most recently fetched
+        # bloblist can be reused. The caller gets its own copies of
+        # the entries, as they may be modified.
+        if self.last_bloblist == None or self.last_bloblist[0] != revision:
+            self.last_bloblist = revision, list(iter_session_bloblist(self.front, revision))
+        return [dict(blobinfo) for blobinfo in self.last_bloblist[1]]
 
     def exists_in_workdir(self, csum):
         """ Returns true if at least one file with the given checksum exists
@@ -575,9 +629,10 @@ class Workdir(object):
         current, otherwise returns None."""
         assert not os.path.isabs(relative_path), "Path must be relative to the workdir. Was: "+relative_path
         assert self.sqlcache
-        abspath = self.wd_abspath(relative_path)
-        stat = os.stat(abspath)
-        sums = self.sqlcache.get(relative_path, stat.st_mtime)
+        return self.__get_cached_md5sum(relative_path, os.stat(self.wd_abspath(relative_path)))
+
+    def __get_cached_md5sum(self, relative_path, stat):
+        sums = self.sqlcache.get(relative_path, stat)
         recent_change = abs(time.time() - stat.st_mtime) < 5.0
         if sums and not recent_change:
             return sums
@@ -593,7 +648,7 @@ class Workdir(object):
             abspath = self.wd_abspath(relative_path)
             stat = os.stat(abspath)
             md5, = checksum_file(abspath, ("md5",))
-            self.sqlcache.set(relative_path, stat.st_mtime, md5)
+            self.sqlcache.set(relative_path, stat, md5)
         assert is_md5sum(md5)
         return md5
 
@@ -633,6 +688,88 @@ class Workdir(object):
         result = self.root + "/" + without_offset
         return result
 
+    def __checksum_files(self, relative_paths, sizes, ignore_errors):
+        """Calculates the md5 checksums of the given workdir files in a
+        pool of workers, largest files first, and stores them in the
+        checksum cache. Returns a dict mapping the relative paths to
+        their checksums. Unreadable files are left out if
+        ignore_errors is True, otherwise a UserError is raised. Only
+        the calling thread writes to the checksum cache and the
+        progress printer."""
+        total_files = len(relative_paths)
+        total_bytes = sum([sizes[fn] for fn in relative_paths])
+        completed_files = 0
+        completed_bytes = 0
+        # Bytes read so far of files that are being checksummed right
+        # now. Only updated when the workers are threads.
+        bytes_read = {}
+        lock = threading.Lock()
+        aborted = threading.Event()
+
+        def work_reporter(fn):
+            def report_work(amount):
+                if aborted.is_set():
+                    raise concurrent.futures.CancelledError()
+                with lock:
+                    bytes_read[fn] = bytes_read.get(fn, 0) + amount
+            return report_work
+
+        def remaining_bytes():
+            with lock:
+                in_progress = sum(bytes_read.values())
+            return max(0, total_bytes - completed_bytes - in_progress)
+
+        if self.checksum_processes:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.checksum_workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.checksum_workers)
+
+        # Smallest last, so that the largest files can be popped first
+        queue = sorted(relative_paths, key = lambda fn: sizes[fn])
+        # Keep the number of queued tasks bounded, there may be
+        # millions of files.
+        max_pending = 2 * self.checksum_workers
+        pending = {}
+        result = {}
+        progress = self.ChecksumProgressPrinter()
+        progress.update(total_files, total_files, total_bytes, total_bytes)
+        with executor:
+            try:
+                while queue or pending:
+                    while queue and len(pending) < max_pending:
+                        fn = queue.pop()
+                        if self.checksum_processes:
+                            future = executor.submit(_checksum_workdir_file, self.wd_abspath(fn))
+                        else:
+                            future = executor.submit(_checksum_workdir_file, self.wd_abspath(fn), work_reporter(fn))
+                        pending[future] = fn
+                    finished, not_finished = concurrent.futures.wait(list(pending.keys()), timeout = 0.5,
+                                                                     return_when = concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        fn = pending.pop(future)
+                        try:
+                            stat, md5 = future.result()
+                            self.sqlcache.set(fn, stat, md5)
+                            result[fn] = md5
+                        except EnvironmentError as e:
+                            f = posix_path_join(self.offset, fn)
+                            if ignore_errors:
+                                warn("Ignoring unreadable file: %s" % f)
+                            else:
+                                raise UserError("Unreadable file: %s" % f)
+                        with lock:
+                            bytes_read.pop(fn, None)
+                        completed_files += 1
+                        completed_bytes += sizes[fn]
+                    progress.update(total_files, total_files - completed_files, total_bytes, remaining_bytes())
+            except:
+                aborted.set()
+                for future in pending:
+                    future.cancel()
+                raise
+        progress.finished()
+        return result
+
     def get_changes_with_renames(self, revision = None, ignore_errors = False):
         """ Compares the work dir with given revision, or the latest
             revision if no revision is given. Returns a tuple of five
@@ -645,7 +782,7 @@ class Workdir(object):
 
         front = self.get_front()
 
-        self.__reload_tree()
+        tree_stats = self.__reload_tree()
         existing_files_list = copy.copy(self.tree)
         prefix = ""
         if self.offset:
@@ -657,37 +794,21 @@ class Workdir(object):
         files_to_checksum = []
         files_to_checksum_sizes = {}
         for fn in existing_files_list:
-            md5 = self.get_cached_md5sum(fn)
+            stat = tree_stats[fn]
+            md5 = self.__get_cached_md5sum(fn, stat)
             if md5 == None:
                 files_to_checksum.append(fn)
-                files_to_checksum_sizes[fn] = os.path.getsize(self.wd_abspath(fn))
+                files_to_checksum_sizes[fn] = stat.st_size
             else:
                 filelist[prefix + fn] = md5
             scan_progress.update()
         scan_progress.finished()
+        # Every file has been looked up, so any old style cache
+        # entries worth keeping have been converted by now.
+        self.sqlcache.finish_migration()
 
-        total_files = len(files_to_checksum)
-        total_bytes = sum(files_to_checksum_sizes.values())
-        remaining_files = total_files
-        remaining_bytes = total_bytes
-
-        progress = self.ChecksumProgressPrinter()
-        progress.update(total_files, remaining_files, total_bytes, remaining_bytes)
-
-        for fn in files_to_checksum:
-            f = prefix + fn
-            try:
-                filelist[f] = self.cached_md5sum(fn)
-            except EnvironmentError as e:
-                if ignore_errors:
-                    warn("Ignoring unreadable file: %s" % f)
-                else:
-                    raise UserError("Unreadable file: %s" % f)
-            remaining_files -= 1
-            remaining_bytes -= files_to_checksum_sizes[fn]
-            progress.update(total_files, remaining_files, total_bytes, remaining_bytes)
-
-        progress.finished()
+        for fn, md5 in self.__checksum_files(files_to_checksum, files_to_checksum_sizes, ignore_errors).items():
+            filelist[prefix + fn] = md5
 
         for f in list(filelist.keys()):
             assert not is_windows_path(f), "Was:" + f
@@ -765,18 +886,50 @@ class Workdir(object):
         return tuple(unchanged_files), tuple(new_files), tuple(modified_files), tuple(deleted_files), ignored_files
 
 
+def _checksum_workdir_file(abspath, report_work = None):
+    """Returns a tuple (stat, md5) for the given file. The stat is
+    taken before the file is read, so that a file that is modified
+    while it is read will not match the cached checksum later. This
+    function is executed by the checksum workers, and must therefore
+    be possible to pickle."""
+    stat = os.stat(abspath)
+    md5summer = hashlib.md5()
+    with safe_open(abspath, "rb") as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b""):
+            md5summer.update(block)
+            if report_work:
+                report_work(len(block))
+    return stat, md5summer.hexdigest()
+
 def fnmatch_multi(patterns, filename):
     for pattern in patterns:
         if fnmatch.fnmatch(filename, pattern):
             return True
     return False
 
-def check_in_file(front, abspath, sessionpath, expected_md5sum, log = FakeFile()):
+# The maximum number of blobs to ask for in a single has_blobs() call
+HAS_BLOBS_BATCH_COUNT = 10000
+
+def get_existing_blobs(front, md5sums):
+    """ Returns the subset of the given blobs that exists in the
+    repository, or in the snapshot underway. """
+    md5sums = list(md5sums)
+    result = []
+    for n in range(0, len(md5sums), HAS_BLOBS_BATCH_COUNT):
+        batch = md5sums[n:n+HAS_BLOBS_BATCH_COUNT]
+        for md5sum, exists in zip(batch, decode_bitmap(front.has_blobs(batch), len(batch))):
+            if exists:
+                result.append(md5sum)
+    return result
+
+def check_in_file(front, abspath, sessionpath, expected_md5sum, log = FakeFile(), blob_exists = None):
     """ Checks in the file found at the given "abspath" into the
     active "front" with the path in the session given as
     "sessionpath". The md5sum of the file has to be provided. The
     checksum is compared to the file while it is read, to ensure it is
-    consistent."""
+    consistent. If the caller already knows if the blob exists in the
+    repository or the new snapshot, it can be given as "blob_exists"
+    to save a lookup."""
     assert os.path.isabs(abspath), \
         "abspath must be absolute. Was: '%s'" % (abspath)
     assert ".." not in sessionpath.split("/"), \
@@ -785,14 +938,22 @@ def check_in_file(front, abspath, sessionpath, expected_md5sum, log = FakeFile()
     assert os.path.exists(abspath), "Tried to check in file that does not exist: " + abspath
     blobinfo = create_blobinfo(abspath, sessionpath, expected_md5sum)
     pp = SimpleProgressPrinter(log, u"Sending %s" % sessionpath)
-    if not front.has_blob(expected_md5sum) and not front.new_snapshot_has_blob(expected_md5sum):
+    if blob_exists == None:
+        blob_exists = front.has_blob(expected_md5sum) or front.new_snapshot_has_blob(expected_md5sum)
+    if not blob_exists:
         # File does not exist in repo or previously in this new snapshot. Upload it.
         _send_file_hook(abspath) # whitebox testing
         with open_raw(abspath) as f:
             #t0 = time.time()
             front.init_new_blob(expected_md5sum, blobinfo["size"])
             #print "check_in_file: front.init_new_blob()", expected_md5sum, time.time() - t0
-            datasource = FileDataSource(f, os.path.getsize(abspath), progress_callback = pp.update)
+            offset = 0
+            if blobinfo["size"] >= repository.RESUMABLE_UPLOAD_MIN_SIZE and \
+                    front_supports(front, "get_partial_offset"):
+                # Continue where an interrupted upload left off
+                offset = front.get_partial_offset(expected_md5sum)
+                f.seek(offset)
+            datasource = FileDataSource(f, max(0, os.path.getsize(abspath) - offset), progress_callback = pp.update)
             front.add_blob_data_streamed(blob_md5 = expected_md5sum, datasource = datasource)
             #print "check_in_file: front.add_blob_data_streamed()", expected_md5sum, time.time() - t0
             front.blob_finished(expected_md5sum)
@@ -876,8 +1037,8 @@ def fetch_blob(front, blobname, target_path, overwrite = False, mtime = None):
     os.close(tmpfile_fd)
     try:
         with StrictFileWriter(tmpfile, blobname, size, overwrite = True) as f:
-            while datareader.bytes_left() > 0:
-                f.write(datareader.read(2**14))
+            for data in iter_chunks(datareader):
+                f.write(data)
         os.rename(tmpfile, target_path)
     except:
         if os.path.exists(tmpfile):
@@ -989,12 +1150,34 @@ def _mtime_to_str(mtime):
     return s
 
 
+def _stat_key(stat):
+    """Returns the parts of a stat result that must be unchanged for
+    a cached checksum to be considered valid. On Windows, the stat
+    results from os.scandir() (see walk_tree()) have an inode number
+    of 0, while os.stat() gives the real one, so the inode number is
+    left out there."""
+    inode = 0 if os.name == "nt" else stat.st_ino
+    return (stat.st_size, stat.st_mtime_ns, inode, stat.st_ctime_ns)
+
 class ChecksumCache(object):
+    """A persistent cache of file checksums. An entry is valid as
+    long as the size, mtime, inode number (except on Windows) and
+    ctime of the file are unchanged. All entries are loaded into
+    memory when the cache is opened, so that lookups do not need to
+    touch the database.
+
+    Caches written by older versions of boar used a table keyed on
+    (path, mtime) only. Such entries are still accepted, and are
+    converted to the current format when they are looked up. The old
+    table is dropped by finish_migration()."""
+
     def __init__(self, dbpath):
         assert dbpath == ":memory:" or os.path.isabs(dbpath)
         assert dbpath == ":memory:" or os.path.exists(os.path.dirname(dbpath))
         self.dbpath = dbpath
         self.conn = None
+        self.entries = {} # path -> (stat_key, md5, row_md5)
+        self.has_legacy_table = False
         self.__init_db()
         atexit.register(self.sync)
         self.rate_limiter = RateLimiter(hz = 1.0/60.0)
@@ -1004,31 +1187,63 @@ class ChecksumCache(object):
             return
         try:
             self.conn = sqlite3.connect(self.dbpath, check_same_thread = False)
-            self.conn.execute("CREATE TABLE IF NOT EXISTS ccache (path text, mtime unsigned int, md5 char(32), row_md5 char(32))")
-            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ccache_index ON ccache (path, mtime)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS checksums (path text PRIMARY KEY, size integer, "
+                              "mtime_ns integer, inode integer, ctime_ns integer, md5 char(32), row_md5 char(32))")
             self.conn.commit()
             # Exclusive mode seems to make operations a lot faster
             self.conn.execute("PRAGMA locking_mode = EXCLUSIVE")
             self.conn.execute("BEGIN")
+            c = self.conn.cursor()
+            c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'ccache'")
+            self.has_legacy_table = bool(c.fetchall())
+            c.execute("SELECT path, size, mtime_ns, inode, ctime_ns, md5, row_md5 FROM checksums")
+            for path, size, mtime_ns, inode, ctime_ns, md5, row_md5 in c:
+                self.entries[path] = ((size, mtime_ns, inode, ctime_ns), md5, row_md5)
         except sqlite3.DatabaseError as e:
             raise
 
     @staticmethod
-    def _row_md5(path, mtime, md5):
+    def _row_md5(path, key, md5):
+        return md5sum(path.encode("utf8") + b"!" + "!".join(map(str, key)).encode("utf8") + b"!" + md5.encode("utf8"))
+
+    @staticmethod
+    def _legacy_row_md5(path, mtime, md5):
         return md5sum(path.encode("utf8") + b"!" + _mtime_to_str(mtime).encode("utf8") + b"!" + md5.encode("utf8"))
 
-    def set(self, path, mtime, md5):
+    def set(self, path, stat, md5):
+        """Stores the checksum of the file at the given path. The stat
+        argument must be the result of os.stat() on the file, taken
+        before its content was read."""
         assert type(path) == str
-        md5_row = self._row_md5(path, mtime, md5)
+        key = _stat_key(stat)
+        md5_row = self._row_md5(path, key, md5)
         try:
-            self.conn.execute("REPLACE INTO ccache (path, mtime, md5, row_md5) VALUES (?, ?, ?, ?)", (path, mtime, md5, md5_row))
+            self.conn.execute("REPLACE INTO checksums (path, size, mtime_ns, inode, ctime_ns, md5, row_md5) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)", (path,) + key + (md5, md5_row))
+            self.entries[path] = (key, md5, md5_row)
             if self.rate_limiter.ready():
                 self.sync()
         except sqlite3.DatabaseError as e:
             raise
 
-    def get(self, path, mtime):
+    def get(self, path, stat):
+        """Returns the cached checksum for the file at the given path,
+        or None if there is no entry matching the given stat result."""
         assert type(path) == str
+        entry = self.entries.get(path)
+        if entry:
+            key, md5, row_md5 = entry
+            if key == _stat_key(stat):
+                assert row_md5 == self._row_md5(path, key, md5), "Workdir cache corrupted"
+                return md5
+        if self.has_legacy_table:
+            md5 = self.__get_legacy(path, stat.st_mtime)
+            if md5:
+                self.set(path, stat, md5)
+            return md5
+        return None
+
+    def __get_legacy(self, path, mtime):
         try:
             c = self.conn.cursor()
             c.execute("SELECT md5, row_md5 FROM ccache WHERE path = ? AND mtime = ?", (path, mtime))
@@ -1039,7 +1254,7 @@ class ChecksumCache(object):
             return None
         assert len(rows) == 1
         md5, row_md5 = rows[0]
-        expected_md5_row = self._row_md5(path, mtime, md5)
+        expected_md5_row = self._legacy_row_md5(path, mtime, md5)
         if row_md5 != expected_md5_row:
             # Also accept checksums computed with Python 3's str(float)
             # for caches that were written by a pre-fix Python 3 version.
@@ -1047,6 +1262,19 @@ class ChecksumCache(object):
             assert row_md5 == py3_md5_row or row_md5 == expected_md5_row, "Workdir cache corrupted"
         return md5
 
+    def finish_migration(self):
+        """Drops the table used by older versions of boar. Should be
+        called when every file in the workdir has been looked up, so
+        that all useful old entries have been converted."""
+        if not self.has_legacy_table:
+            return
+        try:
+            self.conn.execute("DROP TABLE ccache")
+            self.has_legacy_table = False
+            self.sync()
+        except sqlite3.DatabaseError as e:
+            raise
+
     def sync(self):
         if self.conn:
             self.conn.commit()